@@ -3,7 +3,8 @@
 Requires:
     Third Party:
         cx_Oracle module (pip name is cx-Oracle): Used to handle connections and pools to individual
-            Oracle database instances.
+            Oracle database instances. Not needed when pools are given a driver such as
+            stand_in.StandInDriver().
     Internal:
         lib/pythonlibs/luminate/utils.py: Used for gathering cluster and site specific data to
             to determine database connection details.
@@ -17,6 +18,33 @@ Classes:
     Site_Pool: Classed used for creating and handling a connection pool to Site Schemas.
         Uses heterogeneous pooling so that each connection acquired can be used for a different site
         schema.
+    PoolManager: Class used for getting site schema connections for sites on any DB in the cluster.
+        Creates a Site_Pool for a DB the first time a site on it needs a connection.
+    FanOutQuery: Class used for running the same statement against every site schema in a SiteList
+        at once, at most a few at a time per DB, and streaming back (site, row) tuples.
+        Example:
+            query = FanOutQuery(sitelist, "select count(*) from cons", manager=manager)
+            for site, row in query:
+                print(site.short, row)
+            print(query.failures)
+    BulkWriter: Class used for writing many rows to site schemas with array DML, a batch of rows per
+        executemany and a commit per few batches on each site's connection.
+        Example:
+            with BulkWriter(manager, "update cons set email = :2 where cons_id = :1") as writer:
+                for site, cons_id, email in fixes:
+                    writer.add(site, (cons_id, email))
+            print(writer.statistics(), writer.errors)
+    SiteUrlLookup: Class used for resolving URLs to site_ids from an in memory copy of the convio
+        schema's site_url table that is refreshed in the background.
+        Example:
+            site_id = SiteUrlLookup(ConvioPool(db='db103tc')).lookup('www.jdrf.org/site/Donation')
+    AsyncPool: Class used for acquiring connections and streaming rows from asyncio code. Wraps a
+        Convio_Pool, Site_Pool or PoolManager.
+        Example:
+            async with AsyncPool(manager) as pool:
+                async with pool.connection(site) as connection:
+                    async for row in connection.rows("select * from site_url"):
+                        print(row)
 
     Example text, delete below this line once docstring is complete.
     Cluster: Used for cluster wide data and operations.
@@ -35,14 +63,62 @@ Classes:
                       utils.SiteList(key='short', subfile='/some/path/to/file.txt')
 """
 
-import cx_Oracle
+import asyncio
+import csv
+import heapq
+import json
+import logging
+import queue
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import asynccontextmanager, contextmanager
+from functools import partial
+from itertools import count
+from time import monotonic, perf_counter
+
 from utils import Cluster
 
+try:
+    import cx_Oracle
+except ImportError:
+    cx_Oracle = None
+
+LOGGER = logging.getLogger(__name__)
+
+# Upper bounds in milliseconds of the acquire wait time histogram buckets, the last bucket holds
+# every wait longer than WAIT_BUCKETS[-1]
+WAIT_BUCKETS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+# ORA-24418 cannot open further sessions, ORA-24457 no free session within the wait timeout
+POOL_EXHAUSTED_CODES = (24418, 24457)
+# Largest max a pool can have when no ceiling kwarg is given
+DEFAULT_CEILING = 10
+# Rows fetched per round trip by stream() and export()
+DEFAULT_ARRAYSIZE = 1000
+EXPORT_FORMATS = ('csv', 'jsonl')
+SITE_URL_STATEMENT = "select prefix, site_id from site_url"
+# Longest site_url prefix that url starts with, for lookups the in memory copy misses
+SITE_URL_MATCH_STATEMENT = ("select prefix, site_id from (select prefix, site_id from site_url "
+                            "where substr(:url, 1, length(prefix)) = prefix "
+                            "order by length(prefix) desc) where rownum = 1")
+# Slowest a statement can run in seconds before QueryMetrics logs it as a slow query
+SLOW_QUERY_SECONDS = 1.0
+# Priority classes of acquires waiting on a fair or adaptive pool, lower classes are served first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BATCH = 2
+# kwargs a PoolManager passes on to each of its pools
+POOL_KWARGS = ('min', 'max', 'timeout', 'leak_timeout', 'ceiling', 'adaptive', 'grow_wait',
+               'idle_timeout', 'driver', 'stmtcachesize', 'hooks', 'fair', 'ping_interval')
+
 
 class LODBPool:
     """kwargs:
         prod_file: pathlike or filelike object to pass on to Cluster
         db_file: pathlike or filelike object to pass on to Cluster
+        cluster: Cluster to use instead of one from prod_file and db_file
         type: type of pool to create
             Options:
                 convio: creates homogeneous pool to a single db with convio credentials
@@ -50,76 +126,1791 @@ class LODBPool:
                     during connection acquisition.
                 db: database sid/dsn to connect to
                 min: minimum size of the pool
-                max: maximum size of the pool"""
+                max: maximum size of the pool
+                timeout: seconds to wait for a free connection when the pool is at max, by default
+                    acquiring fails straight away, or for a fair or adaptive pool waits as long as
+                    it takes
+                leak_timeout: seconds a connection can be held before it is logged as a leak along
+                    with where it was acquired. Held connections are checked on every acquire and
+                    by a background thread every leak_timeout / 2 seconds until the pool is closed
+                ceiling: largest max allowed, DEFAULT_CEILING by default
+                adaptive: when True the pool starts at max connections and grows towards ceiling
+                    while acquires wait, then shrinks back once connections sit idle, see
+                    AdaptiveLimit
+                grow_wait: seconds an adaptive acquire waits before the pool grows, default 0.05
+                idle_timeout: seconds an adaptive pool's connections sit idle before it shrinks and
+                    idle sessions are closed, default 60
+                driver: module or object with the cx_Oracle API to create the pool with, cx_Oracle
+                    by default
+                stmtcachesize: number of prepared statements each session keeps cached, the
+                    driver's default of 20 when not given
+                hooks: list of functions called with a QueryEvent for every statement run on the
+                    pool's connections, see add_hook()
+                fair: when True acquires that have to wait are queued by priority then arrival
+                    and fail with TimeoutError after timeout seconds, see FairGate. Adaptive pools
+                    are always fair
+                ping_interval: seconds a session can sit idle before acquire pings it and
+                    replaces it if it is dead, needs cx_Oracle 8.2, the driver's default of 60 when
+                    not given and negative to never ping
+
+    Attributes:
+        cluster: the Cluster the db belongs to
+        pool: the cx_Oracle.SessionPool
+        checkouts: dictionary of id(connection) to a Checkout for every connection currently
+            acquired from the pool
+        hooks: list of the functions called with a QueryEvent for every statement, while it is
+            empty connections are handed out as they come from the driver
+        stats: PoolStats counting acquires, releases, wait times and timeouts
+        limit: AdaptiveLimit deciding how many connections can be held at once, None unless the
+            pool is adaptive
+        gate: FairGate, or the AdaptiveLimit, queueing acquires while the pool is at its limit,
+            None unless the pool is fair or adaptive
+    """
 
     def __init__(self, **kwargs):
         accepted_types = ('convio', 'site')
 
-        if 'prod_file' in kwargs and 'db_file' in kwargs:
-            self.cluster = Cluster(prod_file=kwargs['prod_file'], db_file=kwargs['db_file'])
-        elif 'prod_file' in kwargs:
-            self.cluster = Cluster(prod_file=kwargs['prod_file'])
-        elif 'db_file' in kwargs:
-            self.cluster = Cluster(db_file=kwargs['db_file'])
-        else:
-            self.cluster = Cluster()
+        self.cluster = _get_cluster(kwargs)
+        self.driver = kwargs.get('driver', cx_Oracle)
+        if self.driver is None:
+            raise ImportError("cx_Oracle is not installed, install it or pass a 'driver' kwarg")
 
         if 'type' not in kwargs or kwargs['type'] not in accepted_types:
             raise ValueError("The 'type' kwarg is required and must contain a value "
                              "from {}".format(accepted_types))
-        if 'db' not in kwargs or kwargs['db'] not in self.cluster.db_list:
+        if 'db' not in kwargs or kwargs['db'] not in self.cluster.db_set:
             raise ValueError("The 'db' kwarg is required and must contain a value "
                              "from {}".format(self.cluster.db_list))
+        # Without a ceiling the original caps of 5 and 10 apply
+        ceiling = kwargs.get('ceiling', DEFAULT_CEILING)
+        min_cap = ceiling if 'ceiling' in kwargs else 5
         if 'min' in kwargs:
-            if kwargs['min'] < 1 or kwargs['min'] > 5:
-                raise ValueError("The 'min' kwarg cannot exceed 5")
+            if kwargs['min'] < 1 or kwargs['min'] > min_cap:
+                raise ValueError("The 'min' kwarg cannot exceed {}".format(min_cap))
         else:
             kwargs['min'] = 1
         if 'max' in kwargs:
-            if kwargs['max'] < 1 or kwargs['max'] > 10:
-                raise ValueError("The 'max' kwarg cannot exceed 10")
+            if kwargs['max'] < 1 or kwargs['max'] > ceiling:
+                raise ValueError("The 'max' kwarg cannot exceed {}".format(ceiling))
         else:
             kwargs['max'] = 2
+        self.leak_timeout = kwargs.get('leak_timeout')
+        self.timeout = kwargs.get('timeout')
+        self.checkouts = {}
+        self.stats = PoolStats()
+        self.hooks = kwargs.get('hooks', [])
+        self._lock = threading.Lock()
+        self._closed = False
+        self._stopped = threading.Event()
+
+        session_kwargs = {}
+        for name in ('stmtcachesize', 'ping_interval'):
+            if name in kwargs:
+                session_kwargs[name] = kwargs[name]
+
+        self.limit = None
+        self.gate = None
+        if kwargs.get('adaptive'):
+            self.limit = self.gate = AdaptiveLimit(kwargs['max'], ceiling,
+                                                   grow_wait=kwargs.get('grow_wait', 0.05),
+                                                   idle_timeout=kwargs.get('idle_timeout', 60))
+            # The session pool may open up to the ceiling and closes sessions left idle, the
+            # AdaptiveLimit keeps the number in use below its current limit
+            kwargs['max'] = ceiling
+            session_kwargs['timeout'] = int(self.limit.idle_timeout)
+        elif kwargs.get('fair'):
+            self.gate = FairGate(kwargs['max'])
+        elif self.timeout is not None:
+            # Without a gate the session pool itself waits for a free session
+            session_kwargs.update({'getmode': self.driver.SPOOL_ATTRVAL_TIMEDWAIT,
+                                   'wait_timeout': int(self.timeout * 1000)})
 
         if kwargs['type'] == 'convio':
             try:
-                self.pool = cx_Oracle.SessionPool(user='convio', password='convio',
-                                                  dsn=kwargs['db'], min=kwargs['min'],
-                                                  max=kwargs['max'], increment=1, encoding="UTF-8")
-            except cx_Oracle.DatabaseError as error:
+                self.pool = self.driver.SessionPool(user='convio', password='convio',
+                                                    dsn=kwargs['db'], min=kwargs['min'],
+                                                    max=kwargs['max'], increment=1,
+                                                    encoding="UTF-8", **session_kwargs)
+            except self.driver.DatabaseError as error:
                 print(error)
                 raise error
         elif kwargs['type'] == 'site':
             try:
-                self.pool = cx_Oracle.SessionPool(dsn=kwargs['db'], min=kwargs['min'],
-                                                  max=kwargs['max'], increment=1, encoding="UTF-8",
-                                                  homogeneous=False)
-            except cx_Oracle.DatabaseError as error:
+                self.pool = self.driver.SessionPool(dsn=kwargs['db'], min=kwargs['min'],
+                                                    max=kwargs['max'], increment=1,
+                                                    encoding="UTF-8", homogeneous=False,
+                                                    **session_kwargs)
+            except self.driver.DatabaseError as error:
                 print(error)
                 raise error
 
+        if self.leak_timeout is not None:
+            # A pool that goes quiet has no acquires to find its leaks
+            threading.Thread(target=self._watch_leaks, name='LODBPool leaks', daemon=True).start()
+
+    def close(self, force=False):
+        """Closes the pool. Unless force is True this fails while connections are still acquired."""
+        self.pool.close(force=force)
+        self._closed = True
+        self._stopped.set()
+
+    def _watch_leaks(self):
+        while not self._stopped.wait(self.leak_timeout / 2):
+            self.check_leaks()
+
+    def add_hook(self, hook):
+        """Calls hook with a QueryEvent for every statement run on connections acquired from now
+        on, e.g. a QueryMetrics. Exceptions raised by hook are logged and otherwise ignored."""
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def _emit(self, event):
+        for hook in list(self.hooks):
+            try:
+                hook(event)
+            except Exception:
+                LOGGER.exception("Query hook %r failed", hook)
+
+    def acquire(self, site=None, priority=PRIORITY_NORMAL, timeout=None, **acquire_kwargs):
+        """Returns a connection from the pool, recording how long it took to get and, when
+        leak_timeout is set, where it was acquired.
+
+        A fair or adaptive pool at its limit queues the acquire behind those of the same or a lower
+        priority class and raises TimeoutError once it has waited timeout seconds, the pool's
+        timeout when None. Other pools have no queue to order so priority makes no difference.
+        While the pool has hooks the connection is an InstrumentedConnection tagged with site."""
+        if self.gate is None and timeout is not None:
+            raise ValueError("Only a fair or adaptive pool takes a timeout for each acquire.")
+        start = perf_counter()
+        if self.gate is not None:
+            try:
+                self.gate.enter(self.timeout if timeout is None else timeout, priority)
+            except TimeoutError:
+                self.stats.record_failure(perf_counter() - start, True)
+                raise
+        try:
+            connection = self.pool.acquire(**acquire_kwargs)
+        except BaseException as error:
+            # Whatever went wrong the acquire no longer holds its place in the gate
+            if self.gate is not None:
+                self.gate.exit()
+            if isinstance(error, self.driver.DatabaseError):
+                self.stats.record_failure(perf_counter() - start, _is_exhausted(error))
+            raise
+        waited = perf_counter() - start
+        self.stats.record_acquire(waited)
+
+        stack = None
+        if self.leak_timeout is not None:
+            stack = traceback.extract_stack()[:-2]
+        checkout = Checkout(connection, stack, acquire_kwargs)
+        if self.hooks:
+            checkout.connection = InstrumentedConnection(self, connection, site, waited)
+        with self._lock:
+            self.checkouts[id(connection)] = checkout
+        if self.leak_timeout is not None:
+            self.check_leaks()
+        return checkout.connection
+
+    def release(self, connection):
+        """Returns connection to the pool to be reused."""
+        connection = self._checkin(connection)[0]
+        try:
+            self.pool.release(connection)
+        finally:
+            if self.gate is not None:
+                self.gate.exit()
+        self.stats.record_release()
+
+    def drop(self, connection):
+        """Closes connection and removes it from the pool, use for connections that are broken.
+        A fair or adaptive pool opens a session in its place in the background."""
+        connection, checkout = self._checkin(connection)
+        try:
+            self.pool.drop(connection)
+        finally:
+            if self.gate is not None:
+                self.gate.exit()
+        self.stats.record_release(dropped=True)
+        if self.gate is not None and not self._closed:
+            threading.Thread(target=self._replace, args=(checkout.credentials,),
+                             name='LODBPool replace', daemon=True).start()
+
+    def _replace(self, credentials):
+        # Opens a session and parks it in the pool, so the next acquire does not wait for a
+        # connect. The gate is entered without waiting so it never takes a session an acquire
+        # was promised, a busy pool opens sessions on demand anyway
+        try:
+            self.gate.enter(0, PRIORITY_BATCH)
+        except TimeoutError:
+            return
+        try:
+            connection = self.pool.acquire(**credentials)
+            self.pool.release(connection)
+        except self.driver.Error as error:
+            LOGGER.info("Could not replace a dropped session on %s: %s", self.pool.tnsentry,
+                        error)
+            return
+        finally:
+            self.gate.exit()
+        self.stats.record_replacement()
+
+    def close_connection(self, connection, drop=False):
+        """Releases connection back to the pool, or drops it when drop is True."""
+        if drop:
+            self.drop(connection)
+        else:
+            self.release(connection)
+
+    @contextmanager
+    def _checked_out(self, connection):
+        # Always gives connection back, dropping it if a database error left it unusable
+        try:
+            yield connection
+        except self.driver.DatabaseError:
+            self.close_connection(connection, drop=not self._is_usable(connection))
+            raise
+        except BaseException:
+            self.release(connection)
+            raise
+        else:
+            self.release(connection)
+
+    def _connect(self, site):
+        # get_connection() for a ConvioPool, get_connection(site) for a SitePool
+        return self.get_connection() if site is None else self.get_connection(site)
+
+    def cursor(self, connection):
+        """Returns a cursor for connection that is reused by every call until the connection is
+        released, when it is closed. Running the same statement again on it skips the prepare."""
+        checkout = self.checkouts.get(id(_unwrap(connection)))
+        if checkout is None:
+            raise ValueError("Connection was not acquired from this pool or was already released.")
+        if checkout.cursor is None:
+            checkout.cursor = checkout.connection.cursor()
+        return checkout.cursor
+
+    @contextmanager
+    def _cursor(self, statement, parameters, site, arraysize, prefetchrows):
+        # Executes statement on a connection from the pool and yields the cursor
+        with self._checked_out(self._connect(site)) as connection:
+            cursor = self.cursor(connection)
+            cursor.arraysize = arraysize
+            if prefetchrows is not None:
+                cursor.prefetchrows = prefetchrows
+            if parameters is None:
+                cursor.execute(statement)
+            else:
+                cursor.execute(statement, parameters)
+            yield cursor
+
+    def stream(self, statement, parameters=None, site=None, arraysize=DEFAULT_ARRAYSIZE,
+               prefetchrows=None):
+        """Generator of lists of up to arraysize rows returned by statement, one list per round
+        trip, so only a batch of rows is held at a time. site is required for a SitePool.
+
+        arraysize sets how many rows each round trip fetches and prefetchrows how many come back
+        with the execute itself. The connection is released once the generator is exhausted or
+        closed.
+
+        Example:
+            for batch in pool.stream("select prefix, site_id from site_url", arraysize=5000):
+                process(batch)
+        """
+        with self._cursor(statement, parameters, site, arraysize, prefetchrows) as cursor:
+            yield from _batches(cursor)
+
+    def export(self, statement, output, format='csv', parameters=None, site=None,
+               arraysize=DEFAULT_ARRAYSIZE, prefetchrows=None):
+        """Writes the rows returned by statement to output, a text file object, and returns how
+        many were written.
+
+        format 'csv' writes a header of the column names followed by a line per row, 'jsonl'
+        writes a JSON object per row keyed by column name. Rows are fetched and written a batch
+        at a time, see stream()."""
+        if format not in EXPORT_FORMATS:
+            raise ValueError("The format must be one of {}".format(EXPORT_FORMATS))
+        with self._cursor(statement, parameters, site, arraysize, prefetchrows) as cursor:
+            columns = [column[0] for column in cursor.description]
+            if format == 'csv':
+                return write_csv(_batches(cursor), output, columns)
+            return write_jsonl(_batches(cursor), output, columns)
+
+    def _is_usable(self, connection):
+        # Checks with a round trip whether a connection survived a database error
+        try:
+            connection.ping()
+        except self.driver.Error:
+            return False
+        return True
+
+    def _checkin(self, connection):
+        # Forgets connection's Checkout, closing its cursor, and returns the driver's connection
+        # along with the Checkout
+        connection = _unwrap(connection)
+        with self._lock:
+            checkout = self.checkouts.pop(id(connection), None)
+        if checkout is None:
+            raise ValueError("Connection was not acquired from this pool or was already released.")
+        if checkout.connection is not connection:
+            checkout.connection.finish()
+        if checkout.cursor is not None:
+            try:
+                checkout.cursor.close()
+            except self.driver.Error:
+                pass
+        return connection, checkout
+
+    def check_leaks(self):
+        """Returns the Checkouts held longer than leak_timeout, logging a warning with where each
+        was acquired the first time it is found."""
+        if self.leak_timeout is None:
+            return []
+        now = perf_counter()
+        with self._lock:
+            leaks = [checkout for checkout in self.checkouts.values()
+                     if now - checkout.acquired > self.leak_timeout]
+        for checkout in leaks:
+            if not checkout.reported:
+                checkout.reported = True
+                self.stats.record_leak()
+                LOGGER.warning("Connection to %s held for %.1fs, acquired at:\n%s",
+                               self.pool.tnsentry, now - checkout.acquired,
+                               ''.join(traceback.format_list(checkout.stack)))
+        return leaks
+
+    def statistics(self):
+        """Returns a dictionary of the pool's live busy and open counts along with its PoolStats."""
+        statistics = {'db': self.pool.tnsentry, 'busy': self.pool.busy, 'open': self.pool.opened,
+                      'max': self.pool.max, 'held': len(self.checkouts)}
+        statistics.update(self.stats.as_dict())
+        if self.gate is not None:
+            statistics.update(self.gate.as_dict())
+        return statistics
+
+
+class Checkout:
+    """This class represents a connection that has been acquired from a pool.
+
+    Attributes:
+        connection: the connection that was handed out, an InstrumentedConnection when the pool
+            had hooks
+        acquired: time.perf_counter() when the connection was acquired
+        stack: traceback.StackSummary of where it was acquired, None unless leak_timeout is set
+        thread: name of the thread that acquired it
+        reported: True once the connection has been logged as a leak
+        cursor: the cursor LODBPool.cursor() reuses for the connection, None until it is asked for
+        credentials: dictionary of the user and password kwargs it was acquired with
+    """
+    __slots__ = ('connection', 'acquired', 'stack', 'thread', 'reported', 'cursor', 'credentials')
+
+    def __init__(self, connection, stack=None, credentials=None):
+        self.connection = connection
+        self.acquired = perf_counter()
+        self.stack = stack
+        self.thread = threading.current_thread().name
+        self.reported = False
+        self.cursor = None
+        self.credentials = credentials or {}
+
+
+class PoolStats:
+    """Thread safe counters for a pool.
+
+    Attributes:
+        acquires: number of connections acquired
+        releases: number of connections released back to the pool
+        drops: number of connections dropped from the pool
+        failures: number of acquires that raised
+        timeouts: number of acquires that failed because no connection was free in time
+        leaks: number of connections reported as held longer than the pool's leak_timeout
+        replacements: number of sessions opened in the background in place of dropped ones
+        wait_histogram: list of acquire counts per WAIT_BUCKETS bucket plus one for longer waits
+        wait_total: total seconds spent waiting for connections
+        wait_max: longest wait in seconds
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.acquires = 0
+        self.releases = 0
+        self.drops = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.leaks = 0
+        self.replacements = 0
+        self.wait_histogram = [0] * (len(WAIT_BUCKETS) + 1)
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _record_wait(self, seconds):
+        self.wait_histogram[_bucket(seconds)] += 1
+        self.wait_total += seconds
+        self.wait_max = max(self.wait_max, seconds)
+
+    def record_acquire(self, seconds):
+        with self._lock:
+            self.acquires += 1
+            self._record_wait(seconds)
+
+    def record_failure(self, seconds, timed_out):
+        with self._lock:
+            self.failures += 1
+            if timed_out:
+                self.timeouts += 1
+                self._record_wait(seconds)
+
+    def record_release(self, dropped=False):
+        with self._lock:
+            if dropped:
+                self.drops += 1
+            else:
+                self.releases += 1
+
+    def record_leak(self):
+        with self._lock:
+            self.leaks += 1
+
+    def record_replacement(self):
+        with self._lock:
+            self.replacements += 1
+
+    def as_dict(self):
+        """Returns a consistent copy of the counters as a dictionary, wait_histogram is keyed by
+        each bucket's upper bound in milliseconds."""
+        with self._lock:
+            waits = self.acquires + self.timeouts
+            return {'acquires': self.acquires, 'releases': self.releases, 'drops': self.drops,
+                    'failures': self.failures, 'timeouts': self.timeouts, 'leaks': self.leaks,
+                    'replacements': self.replacements,
+                    'wait_histogram': _histogram(self.wait_histogram),
+                    'wait_mean': self.wait_total / waits if waits else 0.0,
+                    'wait_max': self.wait_max}
+
+
+class FairGate:
+    """Caps how many connections a fair pool hands out at once, queueing the acquires that have to
+    wait.
+
+    Waiting acquires are served by priority class, then in the order they arrived. A connection
+    given back goes straight to the first waiter, so an acquire arriving later cannot take it
+    first, and an acquire that times out leaves the queue.
+
+    Attributes:
+        limit: how many connections can be in use at once
+        in_use: how many connections are in use
+        waiting: how many acquires are queued
+    """
+
+    def __init__(self, limit):
+        self._condition = threading.Condition()
+        self.limit = limit
+        self.in_use = 0
+        self._waiters = list()  # heap of _Waiters
+        self._arrivals = count()
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    def enter(self, timeout=None, priority=PRIORITY_NORMAL):
+        """Waits until a connection can be taken and raises TimeoutError if none could be taken
+        within timeout seconds, waiting as long as it takes when timeout is None."""
+        start = perf_counter()
+        with self._condition:
+            self._arrive(start)
+            if self.in_use < self.limit and not self._waiters:
+                self._take()
+                return
+            waiter = _Waiter(priority, next(self._arrivals), self._condition)
+            heapq.heappush(self._waiters, waiter)
+            try:
+                while not waiter.granted:
+                    now = perf_counter()
+                    waited = now - start
+                    if timeout is not None and waited >= timeout:
+                        raise TimeoutError("No connection became free within {}s".format(timeout))
+                    wait = self._wait(now, waited)
+                    if timeout is not None:
+                        wait = timeout - waited if wait is None else min(wait, timeout - waited)
+                    if not waiter.granted:
+                        waiter.condition.wait(wait)
+            except BaseException:
+                if waiter.granted:
+                    # Granted while being interrupted, pass the connection on
+                    self.in_use -= 1
+                    self._grant()
+                else:
+                    self._waiters.remove(waiter)
+                    heapq.heapify(self._waiters)
+                raise
+
+    def exit(self):
+        """Gives back a connection taken with enter()."""
+        with self._condition:
+            self.in_use -= 1
+            self._leave(perf_counter())
+            self._grant()
+
+    def _grant(self):
+        # Called holding the condition, hands every connection that is free to the first waiters
+        while self._waiters and self.in_use < self.limit:
+            waiter = heapq.heappop(self._waiters)
+            waiter.granted = True
+            self._take()
+            waiter.condition.notify()
+
+    def _take(self):
+        # Called holding the condition
+        self.in_use += 1
+
+    def _arrive(self, now):
+        # Called holding the condition when an acquire arrives
+        pass
+
+    def _leave(self, now):
+        # Called holding the condition when a connection is given back
+        pass
+
+    def _wait(self, now, waited):
+        # Called holding the condition, returns the most seconds to wait before checking again,
+        # None to wait until granted
+        return None
+
+    def as_dict(self):
+        """Returns the limit along with how many connections are in use and acquires waiting."""
+        with self._condition:
+            return {'limit': self.limit, 'in_use': self.in_use, 'waiting': len(self._waiters)}
+
+
+class _Waiter:
+    # An acquire queued on a FairGate, ordered by priority class then arrival
+    __slots__ = ('priority', 'arrival', 'condition', 'granted')
+
+    def __init__(self, priority, arrival, lock):
+        self.priority = priority
+        self.arrival = arrival
+        self.condition = threading.Condition(lock)
+        self.granted = False
+
+    def __lt__(self, other):
+        return (self.priority, self.arrival) < (other.priority, other.arrival)
+
+
+class AdaptiveLimit(FairGate):
+    """Caps how many connections an adaptive pool hands out at once, queueing waiting acquires as
+    FairGate does.
+
+    The cap starts at floor. Whenever an acquire has waited grow_wait seconds with every allowed
+    connection in use the cap grows by one, at most once per grow_wait, up to ceiling. Once the
+    pool has gone idle_timeout seconds without every allowed connection in use the cap shrinks by
+    one for each idle_timeout that passed, down to floor. Each change is logged and kept in
+    decisions.
+
+    Attributes:
+        limit: how many connections can currently be in use at once
+        floor: smallest limit, the pool's max kwarg
+        ceiling: largest limit
+        grow_wait: seconds an acquire waits before the limit grows
+        idle_timeout: seconds without the limit being reached before it shrinks
+        in_use: how many connections are in use
+        grows: number of times the limit grew
+        shrinks: number of times the limit shrank
+        decisions: deque of the most recent changes as dictionaries
+    """
+
+    def __init__(self, floor, ceiling, grow_wait=0.05, idle_timeout=60, history=100):
+        if ceiling < floor:
+            raise ValueError("The ceiling {} cannot be below max {}".format(ceiling, floor))
+        super().__init__(floor)
+        self.floor = floor
+        self.ceiling = ceiling
+        self.grow_wait = grow_wait
+        self.idle_timeout = idle_timeout
+        self.grows = 0
+        self.shrinks = 0
+        self.decisions = deque(maxlen=history)
+        self._last_full = perf_counter()
+        self._last_grow = 0.0
+
+    def _take(self):
+        self.in_use += 1
+        if self.in_use >= self.limit:
+            self._last_full = perf_counter()
+
+    def _arrive(self, now):
+        self._shrink(now)
+
+    def _leave(self, now):
+        self._shrink(now)
+
+    def _wait(self, now, waited):
+        if (waited >= self.grow_wait and self.limit < self.ceiling
+                and now - self._last_grow >= self.grow_wait):
+            self._last_grow = now
+            self._change(self.limit + 1, 'grow', waited)
+            self._grant()
+        return self.grow_wait - waited if waited < self.grow_wait else self.grow_wait
+
+    def _shrink(self, now):
+        # Called holding the condition
+        idle = now - self._last_full
+        if self.limit > self.floor and idle >= self.idle_timeout:
+            steps = int(idle // self.idle_timeout)
+            self._change(max(self.floor, self.in_use, self.limit - steps), 'shrink', 0.0)
+            self._last_full = now
+
+    def _change(self, limit, action, waited):
+        # Called holding the condition
+        if limit == self.limit:
+            return
+        if action == 'grow':
+            self.grows += 1
+        else:
+            self.shrinks += 1
+        self.decisions.append({'time': time.time(), 'action': action, 'from': self.limit,
+                               'to': limit, 'in_use': self.in_use, 'waited': waited})
+        LOGGER.info("Pool limit %s from %d to %d with %d in use", action, self.limit, limit,
+                    self.in_use)
+        self.limit = limit
+
+    def as_dict(self):
+        """Returns the limit, its bounds and its recent decisions as a dictionary."""
+        with self._condition:
+            return {'limit': self.limit, 'floor': self.floor, 'ceiling': self.ceiling,
+                    'in_use': self.in_use, 'waiting': len(self._waiters), 'grows': self.grows,
+                    'shrinks': self.shrinks, 'decisions': list(self.decisions)}
+
+
+class QueryEvent:
+    """This class represents a statement run on a connection from a pool, every hook of the pool
+    is called with one.
+
+    Attributes:
+        statement: the SQL statement
+        db: db of the pool the connection came from
+        site: short name of the site whose schema the statement ran in, None for a ConvioPool
+        wait: seconds the acquire of the connection the statement ran on waited
+        seconds: seconds spent running the statement and fetching its rows
+        rows: number of rows a query fetched or DML changed
+        error: the exception the statement raised, None if it succeeded
+        started: time.time() when the statement started
+    """
+    __slots__ = ('statement', 'db', 'site', 'wait', 'seconds', 'rows', 'error', 'started')
+
+    def __init__(self, statement, db, site=None, wait=0.0):
+        self.statement = statement
+        self.db = db
+        self.site = site
+        self.wait = wait
+        self.seconds = 0.0
+        self.rows = 0
+        self.error = None
+        self.started = time.time()
+
+    def __repr__(self):
+        return 'QueryEvent({!r}, db={!r}, site={!r}, seconds={:.6f}, rows={})'.format(
+            self.statement, self.db, self.site, self.seconds, self.rows)
+
+    def as_dict(self):
+        return {'statement': self.statement, 'db': self.db, 'site': self.site, 'wait': self.wait,
+                'seconds': self.seconds, 'rows': self.rows,
+                'error': None if self.error is None else str(self.error), 'started': self.started}
+
+
+class InstrumentedConnection:
+    """Wraps a connection acquired from a pool with hooks so the statements run on it are reported
+    to them. Everything other than cursor() is passed through to the driver's connection.
+
+    Attributes:
+        pool: the LODBPool the connection came from
+        connection: the driver's connection
+        site: the Site whose schema the connection is logged in to, None for a ConvioPool
+        wait: seconds acquiring the connection waited
+    """
+    __slots__ = ('pool', 'connection', 'site', 'wait', '_cursors')
+
+    def __init__(self, pool, connection, site=None, wait=0.0):
+        self.pool = pool
+        self.connection = connection
+        self.site = site
+        self.wait = wait
+        self._cursors = list()
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def cursor(self):
+        cursor = InstrumentedCursor(self, self.connection.cursor())
+        self._cursors.append(cursor)
+        return cursor
+
+    def event(self, statement):
+        """Returns a QueryEvent for statement tagged with the connection's db and site."""
+        return QueryEvent(statement, self.pool.pool.tnsentry,
+                          None if self.site is None else self.site.short, self.wait)
+
+    def finish(self):
+        """Reports the queries of every cursor whose rows were not all fetched, called when the
+        connection goes back to the pool."""
+        cursors, self._cursors = self._cursors, list()
+        for cursor in cursors:
+            cursor.finish()
+
+
+class InstrumentedCursor:
+    """Wraps a cursor of an InstrumentedConnection, timing each statement and counting its rows.
+
+    DML is reported as soon as it runs. A query is reported once fetching runs out of rows or
+    fails, another statement is run on the cursor, or the cursor or its connection is closed, so
+    its seconds include fetching the rows.
+    """
+    __slots__ = ('_connection', '_cursor', '_event')
+
+    def __init__(self, connection, cursor):
+        object.__setattr__(self, '_connection', connection)
+        object.__setattr__(self, '_cursor', cursor)
+        object.__setattr__(self, '_event', None)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __setattr__(self, name, value):
+        # arraysize, prefetchrows and the like belong to the driver's cursor
+        setattr(self._cursor, name, value)
+
+    def __iter__(self):
+        while True:
+            batch = self.fetchmany()
+            if not batch:
+                return
+            yield from batch
+
+    def _run(self, statement, fn, *args, **kwargs):
+        # Runs fn, the driver's execute or executemany, and returns its result with the event
+        self.finish()
+        event = self._connection.event(statement)
+        start = perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as error:
+            event.seconds = perf_counter() - start
+            event.error = error
+            self._connection.pool._emit(event)
+            raise
+        event.seconds = perf_counter() - start
+        return result, event
+
+    def execute(self, statement, parameters=None, **kwargs):
+        args = (statement,) if parameters is None else (statement, parameters)
+        result, event = self._run(statement, self._cursor.execute, *args, **kwargs)
+        if self._cursor.description is None:
+            event.rows = self._cursor.rowcount
+            self._connection.pool._emit(event)
+            return result
+        object.__setattr__(self, '_event', event)
+        return self
+
+    def executemany(self, statement, parameters, **kwargs):
+        result, event = self._run(statement, self._cursor.executemany, statement, parameters,
+                                  **kwargs)
+        event.rows = self._cursor.rowcount
+        self._connection.pool._emit(event)
+        return result
+
+    def _fetch(self, fn, *args):
+        # Calls the driver's fetch method fn, adding its time to the pending query's event
+        start = perf_counter()
+        try:
+            return fn(*args)
+        except Exception as error:
+            if self._event is not None:
+                self._event.error = error
+            self.finish()
+            raise
+        finally:
+            if self._event is not None:
+                self._event.seconds += perf_counter() - start
+
+    def _fetched(self, rows, done):
+        if self._event is not None:
+            self._event.rows += rows
+            if done:
+                self.finish()
+
+    def fetchone(self):
+        row = self._fetch(self._cursor.fetchone)
+        self._fetched(row is not None, row is None)
+        return row
+
+    def fetchmany(self, size=None):
+        batch = self._fetch(self._cursor.fetchmany, *(() if size is None else (size,)))
+        self._fetched(len(batch), not batch)
+        return batch
+
+    def fetchall(self):
+        rows = self._fetch(self._cursor.fetchall)
+        self._fetched(len(rows), True)
+        return rows
+
+    def finish(self):
+        """Reports the pending query, if there is one."""
+        event = self._event
+        if event is not None:
+            object.__setattr__(self, '_event', None)
+            self._connection.pool._emit(event)
+
+    def close(self):
+        self.finish()
+        self._cursor.close()
+
+
+class StatementStats:
+    """Counters for one statement kept by QueryMetrics.
+
+    Attributes:
+        count: number of times the statement ran
+        errors: number of times it raised
+        rows: total rows fetched or changed
+        seconds_total: total seconds spent running it
+        seconds_max: longest it took in seconds
+        histogram: list of run counts per WAIT_BUCKETS bucket plus one for longer runs
+        wait_histogram: list of run counts per WAIT_BUCKETS bucket of the acquire wait
+        dbs: dictionary of db to the number of times it ran there
+    """
+    __slots__ = ('count', 'errors', 'rows', 'seconds_total', 'seconds_max', 'histogram',
+                 'wait_histogram', 'dbs')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.rows = 0
+        self.seconds_total = 0.0
+        self.seconds_max = 0.0
+        self.histogram = [0] * (len(WAIT_BUCKETS) + 1)
+        self.wait_histogram = [0] * (len(WAIT_BUCKETS) + 1)
+        self.dbs = {}
+
+    def record(self, event):
+        self.count += 1
+        if event.error is not None:
+            self.errors += 1
+        self.rows += event.rows
+        self.seconds_total += event.seconds
+        self.seconds_max = max(self.seconds_max, event.seconds)
+        self.histogram[_bucket(event.seconds)] += 1
+        self.wait_histogram[_bucket(event.wait)] += 1
+        self.dbs[event.db] = self.dbs.get(event.db, 0) + 1
+
+    def as_dict(self):
+        return {'count': self.count, 'errors': self.errors, 'rows': self.rows,
+                'seconds_total': self.seconds_total,
+                'seconds_mean': self.seconds_total / self.count if self.count else 0.0,
+                'seconds_max': self.seconds_max, 'histogram': _histogram(self.histogram),
+                'wait_histogram': _histogram(self.wait_histogram), 'dbs': dict(self.dbs)}
+
+
+class QueryMetrics:
+    """Hook for LODBPool.add_hook() or PoolManager.add_hook() keeping per statement latency
+    histograms and a log of slow queries. Slow queries are also logged as warnings.
+
+    Example:
+        metrics = QueryMetrics(slow_seconds=0.5)
+        manager.add_hook(metrics)
+        ...
+        print(json.dumps(metrics.as_dict(), indent=2))
+
+    Attributes:
+        slow_seconds: statements that take at least this many seconds are slow queries
+        slow_queries: deque of the most recent slow_log slow QueryEvents
+        statements: dictionary of statement to its StatementStats
+    """
+    # Distinct statements kept before the rest are counted together under OTHER_STATEMENTS, so
+    # statements with literals in them cannot grow the dictionary without bound
+    MAX_STATEMENTS = 1000
+    OTHER_STATEMENTS = '<other>'
+
+    def __init__(self, slow_seconds=SLOW_QUERY_SECONDS, slow_log=100):
+        self.slow_seconds = slow_seconds
+        self.slow_queries = deque(maxlen=slow_log)
+        self.statements = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        slow = event.seconds >= self.slow_seconds
+        with self._lock:
+            stats = self.statements.get(event.statement)
+            if stats is None:
+                key = event.statement
+                if len(self.statements) >= self.MAX_STATEMENTS:
+                    key = self.OTHER_STATEMENTS
+                stats = self.statements.setdefault(key, StatementStats())
+            stats.record(event)
+            if slow:
+                self.slow_queries.append(event)
+        if slow:
+            LOGGER.warning("Slow query on %s%s took %.3fs for %d rows: %s", event.db,
+                           '' if event.site is None else ' for ' + event.site, event.seconds,
+                           event.rows, event.statement)
+
+    def as_dict(self):
+        """Returns a copy of every statement's StatementStats as a dictionary, along with the
+        slow query log, that can be written out as JSON."""
+        with self._lock:
+            return {'statements': {statement: stats.as_dict()
+                                   for statement, stats in self.statements.items()},
+                    'slow_queries': [event.as_dict() for event in self.slow_queries]}
+
 
 class ConvioPool(LODBPool):
     def __init__(self, **kwargs):
         super().__init__(type='convio', **kwargs)
 
-    def get_connection(self):
-        return self.pool.acquire()
+    def get_connection(self, priority=PRIORITY_NORMAL, timeout=None):
+        return self.acquire(priority=priority, timeout=timeout)
 
-    def close_connection(self):
-        pass
+    def connection(self, priority=PRIORITY_NORMAL, timeout=None):
+        """Context manager for a connection that is released when the with block ends, see
+        acquire() for priority and timeout.
+
+        Example:
+            with pool.connection(priority=PRIORITY_INTERACTIVE, timeout=0.5) as connection:
+                cursor = connection.cursor()
+        """
+        return self._checked_out(self.get_connection(priority, timeout))
 
 
 class SitePool(LODBPool):
     def __init__(self, **kwargs):
         super().__init__(type='site', **kwargs)
-        self.connection_list = list()
 
-    def get_connection(self, site):
+    def get_connection(self, site, priority=PRIORITY_NORMAL, timeout=None):
         if site.site_db == self.pool.tnsentry:
-            return self.pool.acquire(user=site.short, password=site.short)
+            return self.acquire(site=site, priority=priority, timeout=timeout, user=site.short,
+                                password=site.short)
         else:
             raise ValueError("Site {} is not on {}.".format(site.short, self.pool.tnsentry))
 
-    def close_connection(self):
-        pass
+    def connection(self, site, priority=PRIORITY_NORMAL, timeout=None):
+        """Context manager for a connection to site's schema that is released when the with block
+        ends, see acquire() for priority and timeout."""
+        return self._checked_out(self.get_connection(site, priority, timeout))
+
+
+class PoolManager:
+    """Routes site connections to a SitePool for the site's DB, creating each SitePool on first use.
+
+    kwargs:
+        prod_file: pathlike or filelike object to pass on to Cluster
+        db_file: pathlike or filelike object to pass on to Cluster
+        cluster: Cluster to use instead of one from prod_file and db_file
+        min: minimum size of each pool
+        max: maximum size of each pool
+        timeout: seconds each pool waits for a free connection, see LODBPool
+        leak_timeout: seconds a connection can be held before it is logged as a leak
+        adaptive, grow_wait, idle_timeout, driver, stmtcachesize, fair, ping_interval: passed to
+            every pool, see LODBPool
+        ceiling: largest max for every pool, see LODBPool
+        ceilings: dictionary of db to the ceiling for that db's pool, overriding ceiling
+        hooks: list of functions called with a QueryEvent for every statement, shared by every pool
+
+    Attributes:
+        cluster: the Cluster shared by every pool
+        pools: dictionary of db to the SitePool created for it
+        hooks: the list of hooks shared by every pool, see add_hook()
+    """
+
+    def __init__(self, **kwargs):
+        self.cluster = _get_cluster(kwargs)
+        self.pools = {}
+        self.hooks = kwargs.get('hooks', [])
+        self._pool_kwargs = {k: v for k, v in kwargs.items() if k in POOL_KWARGS}
+        self._pool_kwargs['hooks'] = self.hooks
+        self._ceilings = kwargs.get('ceilings', {})
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def pool(self, db):
+        """Returns the SitePool for db, creating it if this is the first request for db."""
+        pool = self.pools.get(db)
+        if pool is None:
+            with self._lock:
+                if self._closed:
+                    raise ValueError("PoolManager has been closed.")
+                pool = self.pools.get(db)
+                if pool is None:
+                    pool_kwargs = dict(self._pool_kwargs)
+                    if db in self._ceilings:
+                        pool_kwargs['ceiling'] = self._ceilings[db]
+                    pool = SitePool(db=db, cluster=self.cluster, **pool_kwargs)
+                    self.pools[db] = pool
+        return pool
+
+    def add_hook(self, hook):
+        """Calls hook with a QueryEvent for every statement run on any pool's connections, see
+        LODBPool.add_hook()."""
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def get_connection(self, site, priority=PRIORITY_NORMAL, timeout=None):
+        """Returns a connection to site's schema from the pool for site.site_db, see
+        LODBPool.acquire() for priority and timeout."""
+        if site.site_db not in self.cluster.db_set:
+            raise ValueError("Site {} is on {} which is not in {}.".format(
+                site.short, site.site_db, self.cluster.db_list))
+        return self.pool(site.site_db).get_connection(site, priority, timeout)
+
+    def connection(self, site, priority=PRIORITY_NORMAL, timeout=None):
+        """Context manager for a connection to site's schema that is released when the with block
+        ends."""
+        connection = self.get_connection(site, priority, timeout)
+        return self.pools[site.site_db]._checked_out(connection)
+
+    def close_connection(self, connection, drop=False):
+        """Releases connection back to the pool it came from, or drops it when drop is True."""
+        for pool in list(self.pools.values()):
+            if id(_unwrap(connection)) in pool.checkouts:
+                pool.close_connection(connection, drop=drop)
+                return
+        raise ValueError("Connection was not acquired from this PoolManager or was already "
+                         "released.")
+
+    def check_leaks(self):
+        """Returns the Checkouts held too long across every pool, see LODBPool.check_leaks()."""
+        return [leak for pool in list(self.pools.values()) for leak in pool.check_leaks()]
+
+    def statistics(self):
+        """Returns a dictionary of db to LODBPool.statistics() for every pool created."""
+        return {db: pool.statistics() for db, pool in list(self.pools.items())}
+
+    def close(self, force=False):
+        """Closes every pool that was created. Pools are all closed even if some fail, then the
+        first failure is raised."""
+        with self._lock:
+            self._closed = True
+            pools, self.pools = self.pools, {}
+        first_error = None
+        for pool in pools.values():
+            try:
+                pool.close(force=force)
+            except pool.driver.Error as error:
+                if first_error is None:
+                    first_error = error
+        if first_error is not None:
+            raise first_error
+
+
+class FanOutQuery:
+    """Runs statement against the schema of every site in sites, a SiteList or SiteListView, and
+    yields (site, row) tuples as the rows arrive.
+
+    Sites run through SiteList.run() so at most per_db_limit run at once on each site_db, by
+    default as many as each DB's pool can hand out. Rows reach the caller in fetchmany batches of
+    arraysize through a queue of at most queue_size batches, so a slow caller holds the queries
+    back rather than buffering every row. A site that fails is recorded in failures and the rest
+    carry on. Leaving the loop early stops the queries still running. Connections are acquired
+    as PRIORITY_BATCH so fair pools serve interactive work first.
+
+    parameters is passed to cursor.execute() with statement, or when it is callable it is called
+    with each site to get that site's parameters e.g. lambda site: {'site_id': site.site_id}.
+    Without a manager one is created from pool_kwargs and closed once the query finishes.
+
+    Attributes:
+        results: list of a SiteResult for every site that finished, whose value is the number of
+            rows it returned and whose seconds is how long it took
+        failures: list of the SiteResults whose query raised
+    """
+
+    def __init__(self, sites, statement, parameters=None, manager=None, per_db_limit=None,
+                 workers=None, arraysize=100, queue_size=64, **pool_kwargs):
+        self.sites = sites
+        self.statement = statement
+        self.parameters = parameters
+        self.manager = manager
+        self.pool_kwargs = pool_kwargs
+        self.per_db_limit = per_db_limit
+        self.workers = workers
+        self.arraysize = arraysize
+        self.queue_size = queue_size
+        self.results = list()
+        self.failures = list()
+
+    def __iter__(self):
+        manager = self.manager
+        if manager is None:
+            manager = PoolManager(**self.pool_kwargs)
+        per_db_limit = self.per_db_limit or _pool_size(manager)
+        workers = self.workers or per_db_limit * max(1, len(self.sites.counts('site_db')))
+        batches = queue.Queue(maxsize=self.queue_size)
+        stopped = threading.Event()
+
+        def put(item):
+            # Gives up once the caller has stopped reading
+            while not stopped.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def query_site(site):
+            if stopped.is_set():
+                raise RuntimeError("ERROR: FanOutQuery stopped before {} ran".format(site.short))
+            parameters = self.parameters(site) if callable(self.parameters) else self.parameters
+            rows = 0
+            with manager.connection(site, PRIORITY_BATCH) as connection:
+                cursor = manager.pools[site.site_db].cursor(connection)
+                cursor.arraysize = self.arraysize
+                if parameters is None:
+                    cursor.execute(self.statement)
+                else:
+                    cursor.execute(self.statement, parameters)
+                while not stopped.is_set():
+                    batch = cursor.fetchmany()
+                    if not batch:
+                        break
+                    rows += len(batch)
+                    put((site, batch))
+            return rows
+
+        def run():
+            try:
+                for result in self.sites.run(query_site, workers=workers,
+                                             per_db_limit=per_db_limit):
+                    put(result)
+            finally:
+                put(None)
+
+        runner = threading.Thread(target=run, name='FanOutQuery', daemon=True)
+        runner.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is None:
+                    break
+                if isinstance(item, tuple):
+                    site, batch = item
+                    for row in batch:
+                        yield site, row
+                else:
+                    self.results.append(item)
+                    if item.error is not None:
+                        self.failures.append(item)
+        finally:
+            stopped.set()
+            runner.join()
+            if self.manager is None:
+                manager.close()
+
+    def timings(self):
+        """Returns a dictionary of site_db to the number of sites, rows, failures and the total
+        seconds spent on its sites."""
+        timings = {}
+        for result in self.results:
+            db = timings.setdefault(result.site.site_db,
+                                    {'sites': 0, 'rows': 0, 'failures': 0, 'seconds': 0.0})
+            db['sites'] += 1
+            db['seconds'] += result.seconds
+            if result.error is None:
+                db['rows'] += result.value
+            else:
+                db['failures'] += 1
+        return timings
+
+
+class BatchError:
+    """This class represents a parameter set that failed within an executemany batch.
+
+    Attributes:
+        site: the Site whose schema the row was written to
+        parameters: the parameter set that failed
+        code: the ORA error number
+        message: the error message
+    """
+    __slots__ = ('site', 'parameters', 'code', 'message')
+
+    def __init__(self, site, parameters, code, message):
+        self.site = site
+        self.parameters = parameters
+        self.code = code
+        self.message = message
+
+    def __repr__(self):
+        return 'BatchError({}, {!r}, {})'.format(self.site.short, self.parameters, self.message)
+
+
+class BulkWriter:
+    """Writes parameter sets for a DML statement to site schemas with executemany.
+
+    Rows given to add() are buffered per site. Once a site has batch_size * commit_interval rows
+    they are written on a background thread with one connection from the site's pool: an
+    executemany per batch_size rows, then a single commit. A site's jobs are written one after
+    another in the order their rows were added. flush() writes whatever is left. At most
+    per_db_limit sites on a DB write at once, by default as many as each pool can hand out, and
+    add() blocks while a few jobs per writer thread are already waiting.
+
+    Parameter sets that fail are reported by the driver's batch errors and kept in errors while the
+    rest of their batch is still written. If anything else fails, such as the connection, that
+    site's uncommitted rows are rolled back and the failure kept in failures. Connections are
+    acquired as PRIORITY_BATCH.
+
+    Attributes:
+        manager: the PoolManager whose SitePools are written through
+        statement: the DML statement run for each parameter set
+        batch_size: parameter sets per executemany
+        commit_interval: executemany batches per commit
+        errors: list of a BatchError for every parameter set that failed
+        failures: list of (site, error, rows) tuples for jobs whose rows were rolled back
+        written: dictionary of site_id to the number of rows committed
+    """
+
+    def __init__(self, manager, statement, batch_size=1000, commit_interval=1, per_db_limit=None):
+        if batch_size < 1 or commit_interval < 1:
+            raise ValueError("The batch_size and commit_interval must be at least 1")
+        self.manager = manager
+        self.statement = statement
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self.per_db_limit = per_db_limit or _pool_size(manager)
+        self.errors = list()
+        self.failures = list()
+        self.written = {}
+        self._buffers = {}  # site_id to (Site, list of parameter sets)
+        self._queued = {}  # site_id to deque of the rows of jobs waiting for the site's running job
+        self._lock = threading.Lock()
+        self._db_slots = {}  # site_db to BoundedSemaphore of per_db_limit
+        workers = self.per_db_limit * max(1, len(manager.cluster.db_list))
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='BulkWriter')
+        self._pending = threading.BoundedSemaphore(workers * 2)
+        self._futures = set()
+        self._start = perf_counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add(self, site, parameters):
+        """Buffers a parameter set to be written to site's schema."""
+        entry = self._buffers.get(site.site_id)
+        if entry is None:
+            entry = self._buffers[site.site_id] = (site, list())
+        entry[1].append(parameters)
+        if len(entry[1]) >= self.batch_size * self.commit_interval:
+            del self._buffers[site.site_id]
+            self._submit(site, entry[1])
+
+    def write(self, rows):
+        """Buffers every (site, parameters) tuple of an iterable, see add()."""
+        for site, parameters in rows:
+            self.add(site, parameters)
+
+    def flush(self):
+        """Writes every buffered row and waits until all writes have finished."""
+        buffers, self._buffers = self._buffers, {}
+        for site, rows in buffers.values():
+            self._submit(site, rows)
+        with self._lock:
+            futures = list(self._futures)
+        wait(futures)
+
+    def close(self):
+        """Flushes and stops the writer threads."""
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown()
+
+    def _submit(self, site, rows):
+        # A job for a site that is already being written waits for the thread writing it, so a
+        #     later job never overtakes an earlier one on another connection
+        self._pending.acquire()
+        with self._lock:
+            queued = self._queued.get(site.site_id)
+            if queued is not None:
+                queued.append(rows)
+                return
+            self._queued[site.site_id] = deque()
+            future = self._executor.submit(self._write_jobs, site, rows)
+            self._futures.add(future)
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        with self._lock:
+            self._futures.discard(future)
+
+    def _write_jobs(self, site, rows):
+        # Runs on a writer thread, writing site's jobs until none are waiting
+        while True:
+            try:
+                self._write_site(site, rows)
+            finally:
+                self._pending.release()
+            with self._lock:
+                queued = self._queued[site.site_id]
+                if not queued:
+                    del self._queued[site.site_id]
+                    return
+                rows = queued.popleft()
+
+    def _write_site(self, site, rows):
+        # Runs on a writer thread, one connection and one commit for up to commit_interval batches
+        with self._lock:
+            slot = self._db_slots.get(site.site_db)
+            if slot is None:
+                slot = self._db_slots[site.site_db] = threading.BoundedSemaphore(
+                    self.per_db_limit)
+        errors = list()
+        with slot:
+            try:
+                with self.manager.connection(site, PRIORITY_BATCH) as connection:
+                    cursor = self.manager.pools[site.site_db].cursor(connection)
+                    try:
+                        for offset in range(0, len(rows), self.batch_size):
+                            batch = rows[offset:offset + self.batch_size]
+                            cursor.executemany(self.statement, batch, batcherrors=True)
+                            errors.extend(BatchError(site, batch[error.offset], error.code,
+                                                     error.message)
+                                          for error in cursor.getbatcherrors())
+                        connection.commit()
+                    except BaseException:
+                        try:
+                            connection.rollback()
+                        except Exception:
+                            # A broken connection cannot roll back, report the original error
+                            pass
+                        raise
+            except Exception as error:
+                with self._lock:
+                    self.failures.append((site, error, len(rows)))
+                return
+        with self._lock:
+            self.errors.extend(errors)
+            self.written[site.site_id] = (self.written.get(site.site_id, 0)
+                                          + len(rows) - len(errors))
+
+    def statistics(self):
+        """Returns a dictionary of the sites and rows written, batch errors, failed jobs and rows
+        per second so far."""
+        with self._lock:
+            rows = sum(self.written.values())
+            seconds = perf_counter() - self._start
+            return {'sites': len(self.written), 'rows': rows, 'errors': len(self.errors),
+                    'failures': len(self.failures), 'seconds': seconds,
+                    'rows_per_second': rows / seconds if seconds else 0.0}
+
+
+class SiteUrlLookup:
+    """In memory index of the site_url table in the convio schema for resolving URLs to site_ids.
+
+    lookup(url) returns the site_id of the longest site_url prefix that url starts with. The
+    index is a dictionary of prefix to site_id probed once per distinct prefix length, longest
+    first, so a lookup costs a few dictionary gets. URLs the index has no prefix for are looked up
+    in the database, acquiring as PRIORITY_INTERACTIVE, and remembered, found or not, until the
+    next refresh.
+
+    Once ttl seconds have passed since the last refresh the next lookup starts a refresh in a
+    background thread while it and later lookups carry on with the current index. A refresh reads
+    site_url again and applies only the prefixes that were added, removed or changed.
+
+    Attributes:
+        pool: the ConvioPool used to read site_url
+        ttl: seconds between refreshes
+        prefixes: dictionary of site_url prefix to site_id
+    """
+    # Most URLs remembered as having no site_url prefix between refreshes
+    MAX_MISSING = 100000
+
+    def __init__(self, pool, ttl=300):
+        self.pool = pool
+        self.ttl = ttl
+        self.prefixes = {}
+        self._lengths = ()
+        self._missing = set()
+        self._expires = 0.0
+        self._refreshed = None
+        self._refresh_lock = threading.Lock()
+        self._refreshing = False
+        self._lock = threading.Lock()
+        self._counts = {'hits': 0, 'misses': 0, 'fallback_hits': 0, 'fallback_misses': 0,
+                        'refreshes': 0, 'refresh_failures': 0}
+        self._last_refresh = {'seconds': 0.0, 'added': 0, 'removed': 0, 'changed': 0}
+        self.refresh()
+
+    def _count(self, name):
+        with self._lock:
+            self._counts[name] += 1
+
+    def lookup(self, url):
+        """Returns the site_id for url's longest site_url prefix or None if no prefix matches."""
+        if monotonic() >= self._expires:
+            self._start_refresh()
+        prefixes = self.prefixes
+        for length in self._lengths:
+            if length <= len(url):
+                site_id = prefixes.get(url[:length])
+                if site_id is not None:
+                    self._count('hits')
+                    return site_id
+        self._count('misses')
+        return self._fallback(url)
+
+    def _fallback(self, url):
+        # Looks url up in the database, remembering the answer until the next refresh
+        if url in self._missing:
+            return None
+        with self.pool.connection(PRIORITY_INTERACTIVE) as connection:
+            cursor = self.pool.cursor(connection)
+            cursor.execute(SITE_URL_MATCH_STATEMENT, {'url': url})
+            row = cursor.fetchone()
+        if row is None:
+            self._count('fallback_misses')
+            if len(self._missing) >= self.MAX_MISSING:
+                self._missing = set()
+            self._missing.add(url)
+            return None
+        self._count('fallback_hits')
+        prefix, site_id = row
+        with self._refresh_lock:
+            self.prefixes[prefix] = site_id
+            if len(prefix) not in self._lengths:
+                self._lengths = tuple(sorted(self._lengths + (len(prefix),), reverse=True))
+        return site_id
+
+    def _start_refresh(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._background_refresh, name='SiteUrlLookup',
+                         daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except self.pool.driver.Error as error:
+            LOGGER.warning("Refreshing site_url from %s failed, keeping the current index: %s",
+                           self.pool.pool.tnsentry, error)
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def refresh(self):
+        """Reads site_url and applies the prefixes that were added, removed or changed since the
+        last refresh. On failure the current index is kept until the next ttl."""
+        # site_url is read without the lock so fallback hits are not held up by the whole
+        #     table streaming, only by the changes being applied
+        start = perf_counter()
+        latest = {}
+        try:
+            for batch in self.pool.stream(SITE_URL_STATEMENT):
+                latest.update(batch)
+        except self.pool.driver.Error:
+            self._count('refresh_failures')
+            self._expires = monotonic() + self.ttl
+            raise
+
+        with self._refresh_lock:
+            prefixes = self.prefixes
+            removed = [prefix for prefix in prefixes if prefix not in latest]
+            added = changed = 0
+            for prefix, site_id in latest.items():
+                current = prefixes.get(prefix)
+                if current != site_id:
+                    if current is None:
+                        added += 1
+                    else:
+                        changed += 1
+                    prefixes[prefix] = site_id
+            for prefix in removed:
+                del prefixes[prefix]
+            self._lengths = tuple(sorted({len(prefix) for prefix in prefixes}, reverse=True))
+            self._missing = set()
+            self._refreshed = monotonic()
+            self._expires = self._refreshed + self.ttl
+            with self._lock:
+                self._counts['refreshes'] += 1
+                self._last_refresh = {'seconds': perf_counter() - start, 'added': added,
+                                      'removed': len(removed), 'changed': changed}
+
+    def statistics(self):
+        """Returns a dictionary of the index size and age along with hit, miss, fallback and
+        refresh counts and what the last refresh changed."""
+        with self._lock:
+            statistics = dict(self._counts)
+            statistics['last_refresh'] = dict(self._last_refresh)
+        statistics['prefixes'] = len(self.prefixes)
+        statistics['age'] = monotonic() - self._refreshed if self._refreshed else None
+        return statistics
+
+
+class AsyncPool:
+    """asyncio counterpart of a ConvioPool, SitePool or PoolManager.
+
+    Blocking driver calls run on a ThreadPoolExecutor of workers threads, by default as many as
+    the wrapped pools can hand out connections. Every DB's pool has an asyncio.Semaphore sized to
+    its max so coroutines beyond that wait on the event loop instead of tying up threads.
+
+    Attributes:
+        pool: the wrapped ConvioPool, SitePool or PoolManager
+    """
+
+    def __init__(self, pool, workers=None):
+        self.pool = pool
+        if workers is None:
+            workers = _pool_size(pool)
+            if isinstance(pool, PoolManager):
+                workers *= len(pool.cluster.db_list)
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='AsyncPool')
+        self._semaphores = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor,
+                                                                partial(fn, *args))
+
+    async def _pool_for(self, site):
+        # Returns the LODBPool to acquire from, creating a PoolManager's pool off the event loop
+        if not isinstance(self.pool, PoolManager):
+            return self.pool
+        if site is None:
+            raise ValueError("A site is required to acquire a connection from a PoolManager.")
+        if site.site_db not in self.pool.cluster.db_set:
+            raise ValueError("Site {} is on {} which is not in {}.".format(
+                site.short, site.site_db, self.pool.cluster.db_list))
+        pool = self.pool.pools.get(site.site_db)
+        if pool is None:
+            pool = await self._run(self.pool.pool, site.site_db)
+        return pool
+
+    async def acquire(self, site=None):
+        """Returns an AsyncConnection, to site's schema when wrapping a SitePool or PoolManager.
+        Waits without blocking the event loop while the DB's pool is at its max."""
+        pool = await self._pool_for(site)
+        semaphore = self._semaphores.get(id(pool))
+        if semaphore is None:
+            semaphore = self._semaphores[id(pool)] = asyncio.Semaphore(pool.pool.max)
+
+        await semaphore.acquire()
+        args = () if site is None else (site,)
+        future = asyncio.get_running_loop().run_in_executor(
+            self._executor, partial(pool.get_connection, *args))
+        try:
+            connection = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # The executor thread still gets the connection, hand it straight back
+            future.add_done_callback(partial(_release_abandoned, pool, semaphore,
+                                             self._executor))
+            raise
+        except BaseException:
+            semaphore.release()
+            raise
+        return AsyncConnection(self, pool, connection, semaphore)
+
+    async def release(self, connection, drop=False):
+        """Releases an AsyncConnection back to its pool, or drops it when drop is True."""
+        try:
+            await self._run(connection.pool.close_connection, connection.connection, drop)
+        finally:
+            connection.semaphore.release()
+
+    @asynccontextmanager
+    async def connection(self, site=None):
+        """Async context manager for an AsyncConnection that is released when the async with
+        block ends, or dropped if a database error left it unusable."""
+        connection = await self.acquire(site)
+        try:
+            yield connection
+        except connection.pool.driver.DatabaseError:
+            usable = await self._run(connection.pool._is_usable, connection.connection)
+            await self.release(connection, drop=not usable)
+            raise
+        except BaseException:
+            await self.release(connection)
+            raise
+        else:
+            await self.release(connection)
+
+    async def close(self, force=False):
+        """Closes the wrapped pool or pools and shuts down the executor."""
+        try:
+            await self._run(self.pool.close, force)
+        finally:
+            self._executor.shutdown(wait=False)
+
+
+class AsyncConnection:
+    """A connection acquired through an AsyncPool whose blocking calls run on the AsyncPool's
+    executor.
+
+    Attributes:
+        pool: the LODBPool the connection came from
+        connection: the driver's connection
+    """
+
+    def __init__(self, async_pool, pool, connection, semaphore):
+        self.async_pool = async_pool
+        self.pool = pool
+        self.connection = connection
+        self.semaphore = semaphore
+
+    def _execute(self, statement, parameters, arraysize):
+        cursor = self.connection.cursor()
+        cursor.arraysize = arraysize
+        if parameters is None:
+            cursor.execute(statement)
+        else:
+            cursor.execute(statement, parameters)
+        return cursor
+
+    async def rows(self, statement, parameters=None, arraysize=100):
+        """Async generator of the rows statement returns, fetched arraysize rows at a time.
+
+        Example:
+            async for row in connection.rows("select prefix, site_id from site_url"):
+                print(row)
+        """
+        cursor = await self.async_pool._run(self._execute, statement, parameters, arraysize)
+        try:
+            while True:
+                batch = await self.async_pool._run(cursor.fetchmany)
+                if not batch:
+                    break
+                for row in batch:
+                    yield row
+        finally:
+            cursor.close()
+
+    async def fetchall(self, statement, parameters=None, arraysize=100):
+        """Returns a list of every row statement returns."""
+        cursor = await self.async_pool._run(self._execute, statement, parameters, arraysize)
+        try:
+            return await self.async_pool._run(cursor.fetchall)
+        finally:
+            cursor.close()
+
+    async def commit(self):
+        await self.async_pool._run(self.connection.commit)
+
+    async def rollback(self):
+        await self.async_pool._run(self.connection.rollback)
+
+
+def _batches(cursor):
+    # Yields fetchmany() batches until the cursor runs out of rows
+    while True:
+        batch = cursor.fetchmany()
+        if not batch:
+            return
+        yield batch
+
+
+def write_csv(batches, output, columns=None):
+    """Writes an iterable of row batches to output as CSV, with a header line of columns when
+    given, and returns the number of rows written."""
+    writer = csv.writer(output)
+    if columns is not None:
+        writer.writerow(columns)
+    rows = 0
+    for batch in batches:
+        writer.writerows(batch)
+        rows += len(batch)
+    return rows
+
+
+def write_jsonl(batches, output, columns):
+    """Writes an iterable of row batches to output as JSON lines, one object per row keyed by
+    columns, and returns the number of rows written. Values JSON cannot hold such as dates and
+    Decimals are written as strings."""
+    encode = json.JSONEncoder(default=str).encode
+    rows = 0
+    for batch in batches:
+        output.write(''.join([encode(dict(zip(columns, row))) + '\n' for row in batch]))
+        rows += len(batch)
+    return rows
+
+
+def _bucket(seconds):
+    # Index of the WAIT_BUCKETS bucket seconds falls in, len(WAIT_BUCKETS) when beyond the last
+    milliseconds = seconds * 1000
+    bucket = 0
+    while bucket < len(WAIT_BUCKETS) and milliseconds > WAIT_BUCKETS[bucket]:
+        bucket += 1
+    return bucket
+
+
+def _histogram(counts):
+    # Keys a list of counts per WAIT_BUCKETS bucket by each bucket's upper bound in milliseconds
+    return dict(zip([str(bound) for bound in WAIT_BUCKETS] + ['inf'], counts))
+
+
+def _unwrap(connection):
+    # The driver's connection of an InstrumentedConnection
+    if isinstance(connection, InstrumentedConnection):
+        return connection.connection
+    return connection
+
+
+def _release_abandoned(pool, semaphore, executor, future):
+    # Done callback releasing a connection whose acquiring coroutine was cancelled. It runs on the
+    #     event loop so the blocking close is sent to executor
+    if future.cancelled() or future.exception() is not None:
+        semaphore.release()
+        return
+    closing = asyncio.get_running_loop().run_in_executor(executor, pool.close_connection,
+                                                         future.result())
+    closing.add_done_callback(partial(_abandoned_released, pool, semaphore))
+
+
+def _abandoned_released(pool, semaphore, closing):
+    # Done callback of the close started by _release_abandoned
+    semaphore.release()
+    if not closing.cancelled() and closing.exception() is not None:
+        LOGGER.warning("Releasing an abandoned connection to %s failed: %s",
+                       pool.pool.tnsentry, closing.exception())
+
+
+def _pool_size(pool):
+    # Returns the most connections pool, or each pool of a PoolManager, can hand out
+    if isinstance(pool, PoolManager):
+        kwargs = pool._pool_kwargs
+        if kwargs.get('adaptive'):
+            return max([kwargs.get('ceiling', DEFAULT_CEILING)] + list(pool._ceilings.values()))
+        return kwargs.get('max', 2)
+    return pool.pool.max
+
+
+def _get_cluster(kwargs):
+    # Every pool shares the Cluster parsed from the same config files
+    if 'cluster' in kwargs:
+        return kwargs['cluster']
+    if 'prod_file' in kwargs and 'db_file' in kwargs:
+        return Cluster.get(prod_file=kwargs['prod_file'], db_file=kwargs['db_file'])
+    if 'prod_file' in kwargs:
+        return Cluster.get(prod_file=kwargs['prod_file'])
+    if 'db_file' in kwargs:
+        return Cluster.get(db_file=kwargs['db_file'])
+    return Cluster.get()
+
+
+def _is_exhausted(error):
+    # True when a cx_Oracle.DatabaseError from acquire means no connection was free in time
+    code = getattr(error.args[0], 'code', None) if error.args else None
+    return code in POOL_EXHAUSTED_CODES
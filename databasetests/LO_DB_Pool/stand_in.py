@@ -0,0 +1,509 @@
+"""Local stand in for the parts of the cx_Oracle API that LO_DB_Pool uses.
+
+Lets pools be created, sized and load tested without an Oracle database. Opening a session and
+running a statement each sleep for a configurable latency so waits on a busy pool look like they
+would against a real database. Preparing a statement that is neither the last one run on the
+cursor nor in the session's statement cache costs parse_latency on top.
+
+Queries return rows from the driver's rows function, or with a database each session runs its
+statements on a sqlite3 connection so SQL, binds, transactions and constraint errors behave for
+real. Sessions can be made to fail at random to test how pools cope with broken connections.
+
+Example:
+    pool = SitePool(db='db103tc', driver=stand_in.StandInDriver(query_latency=0.01))
+    pool = ConvioPool(db='db103tc', driver=stand_in.StandInDriver(database=':memory:',
+                                                                  failure_rate=0.01))
+"""
+
+import random
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from itertools import count
+from time import perf_counter, sleep
+
+SPOOL_ATTRVAL_WAIT = 0
+SPOOL_ATTRVAL_NOWAIT = 1
+SPOOL_ATTRVAL_TIMEDWAIT = 3
+# Oracle's one row table, sysdate is a column so statements like "select sysdate from dual" run
+DUAL_VIEW = "create view if not exists dual as select 'X' as dummy, datetime('now') as sysdate"
+# :name and :1 style bind variables outside of string literals
+BIND_PATTERN = re.compile(r"'[^']*'|:(\w+)")
+# Names for the in memory sqlite3 databases of drivers given ':memory:'
+_memory_names = count()
+
+
+class Error(Exception):
+    pass
+
+
+class DatabaseError(Error):
+    pass
+
+
+class _ErrorInfo:
+    # Mimics the cx_Oracle._Error object carried in a cx_Oracle exception's args and returned by
+    # cursor.getbatcherrors()
+    def __init__(self, code, message, offset=0):
+        self.code = code
+        self.message = message
+        self.offset = offset
+
+    def __str__(self):
+        return self.message
+
+
+def _database_error(code, message):
+    return DatabaseError(_ErrorInfo(code, 'ORA-{:05d}: {}'.format(code, message)))
+
+
+def _sqlite_error(error):
+    # The DatabaseError cx_Oracle would raise for the same problem as sqlite3 error
+    message = str(error)
+    if isinstance(error, sqlite3.IntegrityError):
+        return _database_error(1, 'unique constraint violated ({})'.format(message))
+    if message.startswith('no such table'):
+        return _database_error(942, 'table or view does not exist ({})'.format(message))
+    if 'locked' in message or 'busy' in message:
+        return _database_error(54, 'resource busy ({})'.format(message))
+    return _database_error(900, 'invalid SQL statement ({})'.format(message))
+
+
+def _bind(statement, parameters):
+    # sqlite3 binds sequences by position only to ? placeholders, so name them in statement order
+    if parameters is None or isinstance(parameters, dict):
+        return parameters or {}
+    names = list()
+    for match in BIND_PATTERN.finditer(statement):
+        if match.group(1) is not None and match.group(1) not in names:
+            names.append(match.group(1))
+    return dict(zip(names, parameters))
+
+
+class StandInDriver:
+    """Driver object passed to LODBPool as its driver kwarg in place of the cx_Oracle module.
+
+    Attributes:
+        connect_latency: seconds it takes to open a session
+        query_latency: seconds each cursor.execute() takes
+        fetch_latency: seconds each round trip fetching rows takes, one per fetchmany() call or per
+            arraysize rows when iterating the cursor
+        parse_latency: seconds preparing a statement takes when the session has not cached it
+        ping_latency: seconds a ping round trip takes
+        rows: function called with (user, statement, parameters) that returns the rows for a query,
+            by default every query returns no rows
+        dml: function called with (user, statement, parameters) for any statement other than a
+            query and for every parameter set of an executemany(), that returns the number of
+            rows changed or raises DatabaseError, by default each parameter set changes one row
+        database: path of a sqlite3 database, or ':memory:' for one shared by this driver's
+            sessions, that statements run on in place of rows and dml. Every schema shares it.
+            Writers to a ':memory:' database lock whole tables, use a file for write heavy loads
+        failure_rate: chance of each statement failing with ORA-03113 and breaking its session
+        connect_failure_rate: chance of opening a session failing with ORA-12170
+        seed: seed for the random failures
+        failures: number of failures injected
+        pings: number of idle sessions pinged by acquire
+        dead: number of dead sessions acquire found and replaced
+        commits: number of commits made on any connection
+        prepares: number of statements prepared because neither the cursor nor the session's
+            statement cache had them
+        pools: list of the StandInPools this driver created
+    """
+    Error = Error
+    DatabaseError = DatabaseError
+    SPOOL_ATTRVAL_WAIT = SPOOL_ATTRVAL_WAIT
+    SPOOL_ATTRVAL_NOWAIT = SPOOL_ATTRVAL_NOWAIT
+    SPOOL_ATTRVAL_TIMEDWAIT = SPOOL_ATTRVAL_TIMEDWAIT
+
+    def __init__(self, connect_latency=0.0, query_latency=0.0, fetch_latency=0.0, rows=None,
+                 dml=None, parse_latency=0.0, database=None, failure_rate=0.0,
+                 connect_failure_rate=0.0, seed=None, ping_latency=0.0):
+        self.connect_latency = connect_latency
+        self.query_latency = query_latency
+        self.fetch_latency = fetch_latency
+        self.parse_latency = parse_latency
+        self.ping_latency = ping_latency
+        self.rows = rows if rows is not None else lambda user, statement, parameters: []
+        self.dml = dml if dml is not None else lambda user, statement, parameters: 1
+        self.database = database
+        self.failure_rate = failure_rate
+        self.connect_failure_rate = connect_failure_rate
+        self.failures = 0
+        self.pings = 0
+        self.dead = 0
+        self.commits = 0
+        self.prepares = 0
+        self.pools = list()
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._uri = None
+        self._keep_alive = None
+        if database is not None:
+            if database == ':memory:':
+                self._uri = 'file:stand_in_{}?mode=memory&cache=shared'.format(
+                    next(_memory_names))
+                # A shared in memory database lives as long as a connection to it is open
+                self._keep_alive = self.connect()
+            else:
+                self._uri = 'file:{}'.format(database)
+            connection = self.connect()
+            try:
+                connection.execute(DUAL_VIEW)
+            finally:
+                connection.close()
+
+    def connect(self):
+        """Returns a new sqlite3 connection to the driver's database."""
+        return sqlite3.connect(self._uri, uri=True, timeout=5, check_same_thread=False)
+
+    def close(self):
+        """Closes the driver's ':memory:' database, which is lost once its last session closes."""
+        if self._keep_alive is not None:
+            self._keep_alive.close()
+            self._keep_alive = None
+
+    def fail(self, rate):
+        """Returns True, counting a failure, with a chance of rate."""
+        if not rate:
+            return False
+        with self._lock:
+            if self._random.random() >= rate:
+                return False
+            self.failures += 1
+            return True
+
+    @staticmethod
+    def error(code, message):
+        """Returns a DatabaseError like the one cx_Oracle raises for ORA-code, e.g. for dml."""
+        return _database_error(code, message)
+
+    # Named after cx_Oracle.SessionPool so the driver can stand in for the module
+    def SessionPool(self, **kwargs):
+        pool = StandInPool(self, **kwargs)
+        self.pools.append(pool)
+        return pool
+
+
+class StandInPool:
+    """Session pool with the cx_Oracle.SessionPool acquire, release, drop and close methods.
+
+    Sessions beyond min that sit idle longer than timeout seconds are closed on the next acquire.
+    As with cx_Oracle 8.2, acquire pings a session that sat idle at least ping_interval seconds
+    and opens a new one in place of it if it is dead, a negative ping_interval never pings. Each
+    session caches up to stmtcachesize prepared statements, least recently used first out. The
+    highest number of sessions ever open at once is kept in opened_max.
+    """
+
+    def __init__(self, driver, user=None, password=None, dsn=None, min=1, max=2, increment=1,
+                 encoding=None, homogeneous=True, getmode=SPOOL_ATTRVAL_NOWAIT, wait_timeout=0,
+                 timeout=0, stmtcachesize=20, ping_interval=60):
+        self.driver = driver
+        self.user = user
+        self.tnsentry = dsn
+        self.min = min
+        self.max = max
+        self.increment = increment
+        self.homogeneous = homogeneous
+        self.getmode = getmode
+        self.wait_timeout = wait_timeout
+        self.timeout = timeout
+        self.stmtcachesize = stmtcachesize
+        self.ping_interval = ping_interval
+        self.opened_max = 0
+        self._condition = threading.Condition()
+        self._idle = list()  # (StandInConnection, perf_counter() when it was released)
+        self._busy = set()
+        self._opening = 0
+        self._closed = False
+
+    @property
+    def busy(self):
+        return len(self._busy)
+
+    @property
+    def opened(self):
+        return len(self._busy) + len(self._idle)
+
+    def acquire(self, user=None, password=None):
+        start = perf_counter()
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise _database_error(24550, 'pool is closed')
+                self._close_idle()
+                if self._idle:
+                    connection, since = self._idle.pop()
+                    if not self._alive(connection, since):
+                        continue
+                    connection.user = user or self.user
+                    self._busy.add(connection)
+                    return connection
+                if self.opened + self._opening < self.max:
+                    self._opening += 1
+                    break
+                if self.getmode == SPOOL_ATTRVAL_NOWAIT:
+                    raise _database_error(24418, 'Cannot open further sessions.')
+                if self.getmode == SPOOL_ATTRVAL_TIMEDWAIT:
+                    remaining = self.wait_timeout / 1000 - (perf_counter() - start)
+                    if remaining <= 0:
+                        raise _database_error(24457, 'OCISessionGet() could not find a free '
+                                                     'session in the specified timeout period')
+                    self._condition.wait(remaining)
+                else:
+                    self._condition.wait()
+
+        # Open the new session outside the lock as a real connect would
+        sleep(self.driver.connect_latency)
+        if self.driver.fail(self.driver.connect_failure_rate):
+            with self._condition:
+                self._opening -= 1
+                self._condition.notify()
+            raise _database_error(12170, 'TNS:Connect timeout occurred')
+        connection = StandInConnection(self, user or self.user)
+        with self._condition:
+            self._opening -= 1
+            self._busy.add(connection)
+            self.opened_max = max(self.opened_max, self.opened)
+        return connection
+
+    def _alive(self, connection, since):
+        # Called holding the condition, pings connection if it sat idle ping_interval seconds
+        if self.ping_interval < 0 or perf_counter() - since < self.ping_interval:
+            return True
+        sleep(self.driver.ping_latency)
+        with self.driver._lock:
+            self.driver.pings += 1
+            if connection.closed:
+                self.driver.dead += 1
+        if connection.closed:
+            self._condition.notify()
+            return False
+        return True
+
+    def kill_idle(self):
+        """Breaks every idle session, as a database restart or a firewall dropping idle
+        connections would."""
+        with self._condition:
+            for connection, since in self._idle:
+                connection.close()
+
+    def _close_idle(self):
+        # Called holding the condition
+        if not self.timeout:
+            return
+        now = perf_counter()
+        self._idle = [(connection, since) for number, (connection, since)
+                      in enumerate(self._idle)
+                      if number < self.min or now - since < self.timeout]
+
+    def _check_busy(self, connection):
+        # Called holding the condition
+        if self._closed or connection not in self._busy:
+            raise _database_error(1012, 'not logged on')
+
+    def release(self, connection):
+        with self._condition:
+            self._check_busy(connection)
+            self._busy.remove(connection)
+            self._idle.append((connection, perf_counter()))
+            self._condition.notify()
+
+    def drop(self, connection):
+        with self._condition:
+            self._check_busy(connection)
+            self._busy.remove(connection)
+            connection.close()
+            self._condition.notify()
+
+    def close(self, force=False):
+        with self._condition:
+            if self._busy and not force:
+                raise _database_error(24422, 'error occurred while trying to destroy the '
+                                             'Session Pool')
+            self._closed = True
+            for connection, since in self._idle:
+                connection.close()
+            self._idle = list()
+            self._busy = set()
+            self._condition.notify_all()
+
+
+class StandInConnection:
+    def __init__(self, pool, user):
+        self.pool = pool
+        self.user = user
+        self.closed = False
+        self.stmtcachesize = pool.stmtcachesize
+        self._statements = OrderedDict()
+        self.sqlite = None if pool.driver.database is None else pool.driver.connect()
+
+    def cursor(self):
+        return StandInCursor(self)
+
+    def prepare(self, statement):
+        # Parses statement unless the session's statement cache has it
+        if statement in self._statements:
+            self._statements.move_to_end(statement)
+            return
+        sleep(self.pool.driver.parse_latency)
+        with self.pool.driver._lock:
+            self.pool.driver.prepares += 1
+        if self.stmtcachesize:
+            self._statements[statement] = True
+            while len(self._statements) > self.stmtcachesize:
+                self._statements.popitem(last=False)
+
+    def ping(self):
+        if self.closed:
+            raise _database_error(3113, 'end-of-file on communication channel')
+
+    def run(self):
+        # Called for every statement, injecting a failure that breaks the session
+        self.ping()
+        if self.pool.driver.fail(self.pool.driver.failure_rate):
+            self.close()
+            raise _database_error(3113, 'end-of-file on communication channel')
+
+    def commit(self):
+        self.ping()
+        if self.sqlite is not None:
+            self.sqlite.commit()
+        with self.pool.driver._lock:
+            self.pool.driver.commits += 1
+
+    def rollback(self):
+        self.ping()
+        if self.sqlite is not None:
+            self.sqlite.rollback()
+
+    def close(self):
+        self.closed = True
+        if self.sqlite is not None:
+            self.sqlite.close()
+
+
+class StandInCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.arraysize = 100
+        self.prefetchrows = 2
+        self.rowcount = 0
+        self.description = None
+        self.statement = None
+        self._rows = list()
+        self._position = 0
+        self._batch_errors = list()
+        self._dml_counts = list()
+
+    def _prepare(self, statement):
+        # A cursor runs the statement it ran last again without preparing it
+        if statement != self.statement:
+            self.connection.prepare(statement)
+            self.statement = statement
+
+    def _sqlite_execute(self, statement, parameters):
+        # Runs statement on the session's sqlite3 connection, fetching any rows it returns
+        try:
+            cursor = self.connection.sqlite.execute(statement, _bind(statement, parameters))
+            rows = cursor.fetchall()
+        except sqlite3.Error as error:
+            raise _sqlite_error(error) from error
+        if cursor.description is None:
+            self.description = None
+            self.rowcount = cursor.rowcount
+            return None
+        self._rows = rows
+        self._position = 0
+        self.rowcount = 0
+        self.description = [(column[0].upper(), None, None, None, None, None, True)
+                            for column in cursor.description]
+        return self
+
+    def execute(self, statement, parameters=None, **kwargs):
+        self.connection.run()
+        self._prepare(statement)
+        sleep(self.connection.pool.driver.query_latency)
+        if self.connection.sqlite is not None:
+            return self._sqlite_execute(statement, parameters or kwargs)
+        if not statement.lstrip().lower().startswith(('select', 'with')):
+            self.description = None
+            self.rowcount = self.connection.pool.driver.dml(self.connection.user, statement,
+                                                            parameters or kwargs)
+            return None
+        self._rows = list(self.connection.pool.driver.rows(self.connection.user, statement,
+                                                           parameters or kwargs))
+        self._position = 0
+        self.rowcount = 0
+        width = len(self._rows[0]) if self._rows else 0
+        self.description = [('COLUMN{}'.format(number), None, None, None, None, None, True)
+                            for number in range(1, width + 1)]
+        return self
+
+    def executemany(self, statement, parameters, batcherrors=False, arraydmlrowcounts=False):
+        """Runs statement once per parameter set in a single round trip. With batcherrors the
+        parameter sets that fail are kept for getbatcherrors() and the rest still run."""
+        self.connection.run()
+        self._prepare(statement)
+        sleep(self.connection.pool.driver.query_latency)
+        dml = self.connection.pool.driver.dml
+        if self.connection.sqlite is not None:
+            dml = self._sqlite_dml
+        self._batch_errors = list()
+        self._dml_counts = list()
+        for offset, row in enumerate(parameters):
+            try:
+                self._dml_counts.append(dml(self.connection.user, statement, row))
+            except DatabaseError as error:
+                if not batcherrors:
+                    raise
+                self._batch_errors.append(_ErrorInfo(error.args[0].code, error.args[0].message,
+                                                     offset))
+                self._dml_counts.append(0)
+        self.rowcount = sum(self._dml_counts)
+
+    def _sqlite_dml(self, user, statement, parameters):
+        # Same signature as StandInDriver.dml, for executemany() on a sqlite3 database
+        try:
+            return self.connection.sqlite.execute(statement, _bind(statement, parameters)).rowcount
+        except sqlite3.Error as error:
+            raise _sqlite_error(error) from error
+
+    def getbatcherrors(self):
+        return self._batch_errors
+
+    def getarraydmlrowcounts(self):
+        return self._dml_counts
+
+    def __iter__(self):
+        while True:
+            batch = self.fetchmany()
+            if not batch:
+                return
+            yield from batch
+
+    def _fetch(self, size):
+        # One round trip returning up to size rows
+        sleep(self.connection.pool.driver.fetch_latency)
+        batch = self._rows[self._position:self._position + size]
+        self._position += len(batch)
+        self.rowcount = self._position
+        return batch
+
+    def fetchone(self):
+        batch = self._fetch(1)
+        return batch[0] if batch else None
+
+    def fetchmany(self, size=None):
+        return self._fetch(self.arraysize if size is None else size)
+
+    def fetchall(self):
+        rows = list()
+        while True:
+            batch = self.fetchmany()
+            if not batch:
+                return rows
+            rows.extend(batch)
+
+    def close(self):
+        pass
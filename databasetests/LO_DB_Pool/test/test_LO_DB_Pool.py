@@ -1,5 +1,723 @@
+import asyncio
+import io
+import json
+import os
+import tempfile
+import threading
+import time
 import unittest
+
 import LO_DB_Pool
+import utils
+from LO_DB_Pool.LO_DB_Pool import (PRIORITY_BATCH, PRIORITY_INTERACTIVE, PRIORITY_NORMAL,
+                                   AsyncPool, BulkWriter, ConvioPool, FanOutQuery,
+                                   InstrumentedConnection, PoolManager, QueryMetrics, SitePool,
+                                   SiteUrlLookup)
+from LO_DB_Pool.stand_in import StandInDriver
+
+
+def make_cluster():
+    return utils.Cluster(prod_file=io.StringIO('tc\n'),
+                         db_file=io.StringIO('1,db103tc,\n2,db104tc,\n'))
+
+
+def make_site(short, db='db103tc', site_id=1):
+    return utils.Site(site_id=site_id, short=short, domain=short + '.example.org',
+                      version='23.4', db=db, site_data_dir='/tmp')
+
+
+class PoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cluster = make_cluster()
+        self.driver = StandInDriver()
+
+    def pool(self, pool_class=ConvioPool, **kwargs):
+        kwargs.setdefault('db', 'db103tc')
+        pool = pool_class(cluster=self.cluster, driver=self.driver, **kwargs)
+        self.addCleanup(pool.close, force=True)
+        return pool
+
+
+class TestLifecycle(PoolTestCase):
+    def test_connection_is_released(self):
+        pool = self.pool(max=1)
+        with pool.connection() as connection:
+            self.assertEqual(pool.statistics()['busy'], 1)
+            self.assertIn(id(connection), pool.checkouts)
+        statistics = pool.statistics()
+        self.assertEqual((statistics['busy'], statistics['open']), (0, 1))
+        self.assertEqual((statistics['acquires'], statistics['releases']), (1, 1))
+
+    def test_broken_connection_is_dropped(self):
+        pool = self.pool()
+        with self.assertRaises(self.driver.DatabaseError):
+            with pool.connection() as connection:
+                connection.close()
+                connection.cursor().execute('select 1 from dual')
+        self.assertEqual(pool.statistics()['drops'], 1)
+        self.assertEqual(pool.pool.opened, 0)
+
+    def test_release_twice_fails(self):
+        pool = self.pool()
+        connection = pool.get_connection()
+        pool.close_connection(connection)
+        self.assertRaises(ValueError, pool.close_connection, connection)
+
+    def test_exhausted_pool_counts_timeout(self):
+        pool = self.pool(max=1, timeout=0.01)
+        with pool.connection():
+            self.assertRaises(self.driver.DatabaseError, pool.get_connection)
+        self.assertEqual(pool.statistics()['timeouts'], 1)
+
+    def test_leak_reports_where_it_was_acquired(self):
+        pool = self.pool(leak_timeout=0.01)
+        connection = pool.get_connection()
+        with self.assertLogs('LO_DB_Pool', 'WARNING') as logs:
+            time.sleep(0.02)
+            leaks = pool.check_leaks()
+        self.assertEqual([leak.connection for leak in leaks], [connection])
+        self.assertIn('test_leak_reports_where_it_was_acquired', logs.output[0])
+        pool.close_connection(connection)
+
+    def test_leak_is_reported_without_acquires(self):
+        pool = self.pool(leak_timeout=0.02)
+        connection = pool.get_connection()
+        for _ in range(200):
+            if pool.statistics()['leaks']:
+                break
+            time.sleep(0.01)
+        self.assertEqual(pool.statistics()['leaks'], 1)
+        pool.close_connection(connection)
+        pool.close()
+        self.assertTrue(pool._stopped.is_set())
+
+    def test_site_pool_rejects_other_db(self):
+        pool = self.pool(SitePool)
+        self.assertRaises(ValueError, pool.get_connection, make_site('acme', db='db104tc'))
+
+    def test_pool_manager_routes_by_site_db(self):
+        with PoolManager(cluster=self.cluster, driver=self.driver) as manager:
+            with manager.connection(make_site('acme', db='db104tc')) as connection:
+                self.assertEqual(connection.user, 'acme')
+            self.assertEqual(list(manager.pools), ['db104tc'])
+            self.assertEqual(manager.statistics()['db104tc']['releases'], 1)
+        self.assertEqual(manager.pools, {})
+
+
+class TestPoolManager(PoolTestCase):
+    def manager(self, **kwargs):
+        manager = PoolManager(cluster=self.cluster, driver=self.driver, **kwargs)
+        self.addCleanup(manager.close, force=True)
+        return manager
+
+    def test_routes_by_site_db(self):
+        manager = self.manager()
+        connection = manager.get_connection(make_site('acme', db='db104tc'))
+        self.assertEqual(connection.user, 'acme')
+        self.assertEqual(list(manager.pools), ['db104tc'])
+        self.assertEqual(manager.pools['db104tc'].pool.tnsentry, 'db104tc')
+
+    def test_pools_are_created_on_first_use(self):
+        manager = self.manager(max=3)
+        self.assertEqual(manager.pools, {})
+        manager.get_connection(make_site('acme', site_id=1))
+        pool = manager.pools['db103tc']
+        manager.get_connection(make_site('zenith', site_id=2))
+        self.assertIs(manager.pool('db103tc'), pool)
+        self.assertEqual(list(manager.pools), ['db103tc'])
+        self.assertEqual(pool.pool.max, 3)
+
+    def test_rejects_site_on_unknown_db(self):
+        manager = self.manager()
+        self.assertRaises(ValueError, manager.get_connection, make_site('acme', db='db999tc'))
+        self.assertEqual(manager.pools, {})
+
+    def test_close_closes_every_pool(self):
+        with PoolManager(cluster=self.cluster, driver=self.driver) as manager:
+            pools = [manager.pool('db103tc'), manager.pool('db104tc')]
+        self.assertEqual(manager.pools, {})
+        for pool in pools:
+            self.assertRaises(self.driver.DatabaseError, pool.pool.acquire)
+        self.assertRaises(ValueError, manager.pool, 'db103tc')
+
+    def test_close_finishes_after_a_failure(self):
+        manager = self.manager()
+        manager.get_connection(make_site('acme', db='db103tc'))
+        idle = manager.pool('db104tc')
+        self.assertRaises(self.driver.DatabaseError, manager.close)
+        self.assertRaises(self.driver.DatabaseError, idle.pool.acquire)
+        self.assertEqual(manager.pools, {})
+
+
+class TestStreaming(PoolTestCase):
+    def setUp(self):
+        super().setUp()
+        self.driver.rows = lambda user, statement, parameters: \
+            [('site{}.example.org/'.format(number), number) for number in range(2500)]
+
+    def test_stream_yields_arraysize_batches(self):
+        pool = self.pool()
+        batches = list(pool.stream('select prefix, site_id from site_url', arraysize=1000))
+        self.assertEqual([len(batch) for batch in batches], [1000, 1000, 500])
+        self.assertEqual(pool.checkouts, {})
+        self.assertEqual(pool.stats.releases, 1)
+
+    def test_closing_stream_releases(self):
+        pool = self.pool(SitePool)
+        batches = pool.stream('select prefix, site_id from site_url', site=make_site('acme'))
+        next(batches)
+        batches.close()
+        self.assertEqual(pool.checkouts, {})
+
+    def test_export_csv(self):
+        output = io.StringIO()
+        rows = self.pool().export('select prefix, site_id from site_url', output, arraysize=700)
+        self.assertEqual(rows, 2500)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[:2], ['COLUMN1,COLUMN2', 'site0.example.org/,0'])
+        self.assertEqual(len(lines), 2501)
+
+    def test_export_jsonl(self):
+        output = io.StringIO()
+        self.pool().export('select prefix, site_id from site_url', output, format='jsonl')
+        lines = output.getvalue().splitlines()
+        self.assertEqual(json.loads(lines[-1]), {'COLUMN1': 'site2499.example.org/',
+                                                 'COLUMN2': 2499})
+
+    def test_export_rejects_unknown_format(self):
+        pool = self.pool()
+        self.assertRaises(ValueError, pool.export, 'select 1 from dual', io.StringIO(), 'xml')
+        self.assertEqual(pool.stats.acquires, 0)
+
+
+class TestBulkWriter(PoolTestCase):
+    def setUp(self):
+        super().setUp()
+        self.applied = list()
+        self.driver.dml = self.dml
+        self.sites = [make_site('site{}'.format(number), db=('db103tc', 'db104tc')[number % 2],
+                                site_id=number) for number in range(6)]
+
+    def dml(self, user, statement, parameters):
+        if parameters[1] is None:
+            raise self.driver.error(1400, 'cannot insert NULL')
+        self.applied.append((user, parameters))
+        return 1
+
+    def test_rows_are_committed_in_batches_per_site(self):
+        with PoolManager(cluster=self.cluster, driver=self.driver, max=2) as manager:
+            with BulkWriter(manager, 'update cons set email = :2 where cons_id = :1',
+                            batch_size=10, commit_interval=2) as writer:
+                writer.write((site, (number, 'a@example.org'))
+                             for number in range(45) for site in self.sites)
+            for pool in manager.pools.values():
+                self.assertEqual(pool.checkouts, {})
+                self.assertLessEqual(pool.pool.opened_max, 2)
+        self.assertEqual(writer.written, {site.site_id: 45 for site in self.sites})
+        self.assertEqual(len(self.applied), 270)
+        # 45 rows per site commit as 20, 20 and 5
+        self.assertEqual(self.driver.commits, 18)
+        self.assertEqual(writer.statistics()['rows'], 270)
+
+    def test_jobs_for_a_site_keep_their_order(self):
+        def dml(user, statement, parameters):
+            # The first job is slow so later ones could overtake it on another connection
+            if parameters[0] == 0:
+                time.sleep(0.05)
+            self.applied.append((user, parameters))
+            return 1
+
+        self.driver.dml = dml
+        with PoolManager(cluster=self.cluster, driver=self.driver, max=2) as manager:
+            with BulkWriter(manager, 'update cons set email = :2 where cons_id = :1',
+                            batch_size=2) as writer:
+                writer.write((self.sites[0], (number, 'a@example.org')) for number in range(10))
+        self.assertEqual([parameters[0] for user, parameters in self.applied], list(range(10)))
+        self.assertEqual(writer.written, {0: 10})
+
+    def test_batch_errors_are_reported(self):
+        with PoolManager(cluster=self.cluster, driver=self.driver) as manager:
+            with BulkWriter(manager, 'insert into cons values (:1, :2)', batch_size=4) as writer:
+                writer.write([(self.sites[0], (1, 'a')), (self.sites[0], (2, None)),
+                              (self.sites[0], (3, 'c'))])
+        self.assertEqual([error.parameters for error in writer.errors], [(2, None)])
+        self.assertEqual(writer.errors[0].code, 1400)
+        self.assertEqual(writer.written, {0: 2})
+
+    def test_failed_site_is_rolled_back(self):
+        lost = make_site('lost', db='db999tc', site_id=99)
+        with PoolManager(cluster=self.cluster, driver=self.driver) as manager:
+            with BulkWriter(manager, 'insert into cons values (:1, :2)') as writer:
+                writer.write([(lost, (1, 'a')), (self.sites[0], (1, 'a'))])
+        self.assertEqual([(site.short, rows) for site, error, rows in writer.failures],
+                         [('lost', 1)])
+        self.assertEqual(writer.written, {0: 1})
+
+
+class TestSiteUrlLookup(PoolTestCase):
+    def setUp(self):
+        super().setUp()
+        self.site_url = {'www.jdrf.org/': 3701, 'www.jdrf.org/site/': 3702,
+                         'acme.example.org/': 1234}
+        self.statements = list()
+        self.driver.rows = self.site_url_rows
+
+    def site_url_rows(self, user, statement, parameters):
+        self.statements.append(statement)
+        if 'substr' not in statement:
+            return list(self.site_url.items())
+        matches = [prefix for prefix in self.site_url if parameters['url'].startswith(prefix)]
+        if not matches:
+            return []
+        prefix = max(matches, key=len)
+        return [(prefix, self.site_url[prefix])]
+
+    def test_longest_prefix(self):
+        lookup = SiteUrlLookup(self.pool())
+        self.assertEqual(lookup.lookup('www.jdrf.org/site/Donation2'), 3702)
+        self.assertEqual(lookup.lookup('www.jdrf.org/about'), 3701)
+        statistics = lookup.statistics()
+        self.assertEqual((statistics['hits'], statistics['misses']), (2, 0))
+        self.assertEqual(statistics['last_refresh']['added'], 3)
+        self.assertEqual(len(self.statements), 1)
+
+    def test_miss_falls_back_to_the_database_once(self):
+        lookup = SiteUrlLookup(self.pool())
+        self.site_url['new.example.org/'] = 42
+        self.assertEqual(lookup.lookup('new.example.org/page'), 42)
+        self.assertEqual(lookup.lookup('new.example.org/other'), 42)
+        self.assertIsNone(lookup.lookup('unknown.example.org/'))
+        self.assertIsNone(lookup.lookup('unknown.example.org/'))
+        statistics = lookup.statistics()
+        self.assertEqual((statistics['fallback_hits'], statistics['fallback_misses']), (1, 1))
+        self.assertEqual(len(self.statements), 3)
+
+    def test_fallback_does_not_wait_for_a_refresh(self):
+        lookup = SiteUrlLookup(self.pool(max=2))
+        streaming, finish = threading.Event(), threading.Event()
+        rows = self.driver.rows
+
+        def slow_rows(user, statement, parameters):
+            if 'substr' not in statement:
+                streaming.set()
+                finish.wait(5)
+            return rows(user, statement, parameters)
+
+        self.driver.rows = slow_rows
+        refresher = threading.Thread(target=lookup.refresh)
+        refresher.start()
+        try:
+            self.assertTrue(streaming.wait(5))
+            self.site_url['new.example.org/'] = 42
+            self.assertEqual(lookup.lookup('new.example.org/page'), 42)
+            self.assertTrue(refresher.is_alive())
+        finally:
+            finish.set()
+            refresher.join()
+        self.assertEqual(lookup.statistics()['refreshes'], 2)
+
+    def test_refresh_applies_changes_after_ttl(self):
+        lookup = SiteUrlLookup(self.pool(), ttl=0.01)
+        del self.site_url['acme.example.org/']
+        self.site_url['www.jdrf.org/'] = 1
+        time.sleep(0.02)
+        lookup.lookup('www.jdrf.org/')
+        for _ in range(100):
+            if lookup.statistics()['refreshes'] == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(lookup.statistics()['last_refresh'],
+                         dict(lookup.statistics()['last_refresh'], added=0, removed=1, changed=1))
+        self.assertEqual(lookup.lookup('www.jdrf.org/'), 1)
+        self.assertNotIn('acme.example.org/', lookup.prefixes)
+
+
+class TestAdaptiveSizing(PoolTestCase):
+    def hold_connections(self, pool, count, seconds):
+        def hold():
+            with pool.connection():
+                time.sleep(seconds)
+        threads = [threading.Thread(target=hold) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def test_caps_without_ceiling(self):
+        self.assertRaises(ValueError, self.pool, max=11)
+        self.assertRaises(ValueError, self.pool, min=6)
+        self.assertEqual(self.pool(max=20, ceiling=30).pool.max, 20)
+        self.assertRaises(ValueError, self.pool, max=20, ceiling=10)
+
+    def test_grows_while_acquires_wait(self):
+        pool = self.pool(max=2, ceiling=6, adaptive=True, grow_wait=0.01)
+        self.hold_connections(pool, 8, 0.1)
+        statistics = pool.statistics()
+        self.assertGreater(statistics['limit'], 2)
+        self.assertLessEqual(pool.pool.opened_max, 6)
+        self.assertEqual(statistics['grows'], len(statistics['decisions']))
+        self.assertEqual(statistics['decisions'][0]['action'], 'grow')
+
+    def test_shrinks_when_idle(self):
+        pool = self.pool(max=1, ceiling=4, adaptive=True, grow_wait=0.01, idle_timeout=0.05)
+        self.hold_connections(pool, 4, 0.1)
+        grown = pool.limit.limit
+        self.assertGreater(grown, 1)
+        time.sleep(0.12)
+        with pool.connection():
+            pass
+        self.assertLess(pool.limit.limit, grown)
+        self.assertEqual(pool.statistics()['decisions'][-1]['action'], 'shrink')
+
+    def test_timeout_at_ceiling(self):
+        pool = self.pool(max=1, ceiling=1, adaptive=True, timeout=0.02)
+        with pool.connection():
+            self.assertRaises(TimeoutError, pool.get_connection)
+        self.assertEqual(pool.statistics()['timeouts'], 1)
+
+    def test_per_db_ceilings(self):
+        with PoolManager(cluster=self.cluster, driver=self.driver, adaptive=True,
+                         ceilings={'db104tc': 8}) as manager:
+            self.assertEqual(manager.pool('db103tc').limit.ceiling, 10)
+            self.assertEqual(manager.pool('db104tc').limit.ceiling, 8)
+
+
+class TestFairAcquire(PoolTestCase):
+    def queue(self, pool, name, order, priority=PRIORITY_NORMAL):
+        # Starts a thread whose acquire waits on pool, returning once it is queued
+        def acquire():
+            with pool.connection(priority=priority):
+                order.append(name)
+        waiting = pool.gate.waiting
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        while pool.gate.waiting == waiting:
+            time.sleep(0.001)
+        return thread
+
+    def test_waiters_are_served_in_order(self):
+        pool = self.pool(max=1, fair=True)
+        order = list()
+        with pool.connection():
+            threads = [self.queue(pool, number, order) for number in range(5)]
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, [0, 1, 2, 3, 4])
+
+    def test_interactive_skips_ahead_of_batch(self):
+        pool = self.pool(max=1, fair=True)
+        order = list()
+        with pool.connection():
+            threads = [self.queue(pool, 'batch', order, PRIORITY_BATCH),
+                       self.queue(pool, 'normal', order),
+                       self.queue(pool, 'interactive', order, PRIORITY_INTERACTIVE)]
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, ['interactive', 'normal', 'batch'])
+
+    def test_timeout_leaves_the_queue(self):
+        pool = self.pool(max=1, fair=True, timeout=5)
+        with pool.connection():
+            self.assertRaises(TimeoutError, pool.get_connection, timeout=0.02)
+            self.assertEqual(pool.gate.waiting, 0)
+        pool.close_connection(pool.get_connection(timeout=0))
+        statistics = pool.statistics()
+        self.assertEqual((statistics['timeouts'], statistics['in_use']), (1, 0))
+
+    def test_other_errors_leave_the_queue(self):
+        pool = self.pool(max=1, fair=True, timeout=5)
+        self.assertRaises(TypeError, pool.acquire, unknown=True)
+        self.assertEqual(pool.gate.in_use, 0)
+        pool.close_connection(pool.get_connection(timeout=0))
+
+    def test_timeout_needs_a_fair_pool(self):
+        pool = self.pool()
+        self.assertRaises(ValueError, pool.get_connection, timeout=1)
+        pool.close_connection(pool.get_connection(PRIORITY_BATCH))
+
+    def test_dead_idle_session_is_replaced_on_acquire(self):
+        pool = self.pool(ping_interval=0)
+        pool.close_connection(pool.get_connection())
+        pool.pool.kill_idle()
+        with pool.connection() as connection:
+            connection.cursor().execute('select 1 from dual')
+        self.assertEqual((self.driver.pings, self.driver.dead), (1, 1))
+        self.assertEqual(pool.stats.failures, 0)
+
+    def test_recently_used_session_is_not_pinged(self):
+        pool = self.pool()
+        for _ in range(3):
+            pool.close_connection(pool.get_connection())
+        self.assertEqual(self.driver.pings, 0)
+
+    def test_dropped_session_is_replaced_in_the_background(self):
+        pool = self.pool(max=2, fair=True)
+        with self.assertRaises(self.driver.DatabaseError):
+            with pool.connection() as connection:
+                connection.close()
+                connection.cursor().execute('select 1 from dual')
+        deadline = time.monotonic() + 5
+        while pool.stats.replacements == 0 and time.monotonic() < deadline:
+            time.sleep(0.001)
+        self.assertEqual((pool.stats.drops, pool.stats.replacements), (1, 1))
+        self.assertEqual((pool.pool.opened, pool.pool.busy), (1, 0))
+
+
+class TestFanOutQuery(PoolTestCase):
+    def setUp(self):
+        super().setUp()
+        self.driver.query_latency = 0.01
+        self.driver.rows = lambda user, statement, parameters: \
+            [(user, number, parameters) for number in range(3)]
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        site_version = os.path.join(tmpdir.name, 'site_version.csv')
+        with open(site_version, 'w') as file:
+            for site_id in range(1, 21):
+                file.write('{0},site{0},site{0}.example.org,23.4,{1}\n'.format(
+                    site_id, ('db103tc', 'db104tc')[site_id % 2]))
+            file.write('99,lost,lost.example.org,23.4,db999tc\n')
+        self.sitelist = utils.SiteList(all=True, site_version=site_version)
+
+    def test_rows_are_tagged_with_their_site(self):
+        query = FanOutQuery(self.sitelist, 'select * from cons',
+                            lambda site: {'site_id': site.site_id}, per_db_limit=2,
+                            cluster=self.cluster, driver=self.driver, max=4)
+        rows = list(query)
+        self.assertEqual(len(rows), 60)
+        for site, row in rows:
+            self.assertEqual(row[0], site.short)
+            self.assertEqual(row[2], {'site_id': site.site_id})
+        self.assertEqual(len(query.results), 21)
+        self.assertEqual([failure.site.short for failure in query.failures], ['lost'])
+        self.assertIsInstance(query.failures[0].error, ValueError)
+        timings = query.timings()
+        self.assertEqual(timings['db103tc']['rows'], 30)
+        self.assertEqual(timings['db999tc']['failures'], 1)
+        for pool in self.driver.pools:
+            self.assertLessEqual(pool.opened_max, 2)
+
+    def test_stopping_early_releases_connections(self):
+        with PoolManager(cluster=self.cluster, driver=self.driver) as manager:
+            query = FanOutQuery(self.sitelist, 'select * from cons', manager=manager,
+                                queue_size=1)
+            for site, row in query:
+                break
+            self.assertLess(len(query.results), 21)
+            for pool in manager.pools.values():
+                self.assertEqual(pool.checkouts, {})
+
+
+class TestInstrumentation(PoolTestCase):
+    def setUp(self):
+        super().setUp()
+        self.driver.rows = lambda user, statement, parameters: \
+            [('site{}.example.org/'.format(number), number) for number in range(250)]
+        self.events = list()
+
+    def test_without_hooks_connections_are_not_wrapped(self):
+        pool = self.pool()
+        with pool.connection() as connection:
+            self.assertNotIsInstance(connection, InstrumentedConnection)
+
+    def test_events_are_tagged(self):
+        pool = self.pool(SitePool, hooks=[self.events.append])
+        site = make_site('acme')
+        list(pool.stream('select prefix, site_id from site_url', site=site, arraysize=100))
+        with pool.connection(site) as connection:
+            connection.cursor().execute('update cons set email = null where cons_id = :1', [1])
+        query, update = self.events
+        self.assertEqual((query.db, query.site, query.rows), ('db103tc', 'acme', 250))
+        self.assertEqual((update.rows, update.error), (1, None))
+        self.assertGreaterEqual(query.seconds, 0)
+
+    def test_query_left_unfetched_is_reported_on_release(self):
+        pool = self.pool()
+        pool.add_hook(self.events.append)
+        with pool.connection() as connection:
+            connection.cursor().execute('select prefix, site_id from site_url').fetchmany(10)
+            self.assertEqual(self.events, [])
+        self.assertEqual([event.rows for event in self.events], [10])
+
+    def test_errors_are_reported(self):
+        pool = self.pool(hooks=[self.events.append])
+        with self.assertRaises(self.driver.DatabaseError):
+            with pool.connection() as connection:
+                connection.close()
+                connection.cursor().execute('select 1 from dual')
+        self.assertIsInstance(self.events[0].error, self.driver.DatabaseError)
+        self.assertEqual(pool.stats.drops, 1)
+
+    def test_failing_hook_is_logged(self):
+        def hook(event):
+            raise RuntimeError('broken hook')
+        pool = self.pool(hooks=[hook])
+        with self.assertLogs('LO_DB_Pool', 'ERROR'):
+            batches = list(pool.stream('select prefix, site_id from site_url'))
+        self.assertEqual(sum(len(batch) for batch in batches), 250)
+
+    def test_metrics_histograms_and_slow_queries(self):
+        metrics = QueryMetrics(slow_seconds=0.01)
+        pool = self.pool(hooks=[metrics])
+        list(pool.stream('select prefix, site_id from site_url'))
+        self.driver.query_latency = 0.02
+        with self.assertLogs('LO_DB_Pool', 'WARNING') as logs:
+            list(pool.stream('select * from cons'))
+        self.assertIn('select * from cons', logs.output[0])
+        statistics = metrics.as_dict()
+        stream = statistics['statements']['select prefix, site_id from site_url']
+        self.assertEqual((stream['count'], stream['rows'], stream['dbs']), (1, 250, {'db103tc': 1}))
+        self.assertEqual(sum(stream['histogram'].values()), 1)
+        self.assertEqual([event['statement'] for event in statistics['slow_queries']],
+                         ['select * from cons'])
+        json.dumps(statistics)
+
+    def test_manager_hooks_reach_every_pool(self):
+        with PoolManager(cluster=self.cluster, driver=self.driver) as manager:
+            manager.add_hook(self.events.append)
+            for site in (make_site('acme'), make_site('other', db='db104tc', site_id=2)):
+                with manager.connection(site) as connection:
+                    connection.cursor().execute('select 1 from dual').fetchall()
+        self.assertEqual([(event.db, event.site) for event in self.events],
+                         [('db103tc', 'acme'), ('db104tc', 'other')])
+
+    def test_statement_cache_skips_prepare(self):
+        for stmtcachesize, prepares in ((0, 3), (20, 1)):
+            self.driver.prepares = 0
+            pool = self.pool(max=1, stmtcachesize=stmtcachesize)
+            for _ in range(3):
+                list(pool.stream('select prefix, site_id from site_url'))
+            self.assertEqual(self.driver.prepares, prepares)
+
+    def test_cursor_is_reused_until_release(self):
+        pool = self.pool(stmtcachesize=0)
+        with pool.connection() as connection:
+            cursor = pool.cursor(connection)
+            self.assertIs(pool.cursor(connection), cursor)
+            for _ in range(3):
+                cursor.execute('select 1 from dual')
+            self.assertEqual(self.driver.prepares, 1)
+        self.assertRaises(ValueError, pool.cursor, connection)
+
+
+class TestSqliteStandIn(PoolTestCase):
+    def setUp(self):
+        self.cluster = make_cluster()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.driver = StandInDriver(database=os.path.join(tmpdir.name, 'stand_in.db'))
+        self.addCleanup(self.driver.close)
+        pool = self.pool()
+        with pool.connection() as connection:
+            connection.cursor().execute('create table cons (cons_id integer primary key, '
+                                        'email text)')
+
+    def test_statements_run_on_sqlite(self):
+        pool = self.pool()
+        with pool.connection() as connection:
+            cursor = connection.cursor()
+            cursor.executemany('insert into cons values (:1, :2)',
+                               [(1, 'a@example.org'), (2, 'b@example.org')])
+            connection.commit()
+            cursor.execute('update cons set email = :email where cons_id = :id',
+                           {'email': 'c@example.org', 'id': 2})
+            self.assertEqual(cursor.rowcount, 1)
+            connection.rollback()
+        rows = [row for batch in pool.stream('select cons_id, email from cons order by cons_id')
+                for row in batch]
+        self.assertEqual(rows, [(1, 'a@example.org'), (2, 'b@example.org')])
+        output = io.StringIO()
+        pool.export('select sysdate from dual', output)
+        self.assertEqual(output.getvalue().splitlines()[0], 'SYSDATE')
+
+    def test_constraint_errors_are_batch_errors(self):
+        site = make_site('acme')
+        with PoolManager(cluster=self.cluster, driver=self.driver) as manager:
+            with BulkWriter(manager, 'insert into cons values (:1, :2)') as writer:
+                writer.write([(site, (1, 'a')), (site, (1, 'b')), (site, (2, 'c'))])
+        self.assertEqual([(error.parameters, error.code) for error in writer.errors],
+                         [((1, 'b'), 1)])
+        self.assertEqual(writer.written, {1: 2})
+
+    def test_unknown_table(self):
+        with self.pool().connection() as connection:
+            with self.assertRaises(self.driver.DatabaseError) as raised:
+                connection.cursor().execute('select * from missing')
+        self.assertEqual(raised.exception.args[0].code, 942)
+
+    def test_injected_failures(self):
+        self.driver.failure_rate = 1.0
+        pool = self.pool()
+        with self.assertRaises(self.driver.DatabaseError):
+            list(pool.stream('select 1 from dual'))
+        self.assertEqual((pool.stats.drops, self.driver.failures), (1, 1))
+
+        self.driver.connect_failure_rate = 1.0
+        pool = self.pool(max=1)
+        for _ in range(2):
+            with self.assertRaises(self.driver.DatabaseError) as raised:
+                pool.get_connection()
+            self.assertEqual(raised.exception.args[0].code, 12170)
+        self.driver.connect_failure_rate = 0.0
+        pool.close_connection(pool.get_connection())
+
+
+class TestAsyncPool(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.cluster = make_cluster()
+        self.driver = StandInDriver(query_latency=0.01,
+                                    rows=lambda user, statement, parameters:
+                                    [(user, number) for number in range(250)])
+
+    async def test_fan_out_stays_within_max(self):
+        sites = [make_site('site{}'.format(number), db=('db103tc', 'db104tc')[number % 2],
+                           site_id=number) for number in range(40)]
+
+        async def count_rows(pool, site):
+            async with pool.connection(site) as connection:
+                return len(await connection.fetchall('select * from site_url'))
+
+        async with AsyncPool(PoolManager(cluster=self.cluster, driver=self.driver,
+                                         max=3)) as pool:
+            counts = await asyncio.gather(*(count_rows(pool, site) for site in sites))
+            self.assertEqual(counts, [250] * 40)
+            for db_pool in pool.pool.pools.values():
+                self.assertLessEqual(db_pool.pool.opened_max, 3)
+                self.assertEqual(db_pool.stats.failures, 0)
+
+    async def test_async_for_streams_rows(self):
+        pool = AsyncPool(SitePool(cluster=self.cluster, driver=self.driver, db='db103tc'))
+        async with pool.connection(make_site('acme')) as connection:
+            rows = [row async for row in connection.rows('select 1 from dual', arraysize=100)]
+        self.assertEqual(rows[-1], ('acme', 249))
+        self.assertEqual(pool.pool.checkouts, {})
+        await pool.close()
+
+    async def test_cancelled_acquire_releases(self):
+        self.driver.connect_latency = 0.05
+        pool = AsyncPool(ConvioPool(cluster=self.cluster, driver=self.driver, db='db103tc'))
+        closed_on = list()
+        close_connection = pool.pool.close_connection
+
+        def record_close(*args):
+            closed_on.append(threading.current_thread())
+            return close_connection(*args)
 
+        pool.pool.close_connection = record_close
+        task = asyncio.ensure_future(pool.acquire())
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        await asyncio.sleep(0.08)
+        self.assertEqual(pool.pool.checkouts, {})
+        # The abandoned connection is closed on the executor rather than the event loop
+        self.assertEqual(len(closed_on), 1)
+        self.assertIsNot(closed_on[0], threading.current_thread())
+        async with pool.connection():
+            pass
+        await pool.close()
 
 
+if __name__ == '__main__':
+    unittest.main()
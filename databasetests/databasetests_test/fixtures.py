@@ -0,0 +1,7 @@
+"""Fixtures shared by the tests in this package."""
+
+SITE_VERSION = """# site_id,short,domain,version,db
+3701,jdrf3,www.jdrf.org,23.4,db103tc
+1234,acme,acme.example.org,23.5,db104tc
+42,answer,answer.example.org,23.4,db103tc
+"""
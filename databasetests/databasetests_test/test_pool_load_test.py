@@ -0,0 +1,37 @@
+import unittest
+
+import pool_load_test
+
+
+class TestPoolLoadTest(unittest.TestCase):
+    def test_query_test_scenario(self):
+        results, exhausted = pool_load_test.run_query_test(out=lambda result: None)
+        self.assertTrue(exhausted)
+        self.assertEqual([result[0][:6] for result in results],
+                         ['cur{}: '.format(number) for number in range(1, 7)])
+
+    def test_level_beyond_max_is_exhausted(self):
+        level = pool_load_test.run_level(4, 0.2, max=2, query_latency=0.005, database=':memory:')
+        self.assertGreater(level['queries'], 0)
+        self.assertGreater(level['exhausted'], 0)
+        self.assertEqual((level['errors'], level['opened_max']), (0, 2))
+
+    def test_broken_sessions_are_dropped(self):
+        level = pool_load_test.run_level(2, 0.2, max=2, timeout=1, database=':memory:',
+                                         failure_rate=0.2, seed=3)
+        self.assertGreater(level['failures_injected'], 0)
+        self.assertEqual(level['errors'], level['failures_injected'])
+        self.assertEqual(level['drops'], level['failures_injected'])
+
+    def test_contention_reports_each_class(self):
+        results = pool_load_test.run_contention(threads=4, duration=0.2, max=1, interactive=0.5,
+                                                query_latency=0.002, think=0.001)
+        for mode in ('driver', 'fair'):
+            self.assertEqual(sorted(results['pools'][mode]), ['batch', 'interactive'])
+        fair = results['pools']['fair']
+        self.assertGreater(fair['interactive']['acquires'], 0)
+        self.assertLessEqual(fair['interactive']['p50'], fair['interactive']['p99'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import json
+import os
+import tempfile
+import unittest
+
+import site_data_scan
+import utils
+
+from .fixtures import SITE_VERSION
+
+
+class TestSiteDataScan(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        site_version = os.path.join(self.tmpdir.name, 'site_version.csv')
+        with open(site_version, 'w') as file:
+            file.write(SITE_VERSION)
+        self.site_data = os.path.join(self.tmpdir.name, 'site_data')
+        self.sitelist = utils.SiteList(all=True, site_version=site_version,
+                                       site_data_dir=self.site_data)
+        # jdrf3 has a nested tree, acme a single file and answer no site_data directory at all
+        self.write_file(3701, 'a.txt', 10)
+        self.write_file(3701, 'images/b.png', 300)
+        self.write_file(3701, 'images/thumbs/c.png', 20)
+        self.write_file(1234, 'd.txt', 5)
+        self.checkpoint = os.path.join(self.tmpdir.name, 'usage.jsonl')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write_file(self, site_id, name, size):
+        path = os.path.join(self.sitelist.idkey[site_id].site_data_dir(), name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as file:
+            file.write(b'x' * size)
+        return path
+
+    def test_scan_site(self):
+        usage = site_data_scan.scan_site(self.sitelist.shortkey['jdrf3'], top=2)
+        self.assertEqual(usage.path, os.path.join(self.site_data, '701', '00003701'))
+        self.assertEqual((usage.files, usage.bytes), (3, 330))
+        self.assertEqual([size for size, path in usage.largest], [300, 20])
+        self.assertTrue(usage.largest[0][1].endswith('b.png'))
+        self.assertEqual(usage.errors, [])
+
+    def test_missing_directory_is_an_error(self):
+        usage = site_data_scan.scan_site(self.sitelist.shortkey['answer'])
+        self.assertEqual((usage.files, usage.bytes), (0, 0))
+        self.assertEqual(len(usage.errors), 1)
+
+    def test_scan_sites_saves_checkpoint(self):
+        results = {usage.short: usage for usage in
+                   site_data_scan.scan_sites(self.sitelist, workers=2,
+                                             checkpoint=self.checkpoint)}
+        self.assertEqual(sorted(results), ['acme', 'answer', 'jdrf3'])
+        self.assertEqual(results['acme'].bytes, 5)
+        with open(self.checkpoint) as file:
+            saved = [site_data_scan.SiteUsage.from_json(line) for line in file]
+        self.assertEqual(sorted(usage.site_id for usage in saved), [42, 1234, 3701])
+        self.assertEqual({usage.site_id: usage.bytes for usage in saved}[3701], 330)
+
+    def test_resume_skips_saved_sites(self):
+        with open(self.checkpoint, 'w') as file:
+            file.write(site_data_scan.SiteUsage(site_id=3701, short='jdrf3').to_json() + '\n')
+            # A line cut short by an interrupted scan is scanned again
+            file.write(json.dumps({'site_id': 1234})[:-3])
+        scanned = [usage.site_id for usage in
+                   site_data_scan.scan_sites(self.sitelist, checkpoint=self.checkpoint)]
+        self.assertEqual(sorted(scanned), [42, 1234])
+        # answer has no site_data directory so its scan failed and is not done
+        self.assertEqual(site_data_scan.load_checkpoint(self.checkpoint), {1234, 3701})
+
+    def test_resume_retries_failed_sites(self):
+        with open(self.checkpoint, 'w') as file:
+            for site_id, short in ((3701, 'jdrf3'), (1234, 'acme')):
+                file.write(site_data_scan.SiteUsage(site_id=site_id, short=short,
+                                                    errors=['pool error']).to_json() + '\n')
+            file.write(site_data_scan.SiteUsage(site_id=1234, short='acme').to_json() + '\n')
+        scanned = {usage.site_id: usage for usage in
+                   site_data_scan.scan_sites(self.sitelist, checkpoint=self.checkpoint)}
+        # acme failed once then was saved without errors so only jdrf3 and answer run
+        self.assertEqual(sorted(scanned), [42, 3701])
+        self.assertEqual((scanned[3701].bytes, scanned[3701].errors), (330, []))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,545 @@
+import os
+import tempfile
+import sys
+import threading
+import time
+import unittest
+
+import utils
+
+from .fixtures import SITE_VERSION
+
+
+def double_site_id(site):
+    # Module level so process pools can pickle it
+    return site.site_id * 2
+
+
+class TestCluster(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.prod_file = os.path.join(self.tmpdir.name, '.production')
+        self.db_file = os.path.join(self.tmpdir.name, 'databases.csv')
+        self.write(self.prod_file, 'tc\n')
+        self.write(self.db_file, '1,db103tc,\n2,db104tc,\n')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, path, contents):
+        stat = os.stat(path) if os.path.exists(path) else None
+        with open(path, 'w') as file:
+            file.write(contents)
+        if stat is not None:
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    def test_db_set(self):
+        cluster = utils.Cluster(prod_file=self.prod_file, db_file=self.db_file)
+        self.assertEqual(cluster.db_set, frozenset(['db103tc', 'db104tc']))
+        self.assertEqual(cluster.db_list, ['db103tc', 'db104tc'])
+
+    def test_get_is_shared_until_a_file_changes(self):
+        cluster = utils.Cluster.get(prod_file=self.prod_file, db_file=self.db_file)
+        self.assertIs(utils.Cluster.get(prod_file=self.prod_file, db_file=self.db_file), cluster)
+        self.assertEqual(cluster.db_list, ('db103tc', 'db104tc'))
+        self.assertRaises(AttributeError, setattr, cluster, 'is_prod', True)
+
+        self.write(self.db_file, '1,db103tc,\n2,db104tc,\n3,db105tc,\n')
+        changed = utils.Cluster.get(prod_file=self.prod_file, db_file=self.db_file)
+        self.assertIsNot(changed, cluster)
+        self.assertIn('db105tc', changed.db_set)
+        self.assertNotIn('db105tc', cluster.db_set)
+
+
+class SiteListTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.site_version = self.write_file('site_version.csv', SITE_VERSION)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write_file(self, name, contents):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, 'w') as file:
+            file.write(contents)
+        return path
+
+
+class TestSiteListLoading(SiteListTestCase):
+    def test_all(self):
+        sitelist = utils.SiteList(all=True, site_version=self.site_version)
+        self.assertEqual(len(sitelist), 3)
+        self.assertEqual([site.site_id for site in sitelist], [3701, 1234, 42])
+        self.assertEqual(sitelist.shortkey['acme'].site_db, 'db104tc')
+
+    def test_short_subset_keeps_file_order(self):
+        sitelist = utils.SiteList(key='short', sublist=['answer', 'jdrf3'],
+                                  site_version=self.site_version)
+        self.assertEqual([site.short for site in sitelist], ['jdrf3', 'answer'])
+
+    def test_id_subfile(self):
+        subfile = self.write_file('ids.txt', '# ids\n42\n1234\n')
+        sitelist = utils.SiteList(key='id', subfile=subfile, site_version=self.site_version)
+        self.assertEqual(sorted(sitelist.idkey), [42, 1234])
+
+    def test_subset_stops_once_every_key_is_found(self):
+        with open(self.site_version) as csvfile:
+            rows = utils._parse_site_version(csvfile, 'id', {3701})
+            self.assertEqual(next(rows)[1], 'jdrf3')
+            self.assertRaises(StopIteration, next, rows)
+            # Nothing past the matching row was consumed
+            self.assertEqual(csvfile.readline(), '1234,acme,acme.example.org,23.5,db104tc\n')
+
+    def test_subset_with_no_matches(self):
+        self.assertRaises(RuntimeError, utils.SiteList, key='short', sublist=['missing'],
+                          site_version=self.site_version)
+
+    def test_subset_requires_exactly_one_source(self):
+        self.assertRaises(RuntimeError, utils.SiteList, key='short',
+                          site_version=self.site_version)
+
+
+class TestSiteListIndexing(SiteListTestCase):
+    def test_getitem(self):
+        for storage in ('objects', 'columnar'):
+            sitelist = utils.SiteList(all=True, site_version=self.site_version, storage=storage)
+            self.assertEqual(sitelist[0].short, 'jdrf3')
+            self.assertEqual(sitelist[-1].short, 'answer')
+            self.assertEqual(sitelist['acme'].site_id, 1234)
+            self.assertEqual(sitelist['3701'].short, 'jdrf3')
+            self.assertRaises(KeyError, sitelist.__getitem__, 'missing')
+            self.assertRaises(IndexError, sitelist.__getitem__, 3)
+
+
+class TestColumnarSiteList(SiteListTestCase):
+    def test_matches_object_storage(self):
+        objects = utils.SiteList(all=True, site_version=self.site_version)
+        columnar = utils.SiteList(all=True, site_version=self.site_version, storage='columnar')
+        self.assertEqual([str(site) for site in columnar], [str(site) for site in objects])
+        self.assertEqual(sorted(columnar.idkey), sorted(objects.idkey))
+        self.assertEqual(columnar.idkey[42].site_data_dir(), objects.idkey[42].site_data_dir())
+        self.assertEqual(columnar.shortkey['jdrf3'].version, '23.4')
+        self.assertNotIn('missing', columnar.shortkey)
+        self.assertNotIn(7, columnar.idkey)
+
+    def test_subset(self):
+        sitelist = utils.SiteList(key='id', sublist=[42], site_version=self.site_version,
+                                  storage='columnar')
+        self.assertEqual(len(sitelist), 1)
+        self.assertEqual(sitelist.shortkey['answer'].site_db, 'db103tc')
+
+    def test_invalid_storage(self):
+        self.assertRaises(RuntimeError, utils.SiteList, all=True,
+                          site_version=self.site_version, storage='rows')
+
+
+class TestSnapshots(SiteListTestCase):
+    def setUp(self):
+        super().setUp()
+        self.snapshot_dir = os.path.join(self.tmpdir.name, 'snapshots')
+
+    def load(self):
+        return utils.SiteList(all=True, site_version=self.site_version,
+                              snapshot_dir=self.snapshot_dir)
+
+    def test_warm_load_matches_cold_load(self):
+        cold = self.load()
+        self.assertEqual(len(os.listdir(self.snapshot_dir)), 1)
+        warm = self.load()
+        self.assertIsInstance(warm._list.ids, memoryview)
+        self.assertEqual([str(site) for site in warm], [str(site) for site in cold])
+        self.assertEqual(warm['acme'].site_id, 1234)
+        self.assertEqual(warm.idkey[42].short, 'answer')
+
+    def test_rebuilt_when_source_changes(self):
+        self.load()
+        with open(self.site_version, 'a') as file:
+            file.write('7,seven,seven.example.org,24.1,db104tc\n')
+        sitelist = self.load()
+        self.assertEqual(len(sitelist), 4)
+        self.assertEqual(sitelist['seven'].version, '24.1')
+        self.assertEqual(len(self.load()), 4)
+
+    def test_touched_source_reuses_snapshot(self):
+        self.load()
+        stat = os.stat(self.site_version)
+        os.utime(self.site_version, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.assertEqual(len(self.load()), 3)
+        self.assertIsNotNone(utils._read_snapshot(
+            utils._snapshot_path(self.snapshot_dir, 'sitelist', self.site_version),
+            (self.site_version,)))
+
+    def test_corrupt_snapshot_is_rebuilt(self):
+        self.load()
+        snapshot_file = os.path.join(self.snapshot_dir, os.listdir(self.snapshot_dir)[0])
+        with open(snapshot_file, 'wb') as file:
+            file.write(b'garbage')
+        self.assertEqual(len(self.load()), 3)
+        self.assertEqual(len(self.load()), 3)
+
+    def test_cluster(self):
+        prod_file = self.write_file('.production', 'tc\n')
+        db_file = self.write_file('databases.csv', '1,db103tc,\n2,db104tc,\n')
+        for _ in range(2):
+            cluster = utils.Cluster(prod_file=prod_file, db_file=db_file,
+                                    snapshot_dir=self.snapshot_dir)
+            self.assertEqual(cluster.cluster_id, 'tc')
+            self.assertEqual(cluster.cluster_number, 1)
+            self.assertEqual(cluster.db_list, ['db103tc', 'db104tc'])
+        self.write_file('.production', '2\n')
+        self.assertRaises(RuntimeError, utils.Cluster, prod_file=prod_file, db_file=db_file,
+                          snapshot_dir=self.snapshot_dir)
+
+
+class TestRefresh(SiteListTestCase):
+    def rewrite(self, contents):
+        # Bump the mtime explicitly since a rewrite can land in the same mtime tick
+        stat = os.stat(self.site_version)
+        self.write_file('site_version.csv', contents)
+        os.utime(self.site_version, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    def check_refresh(self, **kwargs):
+        sitelist = utils.SiteList(site_version=self.site_version, **kwargs)
+        events = list()
+        sitelist.subscribe(events.append)
+        self.assertEqual(sitelist.refresh(), [])
+
+        self.rewrite(SITE_VERSION.replace('23.5,db104tc', '24.1,db105tc')
+                     + '7,seven,seven.example.org,24.1,db104tc\n')
+        first = sitelist.refresh()
+        self.assertEqual(sorted((change.kind, change.site.short) for change in first),
+                         [('added', 'seven'), ('changed', 'acme')])
+        changed = [change for change in first if change.kind == 'changed'][0]
+        self.assertEqual((changed.previous.version, changed.previous.site_db), ('23.5', 'db104tc'))
+        self.assertEqual(sitelist['acme'].site_db, 'db105tc')
+        self.assertEqual(sitelist.idkey[7].short, 'seven')
+        self.assertEqual(len(sitelist), 4)
+
+        self.rewrite(SITE_VERSION.replace('42,answer,', '42,renamed,'))
+        changes = sitelist.refresh()
+        self.assertEqual(sorted((change.kind, change.site.short) for change in changes),
+                         [('changed', 'acme'), ('changed', 'renamed'), ('removed', 'seven')])
+        self.assertEqual([site.short for site in sitelist], ['jdrf3', 'acme', 'renamed'])
+        self.assertNotIn('answer', sitelist.shortkey)
+        self.assertNotIn(7, sitelist.idkey)
+        self.assertEqual(sitelist['renamed'].site_id, 42)
+        self.assertEqual(events, [first, changes])
+        return sitelist
+
+    def test_objects(self):
+        sitelist = self.check_refresh(all=True)
+        acme = sitelist['acme']
+        self.rewrite(SITE_VERSION.replace('acme.example.org', 'acme.example.com'))
+        sitelist.refresh()
+        # Object storage updates the Site it already handed out
+        self.assertEqual(acme.domain, 'acme.example.com')
+
+    def test_columnar(self):
+        self.check_refresh(all=True, storage='columnar')
+
+    def test_snapshot(self):
+        snapshot_dir = os.path.join(self.tmpdir.name, 'snapshots')
+        utils.SiteList(all=True, site_version=self.site_version, snapshot_dir=snapshot_dir)
+        self.check_refresh(all=True, snapshot_dir=snapshot_dir)
+
+    def test_subset_only_tracks_its_keys(self):
+        sitelist = utils.SiteList(key='short', sublist=['acme', 'seven'],
+                                  site_version=self.site_version)
+        self.rewrite(SITE_VERSION + '7,seven,seven.example.org,24.1,db104tc\n'
+                     '8,eight,eight.example.org,24.1,db104tc\n')
+        self.assertEqual([(change.kind, change.site.short) for change in sitelist.refresh()],
+                         [('added', 'seven')])
+
+    def test_invalid_file_leaves_sitelist_unchanged(self):
+        sitelist = utils.SiteList(all=True, site_version=self.site_version)
+        self.rewrite(SITE_VERSION + 'not,a,valid,row\n')
+        self.assertRaises(RuntimeError, sitelist.refresh)
+        self.assertEqual(len(sitelist), 3)
+
+    def test_watch(self):
+        sitelist = utils.SiteList(all=True, site_version=self.site_version)
+        refreshed = threading.Event()
+        sitelist.subscribe(lambda changes: refreshed.set())
+        watcher = sitelist.watch(interval=0.01)
+        try:
+            self.rewrite(SITE_VERSION + '7,seven,seven.example.org,24.1,db104tc\n')
+            self.assertTrue(refreshed.wait(5))
+        finally:
+            watcher.stop(timeout=5)
+        self.assertFalse(watcher.is_alive())
+        self.assertEqual(sitelist['seven'].site_id, 7)
+
+
+class TestQueries(SiteListTestCase):
+    def check_queries(self, sitelist):
+        self.assertEqual([site.short for site in sitelist.where(site_db='db103tc')],
+                         ['jdrf3', 'answer'])
+        self.assertEqual([site.short for site in sitelist.where(site_db='db103tc',
+                                                                  version='23.4')],
+                         ['jdrf3', 'answer'])
+        self.assertEqual(len(sitelist.where(site_db='db104tc', version='23.4')), 0)
+        self.assertEqual([site.short for site in sitelist.where(version=['23.5', '23.4'])],
+                         ['jdrf3', 'acme', 'answer'])
+        self.assertEqual(sitelist.where(domain='acme.example.org')[0].site_id, 1234)
+        self.assertEqual(sitelist.count(site_db='db103tc'), 2)
+        self.assertEqual(sitelist.counts('site_db'), {'db103tc': 2, 'db104tc': 1})
+        self.assertEqual(sitelist.counts('site_db', version='23.4'), {'db103tc': 2})
+        groups = sitelist.group_by('version')
+        self.assertEqual([site.short for site in groups['23.4']], ['jdrf3', 'answer'])
+        self.assertEqual(groups['23.4'].counts('site_db'), {'db103tc': 2})
+        self.assertEqual(groups['23.4'].where(domain='www.jdrf.org').count(), 1)
+        self.assertRaises(RuntimeError, sitelist.where, short='jdrf3')
+
+    def test_objects(self):
+        sitelist = utils.SiteList(all=True, site_version=self.site_version)
+        self.check_queries(sitelist)
+        # Views hand out the SiteList's own Site objects
+        self.assertIs(sitelist.where(site_db='db104tc')[0], sitelist['acme'])
+
+    def test_columnar(self):
+        self.check_queries(utils.SiteList(all=True, site_version=self.site_version,
+                                          storage='columnar'))
+
+    def test_indexes_follow_refresh(self):
+        for storage in ('objects', 'columnar'):
+            self.write_file('site_version.csv', SITE_VERSION)
+            sitelist = utils.SiteList(all=True, site_version=self.site_version, storage=storage)
+            self.assertEqual(sitelist.counts('site_db'), {'db103tc': 2, 'db104tc': 1})
+            db103tc = sitelist.where(site_db='db103tc')
+            stat = os.stat(self.site_version)
+            self.write_file('site_version.csv', SITE_VERSION.replace('23.4,db103tc\n1234',
+                                                                     '23.4,db104tc\n1234')
+                            + '7,seven,seven.example.org,24.1,db104tc\n')
+            os.utime(self.site_version, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+            sitelist.refresh()
+            self.assertEqual(sitelist.counts('site_db'), {'db103tc': 1, 'db104tc': 3})
+            self.assertEqual([site.short for site in sitelist.where(site_db='db104tc')],
+                             ['jdrf3', 'acme', 'seven'])
+            # Views taken before the refresh keep their rows
+            self.assertEqual(len(db103tc), 2)
+
+
+    def test_removals_keep_storage_and_indexes(self):
+        def rewrite(contents):
+            stat = os.stat(self.site_version)
+            self.write_file('site_version.csv', contents)
+            os.utime(self.site_version, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+        for storage in ('objects', 'columnar'):
+            self.write_file('site_version.csv', SITE_VERSION)
+            sitelist = utils.SiteList(all=True, site_version=self.site_version, storage=storage)
+            self.assertEqual(sitelist.counts('site_db'), {'db103tc': 2, 'db104tc': 1})
+            sites, indexes = sitelist._list, sitelist._indexes.by_attribute
+            versions = sitelist.where(version=['23.4', '23.5'])
+            rewrite(SITE_VERSION.replace('42,answer,', '42,renamed,').replace(
+                '1234,acme,acme.example.org,23.5,db104tc\n', ''))
+            self.assertEqual(sorted((change.kind, change.site.short)
+                                    for change in sitelist.refresh()),
+                             [('changed', 'renamed'), ('removed', 'acme')])
+            # Removed and renamed rows are patched out of the keys and indexes in place
+            self.assertIs(sitelist._list, sites)
+            self.assertIs(sitelist._indexes.by_attribute, indexes)
+            self.assertEqual(sitelist.counts('site_db'), {'db103tc': 2})
+            self.assertEqual([site.short for site in sitelist], ['jdrf3', 'renamed'])
+            self.assertEqual([site.short for site in sitelist.where(site_db='db103tc')],
+                             ['jdrf3', 'renamed'])
+            self.assertEqual((len(sitelist), sitelist['renamed'].site_id), (2, 42))
+            self.assertNotIn('acme', sitelist.shortkey)
+            self.assertNotIn(1234, sitelist.idkey)
+            # Views taken before the refresh keep the removed site
+            self.assertEqual(versions.where(version='23.5').count(), 1)
+
+            rewrite(''.join(SITE_VERSION.splitlines(True)[:2]))
+            sitelist.refresh()
+            # Once removed rows outnumber the rest the storage is compacted
+            self.assertIsNot(sitelist._list, sites)
+            self.assertEqual([site.short for site in sitelist], ['jdrf3'])
+            self.assertEqual(sitelist.counts('site_db'), {'db103tc': 1})
+            self.assertEqual(len(versions), 3)
+
+
+class TestSharedIteration(SiteListTestCase):
+    def test_nested_loops(self):
+        for storage in ('objects', 'columnar'):
+            sitelist = utils.SiteList(all=True, site_version=self.site_version, storage=storage)
+            pairs = [(outer.short, inner.short) for outer in sitelist for inner in sitelist]
+            self.assertEqual(len(pairs), 9)
+
+    def test_slices_and_filters_are_views(self):
+        sitelist = utils.SiteList(all=True, site_version=self.site_version)
+        view = sitelist[1:]
+        self.assertIsInstance(view, utils.SiteListView)
+        self.assertIsInstance(view.rows, range)
+        self.assertEqual([site.short for site in view], ['acme', 'answer'])
+        self.assertIs(view[0], sitelist['acme'])
+        self.assertEqual([site.short for site in view[::-1]], ['answer', 'acme'])
+        filtered = sitelist.filter(lambda site: site.site_id > 1000)
+        self.assertEqual([site.short for site in filtered], ['jdrf3', 'acme'])
+        self.assertEqual(filtered.where(site_db='db104tc').count(), 1)
+        self.assertEqual(len(filtered.filter(lambda site: site.short == 'acme')), 1)
+
+    def test_lookups_while_a_site_is_stored(self):
+        # Looks keys up where a columnar refresh has stored the new site's id but not yet its
+        #     short, as another thread could
+        sitelist = utils.SiteList(all=True, site_version=self.site_version, storage='columnar')
+        shorts = sitelist._list.shorts
+        seen = list()
+
+        def append(value):
+            seen.append((sitelist['acme'].site_id, 'seven' in sitelist.shortkey, len(sitelist)))
+            utils._StringColumn.append(shorts, value)
+
+        shorts.append = append
+        stat = os.stat(self.site_version)
+        self.write_file('site_version.csv',
+                        SITE_VERSION + '7,seven,seven.example.org,24.1,db104tc\n')
+        os.utime(self.site_version, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        sitelist.refresh()
+        self.assertEqual(seen, [(1234, False, 3)])
+        self.assertEqual(sitelist['seven'].site_id, 7)
+
+    def test_concurrent_iteration_during_refresh(self):
+        base = ''.join('{0},site{0},site{0}.example.org,23.4,db10{1}tc\n'.format(site_id,
+                                                                               3 + site_id % 4)
+                       for site_id in range(1, 301))
+        base_ids = range(1, 301)
+        extra = '1000,extra,extra.example.org,24.1,db103tc\n'
+        self.write_file('site_version.csv', base)
+        # Switching threads as often as possible makes lookups land inside a refresh
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        self.addCleanup(sys.setswitchinterval, switch_interval)
+        for storage in ('objects', 'columnar'):
+            sitelist = utils.SiteList(all=True, site_version=self.site_version, storage=storage)
+            stop = threading.Event()
+            failures = list()
+
+            def iterate():
+                while not stop.is_set():
+                    for view in (sitelist, sitelist[10:], sitelist.where(site_db='db103tc')):
+                        ids = [site.site_id for site in view]
+                        if len(ids) != len(set(ids)) or len(ids) < len(base_ids) // 4:
+                            failures.append((storage, 'ids', len(ids)))
+                        # An inner loop must neither end nor restart the outer one. Views keep
+                        #     their sites while the SiteList itself may lose the extra site
+                        minimum = len(ids) - 1 if view is sitelist else len(ids)
+                        outer = 0
+                        for site in view:
+                            outer += 1
+                            if outer <= 3 and len({inner.site_id for inner in view}) < minimum:
+                                failures.append((storage, 'inner', outer))
+                        if view is not sitelist and outer != len(ids):
+                            failures.append((storage, 'outer', outer, len(ids)))
+
+            def look_up():
+                # Keys are looked up while the extra site comes and goes
+                while not stop.is_set():
+                    for site_id in range(1, 301, 13):
+                        short = 'site{}'.format(site_id)
+                        try:
+                            if (sitelist[short].site_id != site_id
+                                    or sitelist.idkey[site_id].short != short
+                                    or sitelist.shortkey[short].site_id != site_id):
+                                failures.append((storage, 'key', site_id))
+                            extra_site = sitelist.shortkey.get('extra')
+                        except Exception as error:
+                            failures.append((storage, 'key', site_id, repr(error)))
+                            return
+                        if extra_site is not None and extra_site.site_id != 1000:
+                            failures.append((storage, 'extra', extra_site.site_id))
+
+            def refresh():
+                for number in range(11):
+                    stat = os.stat(self.site_version)
+                    self.write_file('site_version.csv', base + extra if number % 2 else base)
+                    os.utime(self.site_version, ns=(stat.st_atime_ns,
+                                                    stat.st_mtime_ns + 10**9))
+                    sitelist.refresh()
+
+            threads = [threading.Thread(target=iterate) for _ in range(4)]
+            threads += [threading.Thread(target=look_up) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            refresher = threading.Thread(target=refresh)
+            refresher.start()
+            refresher.join()
+            stop.set()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(failures, [])
+            self.assertEqual(len(sitelist), 300)
+
+
+class TestRun(SiteListTestCase):
+    def setUp(self):
+        super().setUp()
+        self.write_file('site_version.csv', ''.join(
+            '{0},site{0},site{0}.example.org,23.4,db10{1}tc\n'.format(site_id, 3 + site_id % 3)
+            for site_id in range(1, 61)))
+        self.sitelist = utils.SiteList(all=True, site_version=self.site_version)
+
+    def test_per_db_limit(self):
+        lock = threading.Lock()
+        running = {}
+        peaks = {}
+
+        def task(site):
+            with lock:
+                running[site.site_db] = running.get(site.site_db, 0) + 1
+                peaks[site.site_db] = max(peaks.get(site.site_db, 0), running[site.site_db])
+            time.sleep(0.005)
+            with lock:
+                running[site.site_db] -= 1
+            return site.short
+
+        run = self.sitelist.run(task, workers=8, per_db_limit=2)
+        results = list(run)
+        self.assertEqual(sorted(result.value for result in results),
+                         sorted(site.short for site in self.sitelist))
+        self.assertEqual(run.completed, 60)
+        self.assertEqual(max(peaks.values()), 2)
+        self.assertEqual(len(peaks), 3)
+
+    def test_held_back_sites_are_bounded(self):
+        pulled = list()
+        started = list()
+
+        def sites():
+            for site in self.sitelist.where(site_db='db103tc'):
+                pulled.append(site)
+                yield site
+
+        def task(site):
+            started.append(len(pulled))
+            time.sleep(0.001)
+
+        run = utils.SiteRun(sites(), task, workers=4, per_db_limit=1)
+        self.assertEqual(len(list(run)), 20)
+        # Every call starts with no more than the running site and workers held back pulled
+        #     beyond the sites already started
+        self.assertLessEqual(max(count - number for number, count in enumerate(started)), 5)
+
+    def test_errors_do_not_stop_the_run(self):
+        def task(site):
+            if site.site_id % 10 == 0:
+                raise ValueError(site.short)
+            return site.site_id
+
+        run = self.sitelist.where(site_db='db103tc').run(task, workers=4)
+        results = list(run)
+        self.assertEqual(len(results), 20)
+        self.assertEqual(sorted(result.site.site_id for result in run.errors), [30, 60])
+        self.assertIsInstance(run.errors[0].error, ValueError)
+
+    def test_process_pool(self):
+        results = list(self.sitelist[:5].run(double_site_id, workers=2, executor='process'))
+        self.assertEqual(sorted(result.value for result in results), [2, 4, 6, 8, 10])
+
+    def test_invalid_arguments(self):
+        self.assertRaises(RuntimeError, self.sitelist.run, double_site_id, executor='fibers')
+        self.assertRaises(RuntimeError, self.sitelist.run, double_site_id, per_db_limit=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
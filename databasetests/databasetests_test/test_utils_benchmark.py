@@ -0,0 +1,52 @@
+import json
+import os
+import tempfile
+import unittest
+
+import utils
+import utils_benchmark
+
+
+class TestFixtures(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_fixtures_load(self):
+        db_counts = utils_benchmark.gen_fixtures(self.tmpdir.name, 200, seed=1)
+        cluster = utils.Cluster(prod_file=os.path.join(self.tmpdir.name, '.production'),
+                                db_file=os.path.join(self.tmpdir.name, 'databases.csv'))
+        self.assertEqual(sorted(cluster.db_list), sorted(db_counts))
+        sitelist = utils.SiteList(all=True,
+                                  site_version=os.path.join(self.tmpdir.name, 'site_version.csv'))
+        self.assertEqual(len(sitelist), 200)
+        self.assertEqual(sitelist.counts('site_db'),
+                         {db: count for db, count in db_counts.items() if count})
+        self.assertTrue(all(site.site_db in cluster.db_set for site in sitelist))
+
+    def test_seed_repeats_fixtures(self):
+        contents = list()
+        for _ in range(2):
+            utils_benchmark.gen_fixtures(self.tmpdir.name, 50, seed=7)
+            with open(os.path.join(self.tmpdir.name, 'site_version.csv')) as file:
+                contents.append(file.read())
+        self.assertEqual(contents[0], contents[1])
+
+    def test_suite_writes_json(self):
+        output = os.path.join(self.tmpdir.name, 'results.json')
+        utils_benchmark.run_suite(output, sizes=(100,))
+        with open(output) as file:
+            results = json.load(file)
+        self.assertEqual([result['storage'] for result in results['benchmarks']],
+                         ['objects', 'columnar'])
+        for result in results['benchmarks']:
+            self.assertEqual(result['sites'], 100)
+            self.assertGreater(result['peak_memory_bytes'], 0)
+            self.assertLessEqual(result['idkey_lookup_ns']['p50'],
+                                 result['idkey_lookup_ns']['p99'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""Benchmarks for the LO_DB_Pool module run against the stand in driver.
+
+run_stream() measures rows per second fetching and exporting a large result set for a range of
+arraysizes. The stand in sleeps fetch_latency for every round trip, so the numbers show how many
+round trips each arraysize saves rather than real Oracle throughput. The baseline iterates the
+cursor a row at a time with the default arraysize of 100, as lo_db_query_poc.py does.
+
+run_bulk() compares writing rows to site schemas one cursor.execute() at a time against
+BulkWriter's executemany batches, with every round trip costing latency seconds.
+
+run_statements() runs the same statements on a fresh checkout each time with the session statement
+cache off and on, where every statement the session has not cached costs parse_latency seconds to
+prepare. It then times the same loop with no stand in latency, with and without a QueryMetrics
+hook, to show what instrumentation costs per statement.
+
+Usage:
+    python3 pool_benchmark.py [rows] [fetch_latency]
+    python3 pool_benchmark.py bulk [rows] [latency]
+    python3 pool_benchmark.py statements [executions] [parse_latency]
+"""
+
+import io
+import os
+import sys
+import tempfile
+from time import perf_counter
+
+from utils import Cluster, Site
+from LO_DB_Pool.LO_DB_Pool import BulkWriter, ConvioPool, PoolManager, QueryMetrics
+from LO_DB_Pool.stand_in import StandInDriver
+
+ARRAYSIZES = (10, 100, 1000, 5000, 20000)
+
+
+def make_cluster():
+    """Returns a test cluster Cluster with db103tc and db104tc that needs no config files."""
+    return Cluster(prod_file=io.StringIO('tc\n'), db_file=io.StringIO('1,db103tc,\n2,db104tc,\n'))
+
+
+def site_url_rows(count):
+    """Returns a rows function for StandInDriver giving count (prefix, site_id) rows."""
+    rows = [('site{}.example.org/site/'.format(site_id), site_id) for site_id in range(count)]
+    return lambda user, statement, parameters: rows
+
+
+def rate(rows, seconds):
+    return rows / seconds if seconds else float('inf')
+
+
+def run_stream(rows=200000, fetch_latency=0.0005, arraysizes=ARRAYSIZES):
+    driver = StandInDriver(fetch_latency=fetch_latency, rows=site_url_rows(rows))
+    pool = ConvioPool(db='db103tc', cluster=make_cluster(), driver=driver)
+    statement = 'select prefix, site_id from site_url'
+    results = list()
+
+    with pool.connection() as connection:
+        start = perf_counter()
+        count = sum(1 for _ in connection.cursor().execute(statement))
+        results.append(('row at a time', 100, 'iterate', rate(count, perf_counter() - start)))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for arraysize in arraysizes:
+            start = perf_counter()
+            count = sum(len(batch) for batch in pool.stream(statement, arraysize=arraysize))
+            results.append(('stream', arraysize, 'batches', rate(count, perf_counter() - start)))
+            for export_format in ('csv', 'jsonl'):
+                path = os.path.join(tmpdir, 'site_url.' + export_format)
+                with open(path, 'w', newline='') as output:
+                    start = perf_counter()
+                    count = pool.export(statement, output, format=export_format,
+                                        arraysize=arraysize)
+                    results.append(('export', arraysize, export_format,
+                                    rate(count, perf_counter() - start)))
+    pool.close()
+
+    for name, arraysize, mode, rows_per_second in results:
+        print('{:<14} arraysize {:>6} {:<8} {:>12.0f} rows/s'.format(name, arraysize, mode,
+                                                                    rows_per_second))
+    return results
+
+
+def make_sites(count, db_list=('db103tc', 'db104tc')):
+    """Returns count Sites spread evenly over db_list."""
+    return [Site(site_id=site_id, short='site' + str(site_id),
+                 domain='site{}.example.org'.format(site_id), version='23.4',
+                 db=db_list[site_id % len(db_list)], site_data_dir='/tmp')
+            for site_id in range(1, count + 1)]
+
+
+def run_bulk(rows=20000, latency=0.0005, sites=20, batch_sizes=(100, 1000), commit_interval=5):
+    statement = 'update cons set email = :2 where cons_id = :1'
+    site_list = make_sites(sites)
+    parameters = [(site, (number, 'user{}@example.org'.format(number)))
+                  for number in range(rows // sites) for site in site_list]
+    results = list()
+
+    # One execute per row and a commit per site, the way data fixes are written today
+    driver = StandInDriver(query_latency=latency)
+    with PoolManager(cluster=make_cluster(), driver=driver, max=4) as manager:
+        start = perf_counter()
+        for site in site_list:
+            with manager.connection(site) as connection:
+                cursor = connection.cursor()
+                for row_site, row in parameters:
+                    if row_site is site:
+                        cursor.execute(statement, row)
+                connection.commit()
+        results.append(('row at a time', 1, perf_counter() - start))
+
+    for batch_size in batch_sizes:
+        driver = StandInDriver(query_latency=latency)
+        with PoolManager(cluster=make_cluster(), driver=driver, max=4) as manager:
+            start = perf_counter()
+            with BulkWriter(manager, statement, batch_size=batch_size,
+                            commit_interval=commit_interval) as writer:
+                writer.write(parameters)
+            results.append(('executemany', batch_size, perf_counter() - start))
+
+    for name, batch_size, seconds in results:
+        print('{:<14} batch_size {:>6} {:>8.3f}s {:>12.0f} rows/s'.format(
+            name, batch_size, seconds, rate(len(parameters), seconds)))
+    return results
+
+
+def run_checkouts(pool, statements, executions):
+    # Seconds taken running executions statements, each on its own checkout
+    start = perf_counter()
+    for number in range(executions):
+        with pool.connection() as connection:
+            pool.cursor(connection).execute(statements[number % len(statements)]).fetchall()
+    return perf_counter() - start
+
+
+def run_statements(executions=2000, parse_latency=0.001, query_latency=0.0001):
+    statements = ['select prefix, site_id from site_url where site_id = {}'.format(number)
+                  for number in range(10)]
+    results = list()
+
+    for stmtcachesize in (0, 20):
+        driver = StandInDriver(query_latency=query_latency, parse_latency=parse_latency,
+                               rows=site_url_rows(10))
+        pool = ConvioPool(db='db103tc', cluster=make_cluster(), driver=driver,
+                          stmtcachesize=stmtcachesize)
+        seconds = run_checkouts(pool, statements, executions)
+        pool.close()
+        results.append(('stmtcachesize {}'.format(stmtcachesize), seconds, driver.prepares))
+
+    for hooks in ([], [QueryMetrics()]):
+        pool = ConvioPool(db='db103tc', cluster=make_cluster(), hooks=hooks,
+                          driver=StandInDriver(rows=site_url_rows(10)))
+        seconds = run_checkouts(pool, statements, executions)
+        pool.close()
+        results.append(('hooks' if hooks else 'no hooks', seconds, None))
+
+    for name, seconds, prepares in results:
+        print('{:<16} {:>8.3f}s {:>8.1f}us/statement {:>8} prepares'.format(
+            name, seconds, seconds / executions * 1000000, '-' if prepares is None else prepares))
+    return results
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['bulk']:
+        run_bulk(int(sys.argv[2]) if len(sys.argv) > 2 else 20000,
+                 float(sys.argv[3]) if len(sys.argv) > 3 else 0.0005)
+    elif sys.argv[1:2] == ['statements']:
+        run_statements(int(sys.argv[2]) if len(sys.argv) > 2 else 2000,
+                       float(sys.argv[3]) if len(sys.argv) > 3 else 0.001)
+    else:
+        run_stream(int(sys.argv[1]) if len(sys.argv) > 1 else 200000,
+                   float(sys.argv[2]) if len(sys.argv) > 2 else 0.0005)
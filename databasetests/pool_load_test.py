@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""Load tests of LO_DB_Pool pools run offline against the stand in driver.
+
+run_query_test() repeats what query_test.py does against a live Oracle instance: it acquires every
+connection of a pool with a max of 5, runs a query on each, finds the pool exhausted when it asks
+for a sixth, then releases one and acquires again. Statements run on a sqlite3 database, so the
+query_test.py statements selecting sysdate from dual run as they are.
+
+run_load() raises the number of threads sharing one pool level by level. Each thread acquires a
+connection, runs a statement, fetches its rows and releases the connection until duration runs
+out. Every level reports throughput, how long acquires waited and how often the pool was
+exhausted, which shows where adding threads stops adding throughput.
+
+run_contention() measures acquire wait tail latency with more threads than connections, some of
+them interactive and the rest batch. It compares a pool whose session pool makes acquires wait
+with a fair pool, where waiters are served in order and interactive ones first.
+
+Usage:
+    python3 pool_load_test.py [query_test]
+    python3 pool_load_test.py load [output.json] [max] [timeout]
+    python3 pool_load_test.py contention [output.json] [threads] [max]
+"""
+
+import json
+import sys
+import threading
+import time
+from time import perf_counter
+
+from pool_benchmark import make_cluster, rate
+from LO_DB_Pool.LO_DB_Pool import PRIORITY_BATCH, PRIORITY_INTERACTIVE, ConvioPool, _is_exhausted
+from LO_DB_Pool.stand_in import StandInDriver
+
+CONCURRENCY = (1, 2, 5, 10, 20, 50)
+LOAD_STATEMENT = "select 'load: ' || sysdate from dual"
+
+
+def run_query_test(driver=None, out=print):
+    """Runs the query_test.py scenario, returning the rows each cursor fetched and whether the
+    sixth acquire found the pool exhausted."""
+    driver = driver or StandInDriver(database=':memory:')
+    pool = ConvioPool(db='db103tc', cluster=make_cluster(), driver=driver, min=2, max=5)
+    results = list()
+    exhausted = False
+    try:
+        connections = [pool.get_connection() for _ in range(5)]
+        for number, connection in enumerate(connections, 1):
+            statement = "select 'cur{}: ' || sysdate from dual".format(number)
+            for result in connection.cursor().execute(statement):
+                out(result)
+                results.append(result)
+
+        try:
+            connections.append(pool.get_connection())
+        except driver.DatabaseError as error:
+            exhausted = _is_exhausted(error)
+            pool.close_connection(connections.pop())
+            connections.append(pool.get_connection())
+            for result in connections[-1].cursor().execute("select 'cur6: ' || sysdate from dual"):
+                out(result)
+                results.append(result)
+
+        for connection in connections:
+            pool.close_connection(connection)
+    finally:
+        pool.close(force=True)
+    return results, exhausted
+
+
+def run_level(threads, duration=1.0, max=5, timeout=None, statement=LOAD_STATEMENT,
+              **driver_kwargs):
+    """Runs threads threads against one pool for duration seconds and returns a dictionary of the
+    queries run, their rate, the waits of the acquires that succeeded in milliseconds, and counts of
+    acquires that found the pool exhausted and of other failures. driver_kwargs are passed on to
+    StandInDriver, e.g. failure_rate to see how broken sessions are dropped under load."""
+    driver = StandInDriver(**driver_kwargs)
+    pool = ConvioPool(db='db103tc', cluster=make_cluster(), driver=driver, max=max,
+                      timeout=timeout)
+    lock = threading.Lock()
+    totals = {'queries': 0, 'exhausted': 0, 'errors': 0}
+    waits = list()
+    start = perf_counter()
+    deadline = start + duration
+
+    def worker():
+        counts = {'queries': 0, 'exhausted': 0, 'errors': 0}
+        thread_waits = list()
+        while perf_counter() < deadline:
+            acquire_start = perf_counter()
+            try:
+                checkout = pool.connection()
+            except driver.DatabaseError as error:
+                if _is_exhausted(error):
+                    counts['exhausted'] += 1
+                else:
+                    counts['errors'] += 1
+                continue
+            thread_waits.append(perf_counter() - acquire_start)
+            try:
+                with checkout as connection:
+                    pool.cursor(connection).execute(statement).fetchall()
+                counts['queries'] += 1
+            except driver.DatabaseError:
+                counts['errors'] += 1
+        with lock:
+            for key, value in counts.items():
+                totals[key] += value
+            waits.extend(thread_waits)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    seconds = perf_counter() - start
+    statistics = pool.statistics()
+    pool.close(force=True)
+    driver.close()
+
+    waits.sort()
+    return {'threads': threads, 'seconds': seconds, 'queries': totals['queries'],
+            'queries_per_second': rate(totals['queries'], seconds),
+            'wait_ms': {'p50': _percentile(waits, 0.5) * 1000,
+                        'p99': _percentile(waits, 0.99) * 1000,
+                        'max': waits[-1] * 1000 if waits else 0.0},
+            'exhausted': totals['exhausted'], 'errors': totals['errors'],
+            'drops': statistics['drops'], 'opened_max': driver.pools[0].opened_max,
+            'failures_injected': driver.failures}
+
+
+def run_load(output=None, concurrency=CONCURRENCY, duration=1.0, max=5, timeout=0.05,
+             query_latency=0.005, database=':memory:', **driver_kwargs):
+    """Runs run_level() for every number of threads in concurrency, printing a line per level and
+    writing the results as JSON to output when given. By default acquires wait up to timeout
+    seconds for a free connection, pass timeout=None to fail at once as query_test.py does."""
+    levels = list()
+    for threads in concurrency:
+        level = run_level(threads, duration, max=max, timeout=timeout,
+                          query_latency=query_latency, database=database, **driver_kwargs)
+        levels.append(level)
+        print('{:>4} threads {:>8.0f} queries/s  wait p50 {:>7.2f}ms p99 {:>7.2f}ms  '
+              'exhausted {:>6}  errors {:>4}'.format(
+                  threads, level['queries_per_second'], level['wait_ms']['p50'],
+                  level['wait_ms']['p99'], level['exhausted'], level['errors']))
+
+    results = {'max': max, 'timeout': timeout, 'query_latency': query_latency,
+               'duration': duration, 'levels': levels}
+    if output is not None:
+        with open(output, 'w') as file:
+            json.dump(results, file, indent=2)
+    return results
+
+
+def run_contention(output=None, threads=20, duration=2.0, max=4, interactive=0.2, timeout=1.0,
+                   query_latency=0.005, think=0.005):
+    """Runs threads threads, the interactive fraction of them acquiring as PRIORITY_INTERACTIVE,
+    against a driver waiting pool and a fair pool, each for duration seconds with up to timeout
+    seconds per acquire. Each thread sleeps think seconds between connections. Prints and returns
+    the acquire wait percentiles in milliseconds of each class, writing them as JSON to output
+    when given."""
+    interactive_threads = int(round(threads * interactive))
+    results = {'threads': threads, 'max': max, 'interactive': interactive_threads,
+               'timeout': timeout, 'query_latency': query_latency, 'think': think, 'pools': {}}
+
+    for mode in ('driver', 'fair'):
+        driver = StandInDriver(query_latency=query_latency)
+        pool = ConvioPool(db='db103tc', cluster=make_cluster(), driver=driver, max=max,
+                          timeout=timeout, fair=mode == 'fair')
+        lock = threading.Lock()
+        waits = {'interactive': list(), 'batch': list()}
+        timeouts = {'interactive': 0, 'batch': 0}
+        deadline = perf_counter() + duration
+
+        def worker(name, priority):
+            thread_waits = list()
+            thread_timeouts = 0
+            while perf_counter() < deadline:
+                start = perf_counter()
+                try:
+                    checkout = pool.connection(priority=priority)
+                except (TimeoutError, driver.DatabaseError):
+                    thread_timeouts += 1
+                    continue
+                thread_waits.append(perf_counter() - start)
+                with checkout as connection:
+                    pool.cursor(connection).execute('select 1 from dual')
+                time.sleep(think)
+            with lock:
+                waits[name].extend(thread_waits)
+                timeouts[name] += thread_timeouts
+
+        workers = [threading.Thread(target=worker, args=('interactive', PRIORITY_INTERACTIVE)
+                                    if number < interactive_threads else ('batch', PRIORITY_BATCH))
+                   for number in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        pool.close(force=True)
+
+        classes = {}
+        for name, values in waits.items():
+            values.sort()
+            classes[name] = {'acquires': len(values), 'timeouts': timeouts[name],
+                             'p50': _percentile(values, 0.5) * 1000,
+                             'p99': _percentile(values, 0.99) * 1000,
+                             'max': values[-1] * 1000 if values else 0.0}
+            print('{:<6} {:<11} {:>7} acquires  wait p50 {:>8.2f}ms p99 {:>8.2f}ms '
+                  'max {:>8.2f}ms  timeouts {:>4}'.format(
+                      mode, name, len(values), classes[name]['p50'], classes[name]['p99'],
+                      classes[name]['max'], timeouts[name]))
+        results['pools'][mode] = classes
+
+    if output is not None:
+        with open(output, 'w') as file:
+            json.dump(results, file, indent=2)
+    return results
+
+
+def _percentile(values, fraction):
+    # Value fraction of the way through the sorted list values
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['load']:
+        run_load(sys.argv[2] if len(sys.argv) > 2 else None,
+                 max=int(sys.argv[3]) if len(sys.argv) > 3 else 5,
+                 timeout=float(sys.argv[4]) if len(sys.argv) > 4 else 0.05)
+    elif sys.argv[1:2] == ['contention']:
+        run_contention(sys.argv[2] if len(sys.argv) > 2 else None,
+                       threads=int(sys.argv[3]) if len(sys.argv) > 3 else 20,
+                       max=int(sys.argv[4]) if len(sys.argv) > 4 else 4)
+    else:
+        run_query_test()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""Disk usage and inventory scanner for Luminate site_data directories.
+
+Walks the site_data directory of every Site in a SiteList (see Site.site_data_dir) concurrently on a
+bounded thread pool and streams back per-site file counts, byte totals and largest files. Results
+can be appended to a JSON lines file as they arrive, and a scan that was interrupted resumes by
+skipping the sites already in that file.
+
+Examples:
+    scan every site and save the results as they complete
+        for usage in scan_sites(utils.SiteList(all=True), checkpoint='/var/tmp/usage.jsonl'):
+            print(usage.short, usage.bytes)
+    from the command line, rerunning the same command resumes an interrupted scan
+        python3 site_data_scan.py /var/tmp/usage.jsonl [workers]
+"""
+
+import heapq
+import json
+import os
+import stat
+import sys
+from functools import partial
+from time import perf_counter
+
+from utils import SiteList
+
+
+class SiteUsage:
+    """This class represents the disk usage of one site's site_data directory.
+
+    Attributes:
+        site_id: numeric identifier for the site e.g. 3701
+        short: string for the site's short name e.g. 'jdrf3'
+        path: the site_data directory that was scanned
+        files: number of regular files found
+        bytes: total size in bytes of the regular files found
+        largest: list of [bytes, path] for the largest files, biggest first
+        errors: list of strings describing directories or files that could not be read
+        seconds: how long the scan took
+    """
+    __slots__ = ('site_id', 'short', 'path', 'files', 'bytes', 'largest', 'errors', 'seconds')
+
+    def __init__(self, site_id=None, short=None, path=None, files=0, bytes=0, largest=None,
+                 errors=None, seconds=0.0):
+        self.site_id = site_id
+        self.short = short
+        self.path = path
+        self.files = files
+        self.bytes = bytes
+        self.largest = largest if largest is not None else list()
+        self.errors = errors if errors is not None else list()
+        self.seconds = seconds
+
+    def to_json(self):
+        """Returns the usage as a single line of JSON."""
+        return json.dumps({name: getattr(self, name) for name in self.__slots__})
+
+    @classmethod
+    def from_json(cls, line):
+        """Returns a SiteUsage from a line written by to_json()."""
+        return cls(**json.loads(line))
+
+
+def scan_site(site, top=10):
+    """Returns a SiteUsage for site's site_data directory, keeping the top largest files.
+
+    Symbolic links are not followed. A missing site_data directory or unreadable entries are
+    reported in errors rather than raised."""
+    start = perf_counter()
+    usage = SiteUsage(site_id=site.site_id, short=site.short, path=site.site_data_dir())
+    largest = list()  # min heap of (bytes, path) holding the top largest files
+    pending = [usage.path]
+    while pending:
+        directory = pending.pop()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        info = entry.stat(follow_symlinks=False)
+                    except OSError as error:
+                        usage.errors.append('{}: {}'.format(entry.path, error.strerror))
+                        continue
+                    if stat.S_ISDIR(info.st_mode):
+                        pending.append(entry.path)
+                    elif stat.S_ISREG(info.st_mode):
+                        usage.files += 1
+                        usage.bytes += info.st_size
+                        if len(largest) < top:
+                            heapq.heappush(largest, (info.st_size, entry.path))
+                        elif top and info.st_size > largest[0][0]:
+                            heapq.heapreplace(largest, (info.st_size, entry.path))
+        except OSError as error:
+            usage.errors.append('{}: {}'.format(directory, error.strerror))
+
+    usage.largest = [[size, path] for size, path in sorted(largest, reverse=True)]
+    usage.seconds = perf_counter() - start
+    return usage
+
+
+def load_checkpoint(checkpoint):
+    """Returns the set of site_ids saved in a checkpoint file without errors, empty if it does not
+    exist.
+
+    Sites whose last saved scan has errors are left out so they are scanned again, as is the site
+    of a partly written last line from an interrupted scan."""
+    done = set()
+    try:
+        with open(checkpoint, 'r') as input_file:
+            for line in input_file:
+                try:
+                    saved = json.loads(line)
+                    site_id = saved['site_id']
+                except (ValueError, KeyError):
+                    continue
+                if saved.get('errors'):
+                    done.discard(site_id)
+                else:
+                    done.add(site_id)
+    except FileNotFoundError:
+        pass
+    return done
+
+
+def scan_sites(sites, workers=8, top=10, checkpoint=None):
+    """Generator that scans the site_data directory of every site in sites, a SiteList or
+    SiteListView, and yields a SiteUsage for each as it completes.
+
+    workers bounds the number of directories walked at once. When checkpoint is given sites
+    already saved in it without errors are skipped and every new SiteUsage is appended to it as a
+    line of JSON before it is yielded."""
+    output_file = None
+    if checkpoint is not None:
+        done = load_checkpoint(checkpoint)
+        if done:
+            sites = sites.filter(lambda site: site.site_id not in done)
+        output_file = open(checkpoint, 'a')
+        if output_file.tell() and not _ends_with_newline(checkpoint):
+            # Finish the line an interrupted scan was writing so it stays on its own
+            output_file.write('\n')
+    try:
+        for result in sites.run(partial(scan_site, top=top), workers=workers):
+            usage = result.value
+            if result.error is not None:
+                usage = SiteUsage(site_id=result.site.site_id, short=result.site.short,
+                                  path=result.site.site_data_dir(),
+                                  errors=[repr(result.error)], seconds=result.seconds)
+            if output_file is not None:
+                output_file.write(usage.to_json() + '\n')
+                output_file.flush()
+            yield usage
+    finally:
+        if output_file is not None:
+            output_file.close()
+
+
+def _ends_with_newline(path):
+    with open(path, 'rb') as input_file:
+        input_file.seek(-1, os.SEEK_END)
+        return input_file.read(1) == b'\n'
+
+
+if __name__ == "__main__":
+    # python3 site_data_scan.py [checkpoint] [workers]
+    sitelist = SiteList(all=True)
+    for site_usage in scan_sites(sitelist, workers=int(sys.argv[2]) if len(sys.argv) > 2 else 8,
+                                 checkpoint=sys.argv[1] if len(sys.argv) > 1 else None):
+        print('{:>10} {:<20} {:>10} files {:>16} bytes'.format(
+            site_usage.site_id, site_usage.short, site_usage.files, site_usage.bytes))
@@ -7,6 +7,8 @@ Classes:
              Examples:
                  is the cluster a production cluster cluster.is_prod
                  what is the list of DB's in the cluster cluster.db_list
+                 is a DB in the cluster 'db103tc' in cluster.db_set
+                 get the shared Cluster for the default config files utils.Cluster.get()
     Site: Used for site specific data and operations.
           Examples:
               what DB is the site hosted on site.site_db
@@ -17,9 +19,31 @@ Classes:
                       utils.SiteList(key='cluster_id', sublist=somelist)
                   create SiteList of sites with the contents of a file containing short names
                       utils.SiteList(key='short', subfile='/some/path/to/file.txt')
+                  create SiteList of all sites from a snapshot that is rebuilt when needed
+                      utils.SiteList(all=True, snapshot_dir=utils.SNAPSHOT_DIR)
+                  all sites on db103tc running version 23.4
+                      sitelist.where(site_db='db103tc', version='23.4')
+                  number of sites on each DB
+                      sitelist.counts('site_db')
+                  run a function for every site, at most 2 at a time per DB
+                      for result in sitelist.run(check_site, workers=16, per_db_limit=2):
+                          print(result.site.short, result.value)
 """
 
+import hashlib
+import json
+import mmap
 import os
+import struct
+import sys
+import tempfile
+import threading
+from array import array
+from bisect import bisect_left, insort
+from collections import deque
+from collections.abc import Mapping, Sequence
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from time import perf_counter
 from pathlib import Path
 
 # TODO Add LOGGER for logging to this module similar to what we have in robots_tool.py
@@ -28,6 +52,9 @@ from pathlib import Path
 #      Server list, SB Systems, LWS, FTP, etc.
 
 CLUSTER_IDS = {'tc': 1, 'itc': 8, 2: 2, 3: 3}
+SNAPSHOT_DIR = '/var/tmp/convio_snapshots'
+SNAPSHOT_MAGIC = b'LOSNAP01'
+INDEXED_ATTRIBUTES = ('site_db', 'version', 'domain')
 
 
 class Cluster:
@@ -38,23 +65,81 @@ class Cluster:
         cluster_number: is the numeric identifier for the cluster e.g. 1 for tc, 8 for itc, 2 for 2
         is_prod: is a boolean indicating if the cluster is a production cluster (Only 2 or 3)
         db_list: list containing SID's for the DB servers in the cluster e.g. ['db103tc, 'db104tc']
+        db_set: frozenset of the SID's in db_list for membership checks
+
+    When snapshot_dir is given and prod_file and db_file are paths the parsed values are kept in a
+    snapshot file under snapshot_dir that is reused until either source file changes.
+
+    Cluster.get() returns a shared Cluster per pair of config files that is only parsed again when
+    one of the files changes. Shared Clusters cannot be changed and their db_list is a tuple.
     """
+    _registry = {}  # (prod_file, db_file) to ((prod_file stat), (db_file stat), Cluster)
+    _registry_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, prod_file='/etc/convio/conf/.production',
+            db_file='/etc/convio/conf/databases.csv', snapshot_dir=None):
+        """Returns the shared Cluster for prod_file and db_file, creating it the first time and
+        again whenever either file's mtime or size changes.
+
+        File like objects cannot be checked for changes so they always get a new Cluster."""
+        if not (_is_path(prod_file) and _is_path(db_file)):
+            return cls(prod_file=prod_file, db_file=db_file, snapshot_dir=snapshot_dir)
+
+        key = (os.path.abspath(os.fspath(prod_file)), os.path.abspath(os.fspath(db_file)))
+        try:
+            stamps = tuple((stat.st_mtime_ns, stat.st_size)
+                           for stat in (os.stat(key[0]), os.stat(key[1])))
+        except OSError:
+            # Let Cluster report the unreadable file
+            return cls(prod_file=prod_file, db_file=db_file, snapshot_dir=snapshot_dir)
+
+        entry = cls._registry.get(key)
+        if entry is not None and entry[0] == stamps:
+            return entry[1]
+        with cls._registry_lock:
+            entry = cls._registry.get(key)
+            if entry is None or entry[0] != stamps:
+                cluster = cls(prod_file=prod_file, db_file=db_file, snapshot_dir=snapshot_dir)
+                cluster._freeze()
+                entry = cls._registry[key] = (stamps, cluster)
+        return entry[1]
+
     def __init__(self, prod_file='/etc/convio/conf/.production',
-                 db_file='/etc/convio/conf/databases.csv'):
+                 db_file='/etc/convio/conf/databases.csv', snapshot_dir=None):
+        self._frozen = False
         self.cluster_id = None
         self.is_prod = None
         self.db_list = list()
+        self.db_set = frozenset()
         self.cluster_number = None
 
+        snapshot = None
+        if snapshot_dir is not None and _is_path(prod_file) and _is_path(db_file):
+            snapshot_file = _snapshot_path(snapshot_dir, 'cluster', prod_file, db_file)
+            snapshot = _read_snapshot(snapshot_file, (prod_file, db_file))
+            if not snapshot:
+                # Stamp the sources before parsing them so a change made while we parse is noticed
+                # by the next load
+                try:
+                    stamps = [_read_source(prod_file)[0], _read_source(db_file)[0]]
+                except IOError:
+                    snapshot_dir = None
+        else:
+            snapshot_dir = None
+
         # Read .production file and get cluster_id
-        try:
-            with open(prod_file, 'r') as input_file:
-                self._process_prod_file_contents(input_file, prod_file)
-        except IOError:
-            raise RuntimeError("Unable to read from {}".format(prod_file))
-        except TypeError:
-            # Catches when ProdFile isn't PathLike and handles it like a File Object instead
-            self._process_prod_file_contents(prod_file)
+        if snapshot:
+            self.cluster_id = snapshot.meta['cluster_id']
+        else:
+            try:
+                with open(prod_file, 'r') as input_file:
+                    self._process_prod_file_contents(input_file, prod_file)
+            except IOError:
+                raise RuntimeError("Unable to read from {}".format(prod_file))
+            except TypeError:
+                # Catches when ProdFile isn't PathLike and handles it like a File Object instead
+                self._process_prod_file_contents(prod_file)
 
         # Validate cluster_id
         if self.cluster_id not in CLUSTER_IDS.keys():
@@ -70,6 +155,10 @@ class Cluster:
             self.is_prod = False
 
         # Populate db_list
+        if snapshot:
+            self.db_list = list(snapshot.meta['db_list'])
+            self.db_set = frozenset(self.db_list)
+            return
         try:
             with open(db_file, 'r') as input_file:
                 self._process_db_file_contents(input_file, db_file)
@@ -77,6 +166,22 @@ class Cluster:
             raise RuntimeError("Unable to read from {}".format(db_file))
         except TypeError:
             self._process_db_file_contents(db_file)
+        self.db_set = frozenset(self.db_list)
+
+        if snapshot_dir is not None:
+            _write_snapshot(snapshot_file, stamps,
+                            {'cluster_id': self.cluster_id, 'db_list': self.db_list}, {})
+
+    def __setattr__(self, name, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError("Cluster instances returned by Cluster.get() are shared and "
+                                 "cannot be changed")
+        super().__setattr__(name, value)
+
+    def _freeze(self):
+        # Makes this Cluster safe to share between every caller of Cluster.get()
+        self.db_list = tuple(self.db_list)
+        self._frozen = True
 
     def _process_prod_file_contents(self, input_file, file_name="unknown"):
         _lines = 0
@@ -125,6 +230,8 @@ class Site:
         site_data_root: string for the main site_data location in the cluster used for
             initializing site.site_data_dir
     """
+    __slots__ = ('site_id', 'short', 'domain', 'version', 'site_db', 'site_data_root')
+
     def __init__(self, site_id=None, short=None, domain=None, version=None, db=None,
                  site_data_dir='/etc/convio/site_data', balgrp=None):
 
@@ -178,6 +285,22 @@ class SiteList:
     An interesting item of note is that SiteList items are indexable by both site_id and short.
     e.g. sitelist['3701'] should give you the Site with site_id 3701
     sitelist['jdrf3'] results in the Site with the matching short name.
+    Integer indexes are positional so sitelist[0] is the first Site loaded.
+
+    With storage='columnar' the sites are held in compact columns instead of one Site object per
+    row and Site objects are only created when they are indexed or iterated. Each lookup returns a
+    new Site so changes made to one are not kept by the SiteList.
+
+    where(), group_by(), count() and counts() query the sites by the attributes in
+    INDEXED_ATTRIBUTES. Each attribute is indexed the first time it is queried and the index is kept
+    up to date by refresh(). Queries return SiteListViews that share the SiteList's Sites.
+
+    A SiteList can be shared by every thread in a process. Each iter() over it or one of its views
+    is independent, slices and filter() return SiteListViews instead of copies, and refresh() only
+    ever appends to or replaces the storage that running iterators and views are reading. The rows,
+    keys and indexes a refresh produces are published together, so a lookup never sees a site that
+    is only half stored. Iterating shortkey or idkey directly while another thread refreshes
+    storage='objects' still needs a copy, e.g. list(sitelist.shortkey).
 
     Attributes:
         shortkey: dictionary representation with short names as the keys
@@ -202,20 +325,38 @@ class SiteList:
                               to '/etc/convio/site_data'. Should probably only be overriden when
                               testing in an environment where you have a copy of the site_data
                               structure and do not want to affect the real files.
+            'storage' - String containing 'objects' or 'columnar'. Defaults to 'objects' which keeps
+                        a Site object for every row. 'columnar' trades a little lookup speed for a
+                        much smaller memory footprint.
+            'snapshot_dir' - String containing full path to a directory for snapshot files, e.g.
+                             SNAPSHOT_DIR. Only used when 'all' is True. The parsed site_version
+                             file is kept there in a binary form that later SiteLists map into
+                             memory instead of parsing the file again. The snapshot is rebuilt
+                             whenever site_version changes. Requires storage='columnar' which is
+                             also the default when 'snapshot_dir' is given.
         """
 
-        self._list = list()  # is the List of Sites for doing iterable type things
+        if 'snapshot_dir' not in kwargs:
+            kwargs['snapshot_dir'] = None
+        if 'storage' not in kwargs:
+            kwargs['storage'] = 'columnar' if kwargs['snapshot_dir'] else 'objects'
+        if 'site_data_dir' not in kwargs:
+            kwargs['site_data_dir'] = '/etc/convio/site_data'
+        if kwargs['storage'] not in ('objects', 'columnar'):
+            raise RuntimeError("ERROR: Invalid storage {} not in "
+                               "('objects', 'columnar')".format(kwargs['storage']))
+
+        self._storage = kwargs['storage']
+        self._site_data_dir = kwargs['site_data_dir']
+        self._new_storage()
         self.index = 0  # index for our _list iterable
-        self.shortkey = {}  # dictionary representation with short names as the keys
-        self.idkey = {}  # dictionary representation with site ids as the keys
-        self._data_len = len(self._list)
+        self._subscribers = list()  # callables notified with the SiteChanges of each refresh
+        self._lock = threading.RLock()  # serializes refresh() and index building
 
         if 'site_version' not in kwargs:
             # TODO adjust logic here to allow StringIO of sample contents for site_version.csv
             # TODO should be something like if file kwargs['site_version'] doesn't exist then handle as StringIO
             kwargs['site_version'] = '/etc/convio/conf/site_version.csv'
-        if 'site_data_dir' not in kwargs:
-            kwargs['site_data_dir'] = '/etc/convio/site_data'
         if 'all' not in kwargs:
             kwargs['all'] = False
         if 'sublist' not in kwargs:
@@ -223,187 +364,1301 @@ class SiteList:
         if 'subfile' not in kwargs:
             kwargs['subfile'] = None
 
-        if 'all' in kwargs and kwargs['all']:
-            self._initialize_with_csv(filename=kwargs['site_version'],
-                                      site_data_dir=kwargs['site_data_dir'])
-        elif not kwargs['all'] and 'key' in kwargs and kwargs['key'] == 'short':
-            self._initialize_with_csv_short_subset(filename=kwargs['site_version'],
-                                                   site_data_dir=kwargs['site_data_dir'],
-                                                   sublist=kwargs['sublist'],
-                                                   subfile=kwargs['subfile'])
+        # What refresh() needs to reload the same set of sites
+        self._site_version = kwargs['site_version']
+        self._key = None
+        self._wanted = None
+        self._source_stat = None
+
+        if 'all' in kwargs and kwargs['all'] and kwargs['snapshot_dir']:
+            if kwargs['storage'] != 'columnar':
+                raise RuntimeError("ERROR: snapshot_dir requires storage='columnar'")
+            self._initialize_from_snapshot(filename=kwargs['site_version'],
+                                           snapshot_dir=kwargs['snapshot_dir'])
+        elif 'all' in kwargs and kwargs['all']:
+            self._initialize_from_csv(filename=kwargs['site_version'])
+        elif 'key' in kwargs and kwargs['key'] in ('short', 'id'):
+            self._key = kwargs['key']
+            self._wanted = _build_key_set(kwargs['key'], kwargs['site_version'],
+                                          kwargs['sublist'], kwargs['subfile'])
+            self._initialize_from_csv(filename=kwargs['site_version'])
         else:
-            if 'key' in kwargs and kwargs['key'] == 'id' and 'site_version' in kwargs:
-                self._initialize_with_csv_id_subset(filename=kwargs['site_version'],
-                                                    site_data_dir=kwargs['site_data_dir'],
-                                                    sublist=kwargs['sublist'],
-                                                    subfile=kwargs['subfile'])
-            else:
-                raise RuntimeError("ERROR: Unexpected initialization condition occurred.")
+            raise RuntimeError("ERROR: Unexpected initialization condition occurred.")
+
+    @property
+    def shortkey(self):
+        return self._indexes.shortkey
+
+    @property
+    def idkey(self):
+        return self._indexes.idkey
+
+    @property
+    def _list(self):
+        # The storage of the current generation, see _SiteIndexes
+        return self._indexes.sites
 
     def __len__(self):
-        return self._data_len
+        return len(self._indexes.rows)
 
     def __iter__(self):
-        return self
+        # A new iterator every time so nested loops and threads do not share a position. It covers
+        #     the sites stored when it was created even if refresh() adds more while it runs
+        return iter(self[:])
 
     def __getitem__(self, item):
-        return self._list[item]
+        # Everything is read from one generation so a refresh in another thread cannot mix two
+        indexes = self._indexes
+        if isinstance(item, str):
+            site = indexes.shortkey.get(item)
+            if site is not None:
+                return site
+            try:
+                return indexes.idkey[int(item)]
+            except (ValueError, KeyError):
+                raise KeyError(item)
+        if isinstance(item, slice):
+            return SiteListView(self, indexes.rows[item], indexes.sites)
+        return indexes.sites[indexes.rows[item]]
 
     def __next__(self):
+        # Kept for callers of next(sitelist), for loops use __iter__ and do not touch self.index
         self.index += 1
+        indexes = self._indexes
         try:
-            return self._list[self.index-1]
+            return indexes.sites[indexes.rows[self.index-1]]
         except IndexError:
             self.index = 0
             raise StopIteration
 
-    def _initialize_with_csv(self, filename, site_data_dir):
+    def subscribe(self, callback):
+        """Registers callback to be called with the list of SiteChanges whenever refresh() finds
+        that site_version changed."""
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        """Removes a callback registered with subscribe()."""
+        self._subscribers.remove(callback)
+
+    def refresh(self):
+        """Re-reads site_version and applies only what changed to this SiteList in place.
+
+        Sites added to or removed from site_version are added to or removed from the SiteList and
+        sites whose short, domain, version or site_db changed are updated. Subset SiteLists only
+        consider the sites in their original sublist or subfile. Nothing is read if the file's mtime
+        and size are unchanged. The file is parsed once but only the changed sites touch the rows,
+        keys and indexes, so the work done beyond parsing depends on the number of changes rather
+        than the size of the cluster. Removed sites are left in the storage until they outnumber
+        the sites in use. With storage='columnar' a site whose short or domain changed moves to the
+        end of the SiteList. Returns the list of SiteChanges that were applied."""
+        with self._lock:
+            try:
+                stat = os.stat(self._site_version)
+            except OSError:
+                raise RuntimeError("ERROR: Unable to read from {}".format(self._site_version))
+            if (stat.st_mtime_ns, stat.st_size) == self._source_stat:
+                return []
+
+            if self._storage == 'columnar':
+                changes = self._diff_columnar(stat)
+            else:
+                changes = self._diff_objects(stat)
+
+        if changes:
+            for callback in list(self._subscribers):
+                callback(changes)
+        return changes
+
+    def watch(self, interval=30.0, on_error=None):
+        """Starts and returns a SiteListWatcher thread that calls refresh() every interval seconds
+        until its stop() method is called."""
+        watcher = SiteListWatcher(self, interval=interval, on_error=on_error)
+        watcher.start()
+        return watcher
+
+    def run(self, fn, workers=None, per_db_limit=None, executor='thread'):
+        """Calls fn(site) for every site concurrently and returns a SiteRun that yields a
+        SiteResult for each site as it completes.
+
+        workers is the size of the pool, 'thread' or 'process' as executor picks the kind of pool
+        and per_db_limit caps how many calls run at once for sites on the same site_db. With a
+        process pool fn must be picklable, e.g. a module level function. An exception raised by fn
+        is kept on that site's SiteResult and the remaining sites still run."""
+        return SiteRun(self, fn, workers=workers, per_db_limit=per_db_limit, executor=executor)
+
+    def filter(self, predicate):
+        """Returns a SiteListView of the sites for which predicate(site) is true."""
+        indexes = self._indexes
+        return SiteListView(self, _predicate_rows(indexes.sites, indexes.rows, predicate),
+                            indexes.sites)
+
+    def where(self, **filters):
+        """Returns a SiteListView of the sites matching every filter.
+
+        Filters are attribute=value pairs for attributes in INDEXED_ATTRIBUTES. A list, tuple or set
+        value matches any of its values.
+        e.g. sitelist.where(site_db='db103tc', version=('23.4', '23.5'))"""
+        indexes = self._indexes
+        return SiteListView(self, self._matching_rows(filters, indexes), indexes.sites)
+
+    def group_by(self, attribute, **filters):
+        """Returns a dictionary of attribute value to a SiteListView of the sites with that value,
+        optionally limited to the sites matching filters as in where()."""
+        indexes = self._indexes
+        if filters:
+            return SiteListView(self, self._matching_rows(filters, indexes),
+                                indexes.sites).group_by(attribute)
+        index = self._index(attribute, indexes)
+        return {value: SiteListView(self, rows, indexes.sites)
+                for value, rows in list(index.items())}
+
+    def count(self, **filters):
+        """Returns the number of sites matching filters as in where()."""
+        return len(self._matching_rows(filters, self._indexes))
+
+    def counts(self, attribute, **filters):
+        """Returns a dictionary of attribute value to the number of sites with that value,
+        optionally limited to the sites matching filters as in where()."""
+        return {value: len(view) for value, view in self.group_by(attribute, **filters).items()}
+
+    def _index(self, attribute, indexes):
+        # Returns the dictionary of attribute value to the sorted array of rows with that value,
+        #     building it if this is the first time attribute is queried
+        if attribute not in INDEXED_ATTRIBUTES:
+            raise RuntimeError("ERROR: Invalid attribute {} not in {}".format(attribute,
+                                                                          INDEXED_ATTRIBUTES))
+        index = indexes.by_attribute.get(attribute)
+        if index is not None:
+            return index
+        with self._lock:
+            index = indexes.by_attribute.get(attribute)
+            if index is not None:
+                return index
+            if indexes.by_attribute is self._indexes.by_attribute:
+                # Generations of the same storage share their indexes, which refresh() keeps up to
+                #     date for the newest one
+                indexes = self._indexes
+            index = {}
+            if isinstance(indexes.sites, _SiteColumns):
+                values = indexes.sites.column(attribute, indexes.rows)
+            else:
+                values = (getattr(indexes.sites[row], attribute) for row in indexes.rows)
+            for row, value in zip(indexes.rows, values):
+                rows = index.get(value)
+                if rows is None:
+                    rows = index[value] = array('l')
+                rows.append(row)
+            indexes.by_attribute[attribute] = index
+            return index
+
+    def _matching_rows(self, filters, indexes, rows=None):
+        # Returns the rows of indexes.sites matching every filter in filters, limited to rows when
+        #     given. The index entries of the filters are intersected starting from the smallest
+        filters = {attribute: frozenset(value) if isinstance(value, (list, tuple, set, frozenset))
+                   else value for attribute, value in filters.items()}
+        if not filters:
+            return indexes.rows if rows is None else rows
+        candidates = sorted((self._index_rows(attribute, value, indexes)
+                             for attribute, value in filters.items()), key=len)
+        if rows is None and len(candidates) == 1:
+            return candidates[0]
+
+        matching = set(candidates[0]).intersection(*candidates[1:])
+        if rows is None:
+            return array('l', sorted(matching))
+        return array('l', (row for row in rows if row in matching))
+
+    def _index_rows(self, attribute, value, indexes):
+        # Returns the sorted rows whose attribute is value or, for a frozenset, any of its values
+        index = self._index(attribute, indexes)
+        if not isinstance(value, frozenset):
+            return index.get(value, _NO_ROWS)
+        return array('l', sorted(row for item in value for row in index.get(item, ())))
+
+    def _index_add(self, row):
+        # Adds a newly stored row to the indexes built so far
+        indexes = self._indexes
+        for attribute, index in indexes.by_attribute.items():
+            value = _site_value(indexes.sites, row, attribute)
+            index[value] = _with_row(index.get(value), row)
+
+    def _row_of(self, site, previous):
+        # Returns the row of a Site object whose old values were previous by searching the
+        #     smallest index entry that must hold it
+        indexes = self._indexes
+        entries = [index[getattr(previous, attribute)]
+                   for attribute, index in indexes.by_attribute.items()]
+        for row in min(entries, key=len):
+            if indexes.sites[row] is site:
+                return row
+
+    def _index_remove(self, row):
+        # Removes a row that is no longer in use from the indexes built so far
+        indexes = self._indexes
+        for attribute, index in indexes.by_attribute.items():
+            value = _site_value(indexes.sites, row, attribute)
+            remaining = _without_row(index[value], row)
+            if remaining:
+                index[value] = remaining
+            else:
+                del index[value]
+
+    def _index_change(self, row, previous, site):
+        # Moves row between index entries for every indexed attribute that changed from previous
+        for attribute, index in self._indexes.by_attribute.items():
+            old, new = getattr(previous, attribute), getattr(site, attribute)
+            if old != new:
+                remaining = _without_row(index[old], row)
+                if remaining:
+                    index[old] = remaining
+                else:
+                    del index[old]
+                index[new] = _with_row(index.get(new), row)
+
+    def _new_storage(self):
+        # Creates the empty _list, shortkey, idkey and indexes for our storage type
+        if self._storage == 'columnar':
+            sites = _SiteColumns(self._site_data_dir)
+            self._indexes = _SiteIndexes(sites, range(0), _SiteColumnsKey(sites, 'short'),
+                                         _SiteColumnsKey(sites, 'id'))
+        else:
+            # The List of Sites for doing iterable type things and dictionary representations
+            #     with short names and site ids as the keys
+            self._indexes = _SiteIndexes(list(), range(0), {}, {})
+        self._dead = set()  # rows of removed sites still in the storage, see _publish()
+
+    def _publish(self, added, removed, shortkey, idkey):
+        # Makes the rows added to and removed from the storage visible together with their keys.
+        #     Removed rows stay in the storage as tombstones so running iterators and views keep
+        #     reading the sites they started with and nothing is moved. Once the tombstones
+        #     outnumber the rows in use the storage is compacted, which costs no more than the
+        #     removals that made them
+        indexes = self._indexes
+        rows = indexes.rows
+        if removed or not isinstance(rows, range):
+            rows = _array_from(rows) if isinstance(rows, array) else array('l', rows)
+            for row in removed:
+                del rows[bisect_left(rows, row)]
+            rows.extend(added)
+        else:
+            rows = range(len(rows) + len(added))
+        self._dead.update(removed)
+        self._indexes = _SiteIndexes(indexes.sites, rows, shortkey, idkey, indexes.by_attribute)
+        if len(self._dead) > len(rows):
+            self._compact()
+
+    def _compact(self):
+        # Moves the sites in use to new storage without tombstones. Views taken before keep the
+        #     old storage and the indexes are rebuilt on the next query
+        indexes = self._indexes
+        if self._storage == 'columnar':
+            sites = _SiteColumns(self._site_data_dir)
+            old = indexes.sites
+            for row in indexes.rows:
+                sites.append(old.ids[row], old.shorts[row], old.domains[row],
+                             old.value(row, 'version'), old.value(row, 'site_db'))
+            rows = range(len(sites))
+            self._indexes = _SiteIndexes(sites, rows, _SiteColumnsKey(sites, 'short', rows),
+                                         _SiteColumnsKey(sites, 'id', rows))
+        else:
+            sites = [indexes.sites[row] for row in indexes.rows]
+            self._indexes = _SiteIndexes(sites, range(len(sites)), indexes.shortkey,
+                                         indexes.idkey)
+        self._dead = set()
+
+    def _stored(self):
+        # Publishes every site stored by _initialize_from_csv() or _initialize_from_snapshot(),
+        #     building the columnar keys that were not loaded from a snapshot
+        sites = self._list
+        rows = range(len(sites))
+        shortkey, idkey = self.shortkey, self.idkey
+        if self._storage == 'columnar':
+            if len(shortkey) != len(rows):
+                shortkey = _SiteColumnsKey(sites, 'short', rows)
+            if len(idkey) != len(rows):
+                idkey = _SiteColumnsKey(sites, 'id', rows)
+        self._indexes = _SiteIndexes(sites, rows, shortkey, idkey)
+
+    def _read_rows(self, stat):
+        # Returns every (site_id, short, domain, version, db) row of site_version that belongs in
+        # this SiteList and records stat as the state of the file they were read from
+        try:
+            with open(self._site_version, 'r') as csvfile:
+                rows = list(_parse_site_version(csvfile, self._key, self._wanted))
+        except IOError:
+            raise RuntimeError("ERROR: Unable to read from {}".format(self._site_version))
+        except (ValueError, IndexError):
+            raise RuntimeError("ERROR: Invalid site_version format in {}".format(
+                self._site_version))
+        self._source_stat = (stat.st_mtime_ns, stat.st_size)
+        return rows
+
+    def _initialize_from_csv(self, filename):
         # filename must the the full path to a file that is in the format of site_version.csv
-        # lines in filename starting with comment character '#' will be ignored
+        # When self._key is None every site in filename is loaded, otherwise only the sites whose
+        #     self._key is in the self._wanted set
+        # Lines in filename starting with comment character '#' will be ignored
 
         try:
+            stat = os.stat(filename)
             with open(filename, 'r') as csvfile:
-                contents = csvfile.readlines()
-                for line in contents:
-                    line = line.rstrip()
-                    if line and line[0] != '#':
-                        linelist = line.split(',')
-                        siteid = int(linelist[0])
-                        short = linelist[1]
-                        domain = linelist[2]
-                        version = linelist[3]
-                        in_db = linelist[4]
-
+                rows = _parse_site_version(csvfile, self._key, self._wanted)
+                if self._storage == 'columnar':
+                    for siteid, short, domain, version, in_db in rows:
+                        self._list.append(siteid, short, domain, version, in_db)
+                else:
+                    for siteid, short, domain, version, in_db in rows:
                         site = Site(site_id=siteid, short=short, domain=domain,
-                                    version=version, db=in_db, site_data_dir=site_data_dir)
+                                    version=version, db=in_db, site_data_dir=self._site_data_dir)
                         self._list.append(site)
                         self.shortkey[short] = site
                         self.idkey[siteid] = site
         except IOError:
             raise RuntimeError("ERROR: Unable to read from {}".format(filename))
 
-        self._data_len = len(self._list)
+        self._source_stat = (stat.st_mtime_ns, stat.st_size)
+        self._stored()
+        if self._key is not None and len(self) < 1:
+            raise RuntimeError("ERROR: SiteList initialized with 0 sites.")
 
-    def _initialize_with_csv_short_subset(self, filename, site_data_dir, sublist=None,
-                                          subfile=None):
-        # Filename must the the full path to a file that is in the format of site_version.csv
-        # Must be called with either a sublist of short names OR a subfile containing short
-        #     names never both
-        # If used subfile needs to be the full path to a file containing short names one per line
-        # Lines in filename starting with comment character '#' will be ignored
+    def _initialize_from_snapshot(self, filename, snapshot_dir):
+        # filename must the the full path to a file that is in the format of site_version.csv
+        # Loads every site from the snapshot of filename in snapshot_dir, parsing filename and
+        #     writing a new snapshot when there is no current one
 
-        if subfile and not sublist:
-            sublist = list()
+        snapshot_file = _snapshot_path(snapshot_dir, 'sitelist', filename)
+        snapshot = _read_snapshot(snapshot_file, (filename,))
+        if snapshot:
+            sites = self._list
+            sites.load_sections(snapshot.meta, snapshot.sections)
+            self._indexes = _SiteIndexes(
+                sites, range(len(sites)),
+                _SiteColumnsKey(sites, 'short', sorted_rows=snapshot.sections['short_rows']),
+                _SiteColumnsKey(sites, 'id', sorted_rows=snapshot.sections['id_rows']))
+            self._source_stat = tuple(snapshot.sources[0][1:3])
+        else:
             try:
-                with open(subfile, 'r') as list_file:
-                    contents = list_file.readlines()
-                    for line in contents:
-                        line = line.rstrip()
-                        if line and line[0] != '#':
-                            sublist.append(line)
+                stat = os.stat(filename)
+                digest = hashlib.sha1()
+                with open(filename, 'rb') as csvfile:
+                    for row in _parse_site_version(_hashed_lines(csvfile, digest)):
+                        self._list.append(*row)
             except IOError:
                 raise RuntimeError("ERROR: Unable to read from {}".format(filename))
-        elif sublist and not subfile:
-            if not sublist:
-                raise RuntimeError("ERROR: _initialize_with_csv_short_subset called with invalid "
-                                   "arguments\n"
-                                   "filename={}\n"
-                                   "sublist={}\n"
-                                   "subfile={}\n"
-                                   "The sublist must not be empty.".format(filename,
-                                                                           sublist,
-                                                                           subfile))
-        else:
-            raise RuntimeError("ERROR: _initialize_with_csv_short_subset called with invalid "
-                               "arguments\n"
-                               "filename={}\n"
-                               "sublist={}\n"
-                               "subfile={}\n"
-                               "Only one parameter sublist or subfile can be "
-                               "provided.".format(filename, sublist, subfile))
 
-        try:
-            with open(filename, 'r') as csvfile:
-                for line in csvfile.readlines():
-                    line = line.rstrip()
-                    if line and line[0] != '#':
-                        linelist = line.split(',')
-                        siteid = int(linelist[0])
-                        short = linelist[1]
-                        if short in sublist:
-                            site = Site(site_id=siteid, short=short, domain=linelist[2],
-                                        version=linelist[3], db=linelist[4],
-                                        site_data_dir=site_data_dir)
-                            self._list.append(site)
-                            self.shortkey[short] = site
-                            self.idkey[siteid] = site
-        except IOError:
-            raise RuntimeError("ERROR: Unable to read from {}".format(filename))
+            self._stored()
+            sections = self._list.sections()
+            sections['short_rows'] = self.shortkey.sorted_rows
+            sections['id_rows'] = self.idkey.sorted_rows
+            _write_snapshot(snapshot_file, [_stamp(filename, stat, digest.hexdigest())],
+                            self._list.tables(), sections)
+            self._source_stat = (stat.st_mtime_ns, stat.st_size)
 
-        self._data_len = len(self._list)
-        if self._data_len < 1:
-            raise RuntimeError("ERROR: SiteList initialized with 0 sites.")
+    def _diff_objects(self, stat):
+        # Applies the difference between site_version and our Site objects in place. Changed sites
+        #     are updated in place so anyone holding one sees the new values
+        rows = self._read_rows(stat)
+        indexes = self._indexes
+        sites, shortkey, idkey = indexes.sites, indexes.shortkey, indexes.idkey
+        changes = list()
+        added = list()
+        kept = 0
+        for siteid, short, domain, version, in_db in rows:
+            site = idkey.get(siteid)
+            if site is None:
+                site = Site(site_id=siteid, short=short, domain=domain, version=version,
+                            db=in_db, site_data_dir=self._site_data_dir)
+                sites.append(site)
+                added.append(len(sites) - 1)
+                self._index_add(added[-1])
+                shortkey[short] = site
+                idkey[siteid] = site
+                changes.append(SiteChange('added', site))
+                continue
+            kept += 1
+            if (site.short, site.domain, site.version, site.site_db) != (short, domain, version,
+                                                                         in_db):
+                previous = _copy_site(site)
+                if site.short != short:
+                    if shortkey.get(site.short) is site:
+                        del shortkey[site.short]
+                    shortkey[short] = site
+                site.short, site.domain, site.version, site.site_db = short, domain, version, in_db
+                if self._indexes.by_attribute:
+                    self._index_change(self._row_of(site, previous), previous, site)
+                changes.append(SiteChange('changed', site, previous))
 
-    def _initialize_with_csv_id_subset(self, filename, site_data_dir, sublist=None,
-                                       subfile=None):
-        # Filename must the the full path to a file that is in the format of site_version.csv
-        # Must be called with either a sublist of site ids OR a subfile containing site ids
-        #     never both
-        # If used subfile needs to be the full path to a file containing site ids one per line
-        # Lines in filename starting with comment character '#' will be ignored
+        # Every site we had before that is still in the file was counted in kept so only look for
+        #     removed sites when the counts say there are some
+        removed = list()
+        if kept < len(indexes.rows):
+            seen = {row[0] for row in rows}
+            for row in indexes.rows:
+                site = sites[row]
+                if site.site_id in seen:
+                    continue
+                del idkey[site.site_id]
+                if shortkey.get(site.short) is site:
+                    del shortkey[site.short]
+                self._index_remove(row)
+                removed.append(row)
+                changes.append(SiteChange('removed', site))
+        if added or removed:
+            self._publish(added, removed, shortkey, idkey)
+        return changes
+
+    def _diff_columnar(self, stat):
+        # Applies the difference between site_version and our columns. Version and db changes are
+        #     written into the existing rows and added sites are appended. A packed row cannot
+        #     change length, so a site with a new short or domain is appended too and its old row
+        #     is left behind like the rows of removed sites, see _publish()
+        rows = self._read_rows(stat)
+        indexes = self._indexes
+        columns = indexes.sites
+        dead = self._dead
+        changes = list()
+        kept = 0
+        # site_version keeps its order between changes so the row we expect next is checked
+        #     before falling back to a binary search of idkey
+        expected = 0
+        row_count = len(columns)
+        ids, version_codes, db_codes = columns.ids, columns.version_codes, columns.db_codes
+        short_data, short_offsets = columns.shorts.data, columns.shorts.offsets
+        domain_data, domain_offsets = columns.domains.data, columns.domains.offsets
+        for siteid, short, domain, version, in_db in rows:
+            if expected < row_count and ids[expected] == siteid and expected not in dead:
+                row = expected
+            else:
+                row = indexes.idkey.row(siteid)
+            if row is None:
+                changes.append(SiteChange('added', Site(
+                    site_id=siteid, short=short, domain=domain, version=version, db=in_db,
+                    site_data_dir=self._site_data_dir)))
+                continue
+            expected = row + 1
+            kept += 1
+            if (columns.version_table[version_codes[row]] == version
+                    and columns.db_table[db_codes[row]] == in_db
+                    and short_data[short_offsets[row]:short_offsets[row + 1]] == short.encode()
+                    and domain_data[domain_offsets[row]:domain_offsets[row + 1]]
+                    == domain.encode()):
+                continue
+            changes.append(SiteChange('changed', Site(
+                site_id=siteid, short=short, domain=domain, version=version, db=in_db,
+                site_data_dir=self._site_data_dir), columns.site(row)))
+
+        removed = list()
+        if kept < len(indexes.rows):
+            seen = {row[0] for row in rows}
+            for row in indexes.rows:
+                if ids[row] not in seen:
+                    removed.append(row)
+                    changes.append(SiteChange('removed', columns.site(row)))
+        if not changes:
+            return changes
+
+        # Added rows are stored and indexed before the rows and keys that include them are
+        #     published, so lookups in other threads only ever reach complete rows
+        columns.make_writable()
+        added = list()
+        for change in changes:
+            site, previous = change.site, change.previous
+            if change.kind == 'removed':
+                continue
+            if change.kind == 'changed':
+                row = indexes.idkey.row(site.site_id)
+                if (previous.short, previous.domain) == (site.short, site.domain):
+                    columns.set_codes(row, site.version, site.site_db)
+                    self._index_change(row, previous, site)
+                    continue
+                removed.append(row)
+            added.append(columns.append(site.site_id, site.short, site.domain, site.version,
+                                        site.site_db))
+            self._index_add(added[-1])
+        for row in removed:
+            self._index_remove(row)
+        self._publish(added, removed, indexes.shortkey.with_rows(added, removed),
+                      indexes.idkey.with_rows(added, removed))
+        return changes
+
+
+class SiteListView:
+    """This class represents a read only subset of the sites in a SiteList.
+
+    A view only keeps the row numbers of its sites and the storage of the SiteList they refer to,
+    so with object storage it hands out the very same Site objects and nothing is copied. Rows that
+    refresh() removes stay in the storage until the SiteList compacts it into new storage, so
+    existing views keep showing the sites from before the refresh.
+
+    Attributes:
+        sitelist: the SiteList the view was created from
+        rows: sequence of the row numbers of the sites in the SiteList's storage
+    """
+
+    def __init__(self, sitelist, rows, sites=None):
+        self.sitelist = sitelist
+        self.rows = rows
+        self._sites = sitelist._list if sites is None else sites
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        sites = self._sites
+        return (sites[row] for row in self.rows)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return self._view(self.rows[item])
+        return self._sites[self.rows[item]]
+
+    def run(self, fn, workers=None, per_db_limit=None, executor='thread'):
+        """Calls fn(site) for every site in this view concurrently, see SiteList.run()."""
+        return SiteRun(self, fn, workers=workers, per_db_limit=per_db_limit, executor=executor)
+
+    def filter(self, predicate):
+        """Returns a SiteListView of the sites in this view for which predicate(site) is true."""
+        return self._view(_predicate_rows(self._sites, self.rows, predicate))
+
+    def where(self, **filters):
+        """Returns a SiteListView of the sites in this view matching every filter, see
+        SiteList.where()."""
+        return self._view(self._matching_rows(filters))
+
+    def group_by(self, attribute, **filters):
+        """Returns a dictionary of attribute value to a SiteListView of the sites in this view with
+        that value, see SiteList.group_by()."""
+        if attribute not in INDEXED_ATTRIBUTES:
+            raise RuntimeError("ERROR: Invalid attribute {} not in {}".format(attribute,
+                                                                          INDEXED_ATTRIBUTES))
+        groups = {}
+        for row in self._matching_rows(filters):
+            value = _site_value(self._sites, row, attribute)
+            group = groups.get(value)
+            if group is None:
+                group = groups[value] = array('l')
+            group.append(row)
+        return {value: self._view(group) for value, group in groups.items()}
+
+    def count(self, **filters):
+        """Returns the number of sites in this view matching filters, see SiteList.where()."""
+        return len(self._matching_rows(filters))
+
+    def counts(self, attribute, **filters):
+        """Returns a dictionary of attribute value to the number of sites in this view with that
+        value, see SiteList.counts()."""
+        return {value: len(view) for value, view in self.group_by(attribute, **filters).items()}
+
+    def _view(self, rows):
+        # Returns a view of rows in the same storage as this view
+        return SiteListView(self.sitelist, rows, self._sites)
 
-        # print("filename={}\n"
-        #       "sublist={}\n"
-        #       "subfile={}".format(filename, sublist, subfile))
+    def _matching_rows(self, filters):
+        # Uses the SiteList's indexes while they describe every row of our storage, which stops
+        #     once removed rows are left in it, and otherwise checks our rows one by one
+        indexes = self.sitelist._indexes
+        if indexes.sites is self._sites and isinstance(indexes.rows, range):
+            return self.sitelist._matching_rows(filters, indexes, self.rows)
+        for attribute in filters:
+            if attribute not in INDEXED_ATTRIBUTES:
+                raise RuntimeError("ERROR: Invalid attribute {} not in {}".format(
+                    attribute, INDEXED_ATTRIBUTES))
+        return _predicate_rows(self._sites, self.rows,
+                               lambda site: all(_matches(getattr(site, attribute), value)
+                                                for attribute, value in filters.items()))
 
-        if subfile and not sublist:
-            sublist = list()
+
+class _SiteIndexes:
+    """One generation of a SiteList: its storage, the rows of it in use, its keys and secondary
+    indexes.
+
+    refresh() builds the next generation beside the current one and publishes it with a single
+    assignment under the SiteList's lock, so a lookup or query that starts from one _SiteIndexes
+    never pairs rows or keys from one generation with sites from another. Generations of the same
+    storage share their secondary indexes."""
+    __slots__ = ('sites', 'rows', 'shortkey', 'idkey', 'by_attribute')
+
+    def __init__(self, sites, rows, shortkey, idkey, by_attribute=None):
+        self.sites = sites
+        self.rows = rows  # row numbers of the sites in the SiteList, in order
+        self.shortkey = shortkey
+        self.idkey = idkey
+        # attribute name to index dictionary, see SiteList._index()
+        self.by_attribute = {} if by_attribute is None else by_attribute
+
+
+class SiteResult:
+    """This class represents the outcome of calling a SiteRun's function for one site.
+
+    Attributes:
+        site: the Site the function was called with
+        value: what the function returned, None if it raised
+        error: the exception the function raised, None if it returned
+        seconds: how long the call took
+    """
+    __slots__ = ('site', 'value', 'error', 'seconds')
+
+    def __init__(self, site, value=None, error=None, seconds=0.0):
+        self.site = site
+        self.value = value
+        self.error = error
+        self.seconds = seconds
+
+    def __repr__(self):
+        return 'SiteResult({}, value={!r}, error={!r})'.format(self.site.short, self.value,
+                                                                self.error)
+
+
+class SiteRun:
+    """Runs a function for every site of a SiteList or SiteListView on a thread or process pool.
+
+    Iterating a SiteRun starts the work and yields a SiteResult for each site in the order they
+    complete. Sites are pulled from the SiteList as pool slots free up, so no more than workers
+    calls are in flight and no more than per_db_limit of those are for sites on the same site_db.
+    At most workers sites whose site_db is at its limit are held back, pulling stops while that
+    many are waiting. Created by SiteList.run().
+
+    Attributes:
+        errors: list of the SiteResults whose call raised, filled in as the run progresses
+        completed: number of sites that have finished
+    """
+
+    def __init__(self, sites, fn, workers=None, per_db_limit=None, executor='thread'):
+        if executor not in ('thread', 'process'):
+            raise RuntimeError("ERROR: Invalid executor {} not in "
+                               "('thread', 'process')".format(executor))
+        if per_db_limit is not None and per_db_limit < 1:
+            raise RuntimeError("ERROR: per_db_limit must be at least 1")
+        self.sites = sites
+        self.fn = fn
+        self.workers = workers or (os.cpu_count() or 1) * (1 if executor == 'process' else 4)
+        self.per_db_limit = per_db_limit
+        self.executor = executor
+        self.errors = list()
+        self.completed = 0
+
+    def __iter__(self):
+        pool_class = ProcessPoolExecutor if self.executor == 'process' else ThreadPoolExecutor
+        sites = iter(self.sites)
+        waiting = {}  # site_db to deque of sites held back by per_db_limit
+        held = 0  # number of sites in waiting
+        running = {}  # site_db to number of calls in flight
+        futures = {}  # future to Site
+        exhausted = False
+
+        with pool_class(max_workers=self.workers) as pool:
+            while True:
+                # Fill free pool slots, first from sites that were held back then from new ones
+                while len(futures) < self.workers:
+                    site = self._next_site(waiting, running)
+                    if site is not None:
+                        held -= 1
+                    # Once workers sites are held back a slot has to free up before more are
+                    #     pulled, so a run whose site_dbs are all at their limit reads no further
+                    while site is None and not exhausted and held < self.workers:
+                        site = next(sites, None)
+                        if site is None:
+                            exhausted = True
+                        elif not self._db_free(running, site.site_db):
+                            waiting.setdefault(site.site_db, deque()).append(site)
+                            held += 1
+                            site = None
+                    if site is None:
+                        break
+                    running[site.site_db] = running.get(site.site_db, 0) + 1
+                    futures[pool.submit(_call_site, self.fn, site)] = site
+                if not futures:
+                    return
+
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    site = futures.pop(future)
+                    running[site.site_db] -= 1
+                    try:
+                        value, error, seconds = future.result()
+                    except Exception as pool_error:
+                        # e.g. an unpicklable return value or a dead process pool worker
+                        value, error, seconds = None, pool_error, 0.0
+                    result = SiteResult(site, value=value, error=error, seconds=seconds)
+                    self.completed += 1
+                    if error is not None:
+                        self.errors.append(result)
+                    yield result
+
+    def _db_free(self, running, site_db):
+        # Returns True if another call can start for a site on site_db
+        return self.per_db_limit is None or running.get(site_db, 0) < self.per_db_limit
+
+    def _next_site(self, waiting, running):
+        # Returns a held back site whose site_db now has a free slot or None
+        for site_db, queue in waiting.items():
+            if queue and self._db_free(running, site_db):
+                return queue.popleft()
+        return None
+
+
+def _call_site(fn, site):
+    # Runs in the pool, returns (value, error, seconds) so a failing site does not end the run
+    start = perf_counter()
+    try:
+        return fn(site), None, perf_counter() - start
+    except Exception as error:
+        return None, error, perf_counter() - start
+
+
+class SiteChange:
+    """This class represents a single change found by SiteList.refresh().
+
+    Attributes:
+        kind: string that is one of 'added', 'removed' or 'changed'
+        site: the Site that was added, removed or changed, with its current values
+        previous: a Site with the values from before a change, None for adds and removals
+    """
+    __slots__ = ('kind', 'site', 'previous')
+
+    def __init__(self, kind, site, previous=None):
+        self.kind = kind
+        self.site = site
+        self.previous = previous
+
+    def __repr__(self):
+        return 'SiteChange({!r}, {})'.format(self.kind, self.site)
+
+
+class SiteListWatcher(threading.Thread):
+    """Daemon thread that polls a SiteList's site_version for changes and refreshes it.
+
+    Created by SiteList.watch(). Errors raised by refresh(), e.g. while site_version is being
+    replaced, are passed to on_error when given and otherwise ignored until the next poll."""
+
+    def __init__(self, sitelist, interval=30.0, on_error=None):
+        super().__init__(name='SiteListWatcher', daemon=True)
+        self.sitelist = sitelist
+        self.interval = interval
+        self.on_error = on_error
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
             try:
-                with open(subfile, 'r') as listfile:
-                    contents = listfile.readlines()
-                    for line in contents:
-                        line = line.rstrip()
-                        if line and line[0] != '#':
-                            line = int(line)
-                            sublist.append(int(line))
-            except IOError:
-                raise RuntimeError("ERROR: Unable to read from {}".format(filename))
-        elif sublist and not subfile:
-            if not sublist:
-                raise RuntimeError("ERROR: _initialize_with_csv_id_subset called with "
-                                   "invalid arguments\n"
-                                   "filename={}\n"
-                                   "sublist={}\n"
-                                   "subfile={}\n"
-                                   "The sublist must not be empty.".format(filename,
-                                                                           sublist, subfile))
-        else:
-            raise RuntimeError("ERROR: _initialize_with_csv_id_subset called with invalid "
-                               "arguments\n"
-                               "filename={}\n"
-                               "sublist={}\n"
-                               "subfile={}\n"
-                               "Only one parameter sublist or subfile "
-                               "can be provided.".format(filename, sublist, subfile))
+                self.sitelist.refresh()
+            except RuntimeError as error:
+                if self.on_error is not None:
+                    self.on_error(error)
+
+    def stop(self, timeout=None):
+        """Stops polling and waits up to timeout seconds for the thread to finish."""
+        self._stopped.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(timeout)
+
+
+class _SiteColumns(Sequence):
+    """Columnar storage backing SiteList(storage='columnar').
+
+    Site ids are kept in an array('l') and shorts and domains are packed into _StringColumns.
+    Versions and databases only have a handful of distinct values per cluster so they are stored as
+    array('H') codes into small tables of interned strings. Indexing creates a new Site for the
+    row."""
+
+    def __init__(self, site_data_dir):
+        self.site_data_root = site_data_dir
+        self.ids = array('l')
+        self.shorts = _StringColumn()
+        self.domains = _StringColumn()
+        self.version_codes = array('H')
+        self.db_codes = array('H')
+        self.version_table = list()
+        self.db_table = list()
+        self._version_lookup = {}
+        self._db_lookup = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return [self.site(i) for i in range(*row.indices(len(self.ids)))]
+        if row < 0:
+            row += len(self.ids)
+        if not 0 <= row < len(self.ids):
+            raise IndexError('SiteList index out of range')
+        return self.site(row)
+
+    def __iter__(self):
+        for row in range(len(self.ids)):
+            yield self.site(row)
+
+    def site(self, row):
+        """Returns a new Site built from the values stored at row."""
+        return Site(site_id=self.ids[row], short=self.shorts[row], domain=self.domains[row],
+                    version=self.version_table[self.version_codes[row]],
+                    db=self.db_table[self.db_codes[row]], site_data_dir=self.site_data_root)
+
+    def value(self, row, attribute):
+        """Returns the value of a Site attribute for row without building the Site."""
+        if attribute == 'site_db':
+            return self.db_table[self.db_codes[row]]
+        if attribute == 'version':
+            return self.version_table[self.version_codes[row]]
+        if attribute == 'domain':
+            return self.domains[row]
+        if attribute == 'short':
+            return self.shorts[row]
+        return self.ids[row]
+
+    def column(self, attribute, rows):
+        """Returns an iterable of the value of a Site attribute for every row in rows."""
+        if attribute == 'site_db':
+            table, codes = self.db_table, self.db_codes
+            return (table[codes[row]] for row in rows)
+        if attribute == 'version':
+            table, codes = self.version_table, self.version_codes
+            return (table[codes[row]] for row in rows)
+        values = {'domain': self.domains, 'short': self.shorts}.get(attribute, self.ids)
+        return (values[row] for row in rows)
+
+    def sections(self):
+        """Returns the columns as a dictionary of buffers for _write_snapshot."""
+        return {'ids': self.ids,
+                'short_data': self.shorts.data, 'short_offsets': self.shorts.offsets,
+                'domain_data': self.domains.data, 'domain_offsets': self.domains.offsets,
+                'version_codes': self.version_codes, 'db_codes': self.db_codes}
+
+    def tables(self):
+        """Returns the version and db lookup tables for _write_snapshot."""
+        return {'version_table': self.version_table, 'db_table': self.db_table}
+
+    def load_sections(self, tables, sections):
+        """Replaces the columns with the buffers of a snapshot loaded by _read_snapshot.
+
+        The buffers are read only memoryviews of the mapped snapshot file so nothing is copied and
+        no more rows can be appended."""
+        self.ids = sections['ids']
+        self.shorts.data = sections['short_data']
+        self.shorts.offsets = sections['short_offsets']
+        self.domains.data = sections['domain_data']
+        self.domains.offsets = sections['domain_offsets']
+        self.version_codes = sections['version_codes']
+        self.db_codes = sections['db_codes']
+        self.version_table = [sys.intern(value) for value in tables['version_table']]
+        self.db_table = [sys.intern(value) for value in tables['db_table']]
+        self._version_lookup = {value: code for code, value in enumerate(self.version_table)}
+        self._db_lookup = {value: code for code, value in enumerate(self.db_table)}
+
+    def make_writable(self):
+        """Copies columns loaded from a snapshot into arrays so rows can be changed or added."""
+        if isinstance(self.ids, memoryview):
+            self.ids = _array_from(self.ids)
+            self.shorts.data = bytearray(self.shorts.data)
+            self.shorts.offsets = _array_from(self.shorts.offsets)
+            self.domains.data = bytearray(self.domains.data)
+            self.domains.offsets = _array_from(self.domains.offsets)
+            self.version_codes = _array_from(self.version_codes)
+            self.db_codes = _array_from(self.db_codes)
+
+    def set_codes(self, row, version, db):
+        """Changes the version and db stored at row."""
+        self.version_codes[row] = _table_code(version, self.version_table, self._version_lookup)
+        self.db_codes[row] = _table_code(db, self.db_table, self._db_lookup)
+
+    def append(self, siteid, short, domain, version, db):
+        """Stores a site as a new row and returns the row number."""
+        self.ids.append(siteid)
+        self.shorts.append(short)
+        self.domains.append(domain)
+        self.version_codes.append(_table_code(version, self.version_table, self._version_lookup))
+        self.db_codes.append(_table_code(db, self.db_table, self._db_lookup))
+        return len(self.ids) - 1
+
+
+class _StringColumn(Sequence):
+    """Strings packed end to end as UTF-8 in a single bytearray.
+
+    offsets holds the start of every string plus the end of the last one so string i is
+    data[offsets[i]:offsets[i + 1]]. This costs a few bytes per string instead of a full str
+    object."""
+
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = array('L', [0])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row):
+        return self.raw(row).decode('utf-8')
+
+    def raw(self, row):
+        """Returns the encoded bytes of the string stored at row."""
+        return bytes(self.data[self.offsets[row]:self.offsets[row + 1]])
+
+    def append(self, value):
+        self.data += value.encode('utf-8')
+        self.offsets.append(len(self.data))
+
+
+class _SiteColumnsKey(Mapping):
+    """Read only mapping of short names or site ids to the Sites stored in a _SiteColumns.
+
+    Rather than a dictionary entry per site only an array('l') of row numbers sorted by key is
+    kept and lookups binary search it. A mapping never changes once built: refresh() creates the
+    next one with with_rows() and publishes it with the rest of the SiteList, so lookups never
+    sort or see the rows shift."""
+
+    def __init__(self, columns, key, rows=(), sorted_rows=None):
+        self.columns = columns
+        self.key = key
+        if sorted_rows is None:
+            sorted_rows = array('l', sorted(rows, key=self._key_of))
+        self.sorted_rows = sorted_rows  # rows sorted by key, e.g. from a snapshot
+
+    def __getitem__(self, key):
+        row = self.row(key)
+        if row is None:
+            raise KeyError(key)
+        return self.columns.site(row)
+
+    def __contains__(self, key):
+        return self.row(key) is not None
+
+    def __iter__(self):
+        values = self.columns.shorts if self.key == 'short' else self.columns.ids
+        return (values[row] for row in self.sorted_rows)
+
+    def __len__(self):
+        return len(self.sorted_rows)
 
+    def _key_of(self, row):
+        if self.key == 'short':
+            return self.columns.shorts.raw(row)
+        return self.columns.ids[row]
+
+    def with_rows(self, added, removed=()):
+        """Returns a new mapping that holds the rows in added but not those in removed. Added rows
+        must already be stored in the columns and removed rows must still hold their values."""
+        sorted_rows = _array_from(self.sorted_rows)
+        for row in removed:
+            position = self._position(self._key_of(row), sorted_rows)
+            while sorted_rows[position] != row:
+                position += 1
+            del sorted_rows[position]
+        for row in added:
+            sorted_rows.insert(self._position(self._key_of(row), sorted_rows), row)
+        return _SiteColumnsKey(self.columns, self.key, sorted_rows=sorted_rows)
+
+    def row(self, key):
+        """Returns the row number holding key or None if there is no such row."""
+        sorted_rows = self.sorted_rows
+        if self.key == 'short':
+            if not isinstance(key, str):
+                return None
+            key = key.encode('utf-8')
+        elif not isinstance(key, int):
+            return None
+
+        position = self._position(key, sorted_rows)
+        if position < len(sorted_rows) and self._key_of(sorted_rows[position]) == key:
+            return sorted_rows[position]
+        return None
+
+    def _position(self, key, sorted_rows):
+        # Binary search for the first position in sorted_rows whose key is not less than key
+        low, high = 0, len(sorted_rows)
+        if self.key == 'short':
+            data, offsets = self.columns.shorts.data, self.columns.shorts.offsets
+            # A bytearray slice is a short copy that compares with bytes directly, a memoryview
+            #     slice from a snapshot does not copy but only supports ==, so it is copied to
+            #     bytes for <
+            probe = bytes if isinstance(data, memoryview) else None
+            while low < high:
+                middle = (low + high) // 2
+                row = sorted_rows[middle]
+                found = data[offsets[row]:offsets[row + 1]]
+                if (found if probe is None else probe(found)) < key:
+                    low = middle + 1
+                else:
+                    high = middle
+            return low
+        ids = self.columns.ids
+        while low < high:
+            middle = (low + high) // 2
+            if ids[sorted_rows[middle]] < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+
+_NO_ROWS = array('l')
+
+
+def _array_from(view):
+    # Returns a writable array copy of an array or a memoryview loaded from a snapshot
+    view = memoryview(view)
+    copy = array(view.format)
+    copy.frombytes(view.cast('B'))
+    return copy
+
+
+def _with_row(rows, row):
+    # Returns a sorted copy of the index entry rows with row added. Entries are never changed in
+    #     place because SiteListViews may share them
+    rows = array('l', rows or ())
+    insort(rows, row)
+    return rows
+
+
+def _without_row(rows, row):
+    # Returns a copy of the index entry rows without row
+    rows = array('l', rows)
+    rows.remove(row)
+    return rows
+
+
+def _site_value(sites, row, attribute):
+    # Returns the value of attribute for row of a SiteList's list or _SiteColumns storage
+    if isinstance(sites, _SiteColumns):
+        return sites.value(row, attribute)
+    return getattr(sites[row], attribute)
+
+
+def _matches(found, value):
+    # Returns True if found is value or, for a list, tuple or set value, is one of its values
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return found in value
+    return found == value
+
+
+def _predicate_rows(sites, rows, predicate):
+    # Returns an array of the rows of a SiteList's storage for which predicate(site) is true
+    return array('l', (row for row in rows if predicate(sites[row])))
+
+
+def _copy_site(site):
+    # Returns a new Site with the same values as site
+    return Site(site_id=site.site_id, short=site.short, domain=site.domain, version=site.version,
+                db=site.site_db, site_data_dir=site.site_data_root)
+
+
+def _table_code(value, table, lookup):
+    # Returns the code for value in a _SiteColumns lookup table, adding it to the table if needed
+    try:
+        return lookup[value]
+    except KeyError:
+        lookup[value] = len(table)
+        table.append(sys.intern(value))
+        return lookup[value]
+
+
+def _build_key_set(key, filename, sublist=None, subfile=None):
+    """Returns a set of the short names or site ids a subset SiteList should contain.
+
+    The keys come from either sublist or the lines of subfile, never both. Site ids are always
+    converted to integers so they hash the same way as the parsed site_version.csv values."""
+    if subfile and not sublist:
+        sublist = list()
         try:
-            with open(filename, 'r') as csvfile:
-                for line in csvfile.readlines():
+            with open(subfile, 'r') as list_file:
+                for line in list_file:
                     line = line.rstrip()
                     if line and line[0] != '#':
-                        linelist = line.split(',')
-                        siteid = int(linelist[0])
-                        short = linelist[1]
-                        if siteid in sublist:
-                            site = Site(site_id=siteid, short=short, domain=linelist[2],
-                                        version=linelist[3], db=linelist[4],
-                                        site_data_dir=site_data_dir)
-                            self._list.append(site)
-                            self.shortkey[short] = site
-                            self.idkey[siteid] = site
+                        sublist.append(line)
         except IOError:
-            raise RuntimeError("ERROR: Unable to read from {}".format(filename))
+            raise RuntimeError("ERROR: Unable to read from {}".format(subfile))
+    elif not (sublist and not subfile):
+        raise RuntimeError("ERROR: SiteList {} subset called with invalid "
+                           "arguments\n"
+                           "filename={}\n"
+                           "sublist={}\n"
+                           "subfile={}\n"
+                           "Exactly one non-empty parameter sublist or subfile "
+                           "must be provided.".format(key, filename, sublist, subfile))
 
-        self._data_len = len(self._list)
-        if self._data_len < 1:
-            raise RuntimeError("ERROR: SiteList initialized with 0 sites.")
+    if key == 'id':
+        return {int(item) for item in sublist}
+    return set(sublist)
+
+
+def _parse_site_version(csvfile, key=None, wanted=None):
+    """Generator yielding (site_id, short, domain, version, db) tuples from a site_version.csv
+    formatted file object.
+
+    The file is read a line at a time so it is never held in memory as a whole. When key is
+    'short' or 'id' only rows whose key is in the wanted set are yielded, and parsing stops as soon
+    as every wanted key has been seen."""
+    remaining = None
+    if key is not None:
+        remaining = set(wanted)
+        if not remaining:
+            return
+
+    for line in csvfile:
+        line = line.rstrip()
+        if not line or line[0] == '#':
+            continue
+        linelist = line.split(',', 5)
+        siteid = int(linelist[0])
+        short = linelist[1]
+        if remaining is not None:
+            found = short if key == 'short' else siteid
+            if found not in wanted:
+                continue
+            remaining.discard(found)
+        yield siteid, short, linelist[2], linelist[3], linelist[4]
+        if remaining is not None and not remaining:
+            return
+
+
+class _Snapshot:
+    """A snapshot file mapped into memory by _read_snapshot.
+
+    Attributes:
+        sources: list of [path, mtime_ns, size, sha1] stamps of the files the snapshot was built
+            from
+        meta: dictionary of the JSON values stored with the snapshot
+        sections: dictionary of read only memoryviews over the binary sections of the snapshot,
+            already cast to the type they were written with
+    """
+    def __init__(self, sources, meta, sections):
+        self.sources = sources
+        self.meta = meta
+        self.sections = sections
+
+
+def _is_path(value):
+    # Returns True when value is a path rather than a file like object
+    return isinstance(value, (str, os.PathLike))
+
+
+def _snapshot_path(snapshot_dir, kind, *sources):
+    """Returns the snapshot file in snapshot_dir for the given kind and source paths."""
+    key = '\0'.join(os.path.abspath(os.fspath(source)) for source in sources)
+    return os.path.join(snapshot_dir, '{}-{}.snap'.format(
+        kind, hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]))
+
+
+def _stamp(path, stat, digest):
+    # Returns the [path, mtime_ns, size, sha1] list a snapshot keeps for each source file
+    return [os.path.abspath(os.fspath(path)), stat.st_mtime_ns, stat.st_size, digest]
+
+
+def _read_source(path):
+    """Returns (stamp, contents) for the source file at path.
+
+    The file is stat'ed before it is read so a change made while reading leaves a stamp that no
+    longer matches the file."""
+    stat = os.stat(path)
+    with open(path, 'rb') as source:
+        contents = source.read()
+    return _stamp(path, stat, hashlib.sha1(contents).hexdigest()), contents
+
+
+def _hashed_lines(binary_file, digest):
+    # Yields the decoded lines of binary_file while feeding the raw bytes to digest
+    for line in binary_file:
+        digest.update(line)
+        yield line.decode('utf-8')
+
+
+def _padded(length):
+    # Snapshot sections start on 8 byte boundaries so they can be cast to any array type
+    return (length + 7) & ~7
+
+
+def _write_snapshot(snapshot_file, sources, meta, sections):
+    """Atomically replaces snapshot_file with a snapshot of meta and sections.
+
+    sources is the list of stamps from _read_source the snapshot was built from. meta must be JSON
+    serializable and sections is a dictionary of buffers such as arrays, bytearrays or memoryviews.
+    The snapshot is written to a temporary file in the same directory which is then renamed over
+    snapshot_file so readers only ever see a complete snapshot. Returns False if the snapshot
+    could not be written, a missing snapshot only costs the next load a parse."""
+    layout = {}
+    views = []
+    offset = 0
+    for name, section in sections.items():
+        view = memoryview(section)
+        layout[name] = [offset, view.nbytes, view.format, view.itemsize]
+        views.append(view.cast('B'))
+        offset += _padded(view.nbytes)
+    header = json.dumps({'sources': sources, 'meta': meta, 'sections': layout}).encode('utf-8')
+
+    snapshot_dir = os.path.dirname(snapshot_file)
+    try:
+        os.makedirs(snapshot_dir, exist_ok=True)
+        handle, temp_file = tempfile.mkstemp(dir=snapshot_dir, suffix='.tmp',
+                                             prefix='.' + os.path.basename(snapshot_file))
+    except OSError:
+        return False
+    try:
+        with os.fdopen(handle, 'wb') as output_file:
+            output_file.write(SNAPSHOT_MAGIC)
+            output_file.write(struct.pack('<Q', len(header)))
+            output_file.write(header)
+            output_file.write(bytes(_padded(len(header)) - len(header)))
+            for view in views:
+                output_file.write(view)
+                output_file.write(bytes(_padded(view.nbytes) - view.nbytes))
+            output_file.flush()
+            os.fsync(output_file.fileno())
+        os.replace(temp_file, snapshot_file)
+    except OSError:
+        try:
+            os.unlink(temp_file)
+        except OSError:
+            pass
+        return False
+    return True
+
+
+def _read_snapshot(snapshot_file, source_paths):
+    """Returns a _Snapshot mapped from snapshot_file or None if it is missing, unreadable or was
+    not built from the current contents of source_paths.
+
+    A source whose mtime or size changed is hashed, and if its contents are unchanged the snapshot
+    is still used and rewritten with the new stamp so the next load can skip the hash."""
+    try:
+        with open(snapshot_file, 'rb') as input_file:
+            mapped = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+    buffer = memoryview(mapped)
+    try:
+        if bytes(buffer[:len(SNAPSHOT_MAGIC)]) != SNAPSHOT_MAGIC:
+            return None
+        header_length = struct.unpack_from('<Q', buffer, len(SNAPSHOT_MAGIC))[0]
+        header_start = len(SNAPSHOT_MAGIC) + 8
+        header = json.loads(bytes(buffer[header_start:header_start + header_length]))
+
+        sources = header['sources']
+        if [source[0] for source in sources] != [os.path.abspath(os.fspath(path))
+                                                 for path in source_paths]:
+            return None
+        restamped = False
+        for number, (path, mtime_ns, size, digest) in enumerate(sources):
+            stat = os.stat(path)
+            if stat.st_mtime_ns == mtime_ns and stat.st_size == size:
+                continue
+            if stat.st_size != size:
+                return None
+            stamp = _read_source(path)[0]
+            if stamp[3] != digest:
+                return None
+            sources[number] = stamp
+            restamped = True
+
+        data_start = header_start + _padded(header_length)
+        sections = {}
+        for name, (offset, length, typecode, itemsize) in header['sections'].items():
+            if array(typecode).itemsize != itemsize:
+                return None
+            start = data_start + offset
+            sections[name] = buffer[start:start + length].cast(typecode)
+    except (OSError, ValueError, KeyError, TypeError, struct.error):
+        return None
+
+    if restamped:
+        _write_snapshot(snapshot_file, sources, header['meta'], sections)
+    return _Snapshot(sources, header['meta'], sections)
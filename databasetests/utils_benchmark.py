@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""Benchmarks for the utils module loaders.
+
+run_suite() generates site_version.csv, databases.csv and .production fixtures for clusters of 1k,
+100k and 1M sites and, for both SiteList storages, measures the Cluster and SiteList load time, peak
+memory, shortkey/idkey lookup latency, subset loading and iteration. The results are saved as JSON
+so runs against different revisions can be compared.
+
+The remaining run functions are one off comparisons. run() generates a synthetic site_version.csv
+and times how long SiteList takes to load all of it, a subset of short names and a subset of site
+ids. It then compares the memory held by a fully loaded SiteList with the default object storage
+against storage='columnar', and times cold and warm starts of SiteList(all=True) through a
+snapshot_dir. Finally it compares per-database where(site_db=..., version=...) queries against a
+linear scan of the SiteList, and the throughput of SiteList.run() against a serial loop for a task
+with simulated latency.
+
+Usage:
+    python3 utils_benchmark.py [output.json [sites ...]]
+    python3 utils_benchmark.py compare [rows] [subset_size]
+"""
+
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from datetime import datetime, timezone
+from time import perf_counter, perf_counter_ns, sleep
+
+from utils import Cluster, SiteList
+
+DB_LIST = ['db103tc', 'db104tc', 'db105tc', 'db106tc']
+VERSIONS = ['23.4', '23.5', '24.1']
+SUITE_SIZES = (1000, 100000, 1000000)
+SITES_PER_DB = 50000
+CLUSTER_NUMBERS = {'tc': 1, 'itc': 8}
+
+
+def gen_site_version(file_handle, count, db_list=None, versions=None, sparse=False):
+    """Writes count site_version.csv formatted rows to file_handle and returns the number of sites
+    written per database.
+
+    With sparse the site_ids are spread over a range four times count, as they are on clusters
+    where sites have been removed, instead of running from 1 to count."""
+    if db_list is None:
+        db_list = DB_LIST
+    if versions is None:
+        versions = VERSIONS
+    db_counts = {k: 0 for k in db_list}
+    site_ids = sorted(random.sample(range(1, 4 * count + 1), count)) if sparse else \
+        range(1, count + 1)
+    file_handle.write('# site_id,short,domain,version,db\n')
+    for site_id in site_ids:
+        db = random.choice(db_list)
+        db_counts[db] += 1
+        short = 'site' + str(site_id)
+        file_handle.write(str(site_id) + ',' + short + ',' + short + '.example.org,'
+                          + random.choice(versions) + ',' + db + '\n')
+    return db_counts
+
+
+def gen_databases(file_handle, db_list):
+    """Writes a databases.csv formatted row to file_handle for every db in db_list."""
+    for number, db in enumerate(db_list, 1):
+        file_handle.write(str(number) + ',' + db + ',\n')
+
+
+def gen_fixtures(directory, sites, cluster_id='tc', seed=None):
+    """Writes .production, databases.csv and site_version.csv for a cluster of sites sites to
+    directory, with one DB per SITES_PER_DB sites, and returns the number of sites per DB."""
+    if seed is not None:
+        random.seed(seed)
+    db_list = ['db{}{:02d}{}'.format(CLUSTER_NUMBERS[cluster_id], number, cluster_id)
+               for number in range(3, 3 + max(len(DB_LIST), -(-sites // SITES_PER_DB)))]
+    with open(os.path.join(directory, '.production'), 'w') as file:
+        file.write(str(cluster_id) + '\n')
+    with open(os.path.join(directory, 'databases.csv'), 'w') as file:
+        gen_databases(file, db_list)
+    with open(os.path.join(directory, 'site_version.csv'), 'w') as file:
+        return gen_site_version(file, sites, db_list=db_list, sparse=True)
+
+
+def time_load(**kwargs):
+    """Returns (seconds, SiteList) for a SiteList built with kwargs."""
+    start = perf_counter()
+    sitelist = SiteList(**kwargs)
+    return perf_counter() - start, sitelist
+
+
+def run(rows=500000, subset_size=5000):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        site_version = os.path.join(tmpdir, 'site_version.csv')
+        with open(site_version, 'w') as file:
+            gen_site_version(file, rows)
+
+        ids = random.sample(range(1, rows + 1), subset_size)
+        shorts = ['site' + str(site_id) for site_id in ids]
+        # Subset keys clustered at the head of the file show the early exit
+        head_ids = list(range(1, subset_size + 1))
+
+        results = [
+            ('all', time_load(all=True, site_version=site_version)),
+            ('short subset', time_load(key='short', sublist=shorts, site_version=site_version)),
+            ('id subset', time_load(key='id', sublist=ids, site_version=site_version)),
+            ('id subset (head)', time_load(key='id', sublist=head_ids,
+                                           site_version=site_version)),
+        ]
+
+    for name, (seconds, sitelist) in results:
+        print('{:<18} {:>8} sites {:>9.3f}s'.format(name, len(sitelist), seconds))
+    return results
+
+
+def measure_memory(**kwargs):
+    """Returns (bytes, SiteList) where bytes is the memory still allocated by a SiteList built
+    with kwargs once loading has finished and both key indexes have been used."""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        sitelist = SiteList(**kwargs)
+        'site1' in sitelist.shortkey
+        1 in sitelist.idkey
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return after - before, sitelist
+
+
+def run_memory(rows=500000):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        site_version = os.path.join(tmpdir, 'site_version.csv')
+        with open(site_version, 'w') as file:
+            gen_site_version(file, rows)
+
+        results = [(storage, measure_memory(all=True, site_version=site_version, storage=storage))
+                   for storage in ('objects', 'columnar')]
+
+    for storage, (size, sitelist) in results:
+        print('{:<18} {:>8} sites {:>9.1f}MiB {:>6.1f}B/site'.format(
+            storage, len(sitelist), size / 2**20, size / len(sitelist)))
+    return results
+
+
+def run_snapshot(rows=500000, warm_runs=5):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        site_version = os.path.join(tmpdir, 'site_version.csv')
+        snapshot_dir = os.path.join(tmpdir, 'snapshots')
+        with open(site_version, 'w') as file:
+            gen_site_version(file, rows)
+
+        results = [('no snapshot', time_load(all=True, site_version=site_version)[0]),
+                   ('cold snapshot', time_load(all=True, site_version=site_version,
+                                               snapshot_dir=snapshot_dir)[0])]
+        warm = [time_load(all=True, site_version=site_version, snapshot_dir=snapshot_dir)[0]
+                for _ in range(warm_runs)]
+        results.append(('warm snapshot', min(warm)))
+
+    for name, seconds in results:
+        print('{:<18} {:>8} sites {:>9.4f}s'.format(name, rows, seconds))
+    return results
+
+
+def time_per_db(query, db_list):
+    """Returns (seconds, sites) for running query(db) once for every db in db_list."""
+    start = perf_counter()
+    sites = sum(len(query(db)) for db in db_list)
+    return perf_counter() - start, sites
+
+
+def run_queries(rows=500000, version='23.4'):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        site_version = os.path.join(tmpdir, 'site_version.csv')
+        with open(site_version, 'w') as file:
+            gen_site_version(file, rows)
+
+        results = list()
+        for storage in ('objects', 'columnar'):
+            sitelist = SiteList(all=True, site_version=site_version, storage=storage)
+            results.append((storage + ' scan', time_per_db(
+                lambda db: [site for site in sitelist
+                            if site.site_db == db and site.version == version], DB_LIST)))
+            # The first pass includes building the site_db and version indexes
+            for name in ('first where', 'where'):
+                results.append((storage + ' ' + name, time_per_db(
+                    lambda db: sitelist.where(site_db=db, version=version), DB_LIST)))
+
+    for name, (seconds, sites) in results:
+        print('{:<20} {:>8} sites {:>9.4f}s'.format(name, sites, seconds))
+    return results
+
+
+def simulated_query(site, latency=0.01):
+    """Stands in for a per-site DB query that spends latency seconds waiting on the database."""
+    sleep(latency)
+    return site.site_id
+
+
+def run_executor(sites=400, worker_counts=(8, 32), per_db_limit=4):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        site_version = os.path.join(tmpdir, 'site_version.csv')
+        with open(site_version, 'w') as file:
+            gen_site_version(file, sites)
+        sitelist = SiteList(all=True, site_version=site_version)
+
+    start = perf_counter()
+    for site in sitelist:
+        simulated_query(site)
+    results = [('serial', perf_counter() - start)]
+    for workers in worker_counts:
+        for limit in (None, per_db_limit):
+            start = perf_counter()
+            for _ in sitelist.run(simulated_query, workers=workers, per_db_limit=limit):
+                pass
+            results.append(('{} workers, per_db_limit {}'.format(workers, limit),
+                            perf_counter() - start))
+
+    for name, seconds in results:
+        print('{:<32} {:>8.3f}s {:>8.1f} sites/s'.format(name, seconds, sites / seconds))
+    return results
+
+
+def lookup_latency(mapping, keys):
+    """Returns the mean, median and 99th percentile in nanoseconds of looking up each of keys in
+    mapping."""
+    timings = list()
+    for key in keys:
+        start = perf_counter_ns()
+        mapping[key]
+        timings.append(perf_counter_ns() - start)
+    timings.sort()
+    return {'mean': sum(timings) / len(timings), 'p50': timings[len(timings) // 2],
+            'p99': timings[len(timings) * 99 // 100]}
+
+
+def peak_memory(fn):
+    """Returns (peak bytes, result) for calling fn() with tracemalloc running."""
+    tracemalloc.start()
+    try:
+        result = fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return peak, result
+
+
+def benchmark_fixture(directory, storage='objects', lookups=10000, subset_size=1000):
+    """Returns a dict of measurements for the fixtures gen_fixtures() wrote to directory."""
+    prod_file = os.path.join(directory, '.production')
+    db_file = os.path.join(directory, 'databases.csv')
+    site_version = os.path.join(directory, 'site_version.csv')
+    results = {'storage': storage}
+
+    start = perf_counter()
+    Cluster(prod_file=prod_file, db_file=db_file)
+    results['cluster_load_s'] = perf_counter() - start
+
+    results['load_s'], sitelist = time_load(all=True, site_version=site_version, storage=storage)
+    results['sites'] = len(sitelist)
+    # Measured on a second load so the first one's garbage does not count against it
+    results['peak_memory_bytes'] = peak_memory(
+        lambda: SiteList(all=True, site_version=site_version, storage=storage))[0]
+
+    sample = random.sample(range(len(sitelist)), min(lookups, len(sitelist)))
+    shorts = [sitelist[row].short for row in sample]
+    ids = [sitelist[row].site_id for row in sample]
+    results['shortkey_lookup_ns'] = lookup_latency(sitelist.shortkey, shorts)
+    results['idkey_lookup_ns'] = lookup_latency(sitelist.idkey, ids)
+
+    results['subset_short_s'] = time_load(key='short', sublist=shorts[:subset_size],
+                                          site_version=site_version, storage=storage)[0]
+    results['subset_id_s'] = time_load(key='id', sublist=ids[:subset_size],
+                                       site_version=site_version, storage=storage)[0]
+
+    start = perf_counter()
+    for site in sitelist:
+        site.site_db
+    results['iterate_s'] = perf_counter() - start
+    return results
+
+
+def revision():
+    """Returns the git revision of this checkout, None when it cannot be found."""
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(output=None, sizes=SUITE_SIZES, storages=('objects', 'columnar'), seed=0):
+    """Benchmarks every storage against generated fixtures of each of sizes sites and returns the
+    results, also writing them to output as JSON when it is given."""
+    results = {'revision': revision(), 'python': platform.python_version(),
+               'platform': platform.platform(),
+               'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+               'benchmarks': list()}
+    for sites in sizes:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            gen_fixtures(tmpdir, sites, seed=seed)
+            for storage in storages:
+                result = benchmark_fixture(tmpdir, storage=storage)
+                results['benchmarks'].append(result)
+                print('{:>8} sites {:<9} load {:>8.3f}s peak {:>8.1f}MiB shortkey p50 {:>6}ns '
+                      'iterate {:>7.3f}s'.format(sites, storage, result['load_s'],
+                                                 result['peak_memory_bytes'] / 2**20,
+                                                 result['shortkey_lookup_ns']['p50'],
+                                                 result['iterate_s']))
+
+    if output is not None:
+        with open(output, 'w') as file:
+            json.dump(results, file, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['compare']:
+        args = [int(arg) for arg in sys.argv[2:4]]
+        run(*args)
+        run_memory(*args[:1])
+        run_snapshot(*args[:1])
+        run_queries(*args[:1])
+        run_executor()
+    else:
+        run_suite(sys.argv[1] if len(sys.argv) > 1 else 'utils_benchmark.json',
+                  sizes=[int(arg) for arg in sys.argv[2:]] or SUITE_SIZES)
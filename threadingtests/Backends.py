@@ -0,0 +1,204 @@
+import asyncio
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timezone
+from time import perf_counter, sleep
+
+from Scheduler import GroupScheduler, read_items
+
+WORK_MODES = ('sleep', 'cpu', 'mixed')
+WORKER_COUNTS = (1, 2, 4, 8)
+
+
+def spin(iterations):
+    # CPU bound work that holds the GIL the whole time
+    total = 0
+    for number in range(iterations):
+        total += number * number
+    return total
+
+
+def iterations_per_second(seconds=0.2):
+    """Returns how many spin() iterations this machine runs per second on one core."""
+    iterations = 10000
+    while True:
+        start = perf_counter()
+        spin(iterations)
+        elapsed = perf_counter() - start
+        if elapsed >= seconds:
+            return int(iterations / elapsed)
+        iterations *= 2
+
+
+def make_tasks(items, mode, scale, rate):
+    """Returns a (group, task) pair for every (group, cost) pair in items. A task is a tuple of
+    (mode, seconds to sleep, iterations to spin): sleep work sleeps cost * scale seconds, cpu
+    work spins as long as that takes on one core and mixed work does half of each."""
+    tasks = list()
+    for group, cost in items:
+        seconds = cost * scale
+        if mode == 'sleep':
+            task = (mode, seconds, 0)
+        elif mode == 'cpu':
+            task = (mode, 0.0, int(seconds * rate))
+        elif mode == 'mixed':
+            task = (mode, seconds / 2, int(seconds / 2 * rate))
+        else:
+            raise ValueError("mode must be one of {}".format(WORK_MODES))
+        tasks.append((group, task))
+    return tasks
+
+
+def run_task(task):
+    """Does the work of task and returns the seconds it took."""
+    mode, seconds, iterations = task
+    start = perf_counter()
+    if seconds:
+        sleep(seconds)
+    if iterations:
+        spin(iterations)
+    return perf_counter() - start
+
+
+async def run_task_async(task):
+    # Sleeping gives the event loop back, spinning blocks it as CPU work in a coroutine would
+    mode, seconds, iterations = task
+    start = perf_counter()
+    if seconds:
+        await asyncio.sleep(seconds)
+    if iterations:
+        spin(iterations)
+    return perf_counter() - start
+
+
+def run_threads(tasks, workers):
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(run_task, [task for group, task in tasks]))
+
+
+def run_processes(tasks, workers):
+    # Starting the worker processes counts towards the makespan as it would for a batch job
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(run_task, [task for group, task in tasks],
+                                 chunksize=max(1, len(tasks) // (workers * 16))))
+
+
+def run_asyncio(tasks, workers):
+    async def run_all():
+        semaphore = asyncio.Semaphore(workers)
+
+        async def limited(task):
+            async with semaphore:
+                return await run_task_async(task)
+        return await asyncio.gather(*[limited(task) for group, task in tasks])
+    return asyncio.run(run_all())
+
+
+def run_scheduler(tasks, workers):
+    durations = list()
+    scheduler = GroupScheduler(lambda task: durations.append(run_task(task)), workers=workers)
+    scheduler.run(tasks)
+    return durations
+
+
+# Name to function(tasks, workers) that runs every task and returns the seconds each took, add
+# an entry to benchmark another way of running the work
+BACKENDS = {'threads': run_threads, 'processes': run_processes, 'asyncio': run_asyncio,
+            'scheduler': run_scheduler}
+
+
+def measure(backend, tasks, workers, start_method=None):
+    """Runs tasks on backend with workers workers and returns a dictionary of its makespan,
+    throughput, worker utilization and peak resident memory in KiB of this process and of its
+    largest child process. Call it in a fresh process, see isolated(), for the peaks to be its
+    own. start_method is how the processes backend starts its workers, a process spawned by
+    isolated() would spawn them otherwise."""
+    if start_method is not None:
+        multiprocessing.set_start_method(start_method, force=True)
+    start = perf_counter()
+    durations = BACKENDS[backend](tasks, workers)
+    makespan = perf_counter() - start
+    return {'backend': backend, 'workers': workers, 'items': len(durations),
+            'makespan': makespan,
+            'items_per_second': len(durations) / makespan if makespan else 0.0,
+            'utilization': sum(durations) / (workers * makespan) if makespan else 0.0,
+            'peak_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'children_peak_rss_kib': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss}
+
+
+def _send_result(connection, fn, args):
+    try:
+        connection.send((True, fn(*args)))
+    except Exception:
+        connection.send((False, traceback.format_exc()))
+    finally:
+        connection.close()
+
+
+def isolated(fn, *args):
+    """Returns fn(*args) run in a freshly spawned process."""
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_send_result, args=(sender, fn, args))
+    process.start()
+    sender.close()
+    try:
+        succeeded, result = receiver.recv()
+    finally:
+        process.join()
+    if not succeeded:
+        raise RuntimeError("ERROR: {} failed in its process:\n{}".format(fn.__name__, result))
+    return result
+
+
+def benchmark(items, backends=tuple(BACKENDS), worker_counts=WORKER_COUNTS, modes=WORK_MODES,
+              scale=0.0005, output=None):
+    """Runs the (group, cost) pairs in items with every mode of work on every backend and worker
+    count, each in its own process, printing a line per run. Returns the results and writes them
+    as JSON to output when given."""
+    items = list(items)
+    rate = iterations_per_second()
+    start_method = multiprocessing.get_start_method()
+    summary = {'python': platform.python_version(), 'platform': platform.platform(),
+               'cpus': len(os.sched_getaffinity(0)), 'start_method': start_method,
+               'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+               'items': len(items), 'total_cost': sum(cost for group, cost in items),
+               'scale': scale, 'spin_iterations_per_second': rate, 'results': list()}
+    for mode in modes:
+        tasks = make_tasks(items, mode, scale, rate)
+        for backend in backends:
+            for workers in worker_counts:
+                result = isolated(measure, backend, tasks, workers, start_method)
+                result['mode'] = mode
+                summary['results'].append(result)
+                print('{:<6} {:<10} {:>3} workers {:>8.3f}s {:>9.1f} items/s utilization '
+                      '{:>5.1%} peak {:>7} KiB children {:>7} KiB'.format(
+                          mode, backend, workers, result['makespan'],
+                          result['items_per_second'], result['utilization'],
+                          result['peak_rss_kib'], result['children_peak_rss_kib']))
+
+    if output is not None:
+        with open(output, 'w') as file:
+            json.dump(summary, file, indent=2)
+    return summary
+
+
+if __name__ == "__main__":
+    infile_name = sys.argv[1] if len(sys.argv) > 1 else 'infile.csv'
+    output_name = sys.argv[2] if len(sys.argv) > 2 else 'backends.json'
+    if os.path.exists(infile_name):
+        with open(infile_name, 'r') as infile:
+            input_items = list(read_items(infile))
+    else:
+        from InputBuilder import gen_input
+        generated = io.StringIO()
+        gen_input(generated, 1200, 1, 8, 1, 10)
+        input_items = list(read_items(generated.getvalue().splitlines()))
+    benchmark(input_items, output=output_name)
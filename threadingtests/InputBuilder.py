@@ -1,24 +1,104 @@
+import math
 import random
+import sys
+from collections import Counter
+from itertools import accumulate
 
+GROUP_SKEWS = ('uniform', 'zipf', 'hot')
+COST_DISTRIBUTIONS = ('uniform', 'pareto', 'lognormal')
+BATCH_ROWS = 65536
+
+
+def group_weights(min_group, max_group, skew='uniform', zipf_s=1.1, hot_fraction=0.4):
+    """Returns the relative weight of every group from min_group to max_group.
+
+    uniform: every group is as likely
+    zipf: the n-th group is 1 / n ** zipf_s as likely as min_group
+    hot: min_group gets hot_fraction of the rows and the other groups share the rest evenly
+    """
+    groups = max_group - min_group + 1
+    if skew == 'uniform':
+        return [1.0] * groups
+    if skew == 'zipf':
+        return [1.0 / rank ** zipf_s for rank in range(1, groups + 1)]
+    if skew == 'hot':
+        if groups == 1:
+            return [1.0]
+        return [hot_fraction] + [(1.0 - hot_fraction) / (groups - 1)] * (groups - 1)
+    raise ValueError("skew must be one of {}".format(GROUP_SKEWS))
+
+
+def cost_weights(min_value, max_value, costs='uniform', alpha=1.2, sigma=1.0):
+    """Returns the relative weight of every cost from min_value to max_value.
+
+    uniform: every cost is as likely
+    pareto: heavy tailed, a cost of v is as likely as v ** -(alpha + 1)
+    lognormal: heavy tailed, costs follow a lognormal with sigma whose median is min_value
+    """
+    values = range(min_value, max_value + 1)
+    if costs == 'uniform':
+        return [1.0] * len(values)
+    if min_value < 1 and costs in ('pareto', 'lognormal'):
+        raise ValueError("min_value must be at least 1 for {} costs".format(costs))
+    if costs == 'pareto':
+        return [value ** -(alpha + 1) for value in values]
+    if costs == 'lognormal':
+        mu = math.log(min_value)
+        return [math.exp(-(math.log(value) - mu) ** 2 / (2 * sigma ** 2)) / value
+                for value in values]
+    raise ValueError("costs must be one of {}".format(COST_DISTRIBUTIONS))
+
+
+def gen_input(file_handle, count, min_group, max_group, min_value, max_value, seed=None,
+              skew='uniform', costs='uniform', zipf_s=1.1, hot_fraction=0.4, alpha=1.2,
+              sigma=1.0, batch=BATCH_ROWS):
+    """Writes count rows of group,cost like infile.csv to file_handle and returns how many rows
+    each group from min_group to max_group got. Rows are drawn batch at a time and each batch
+    is written with a single write. The same seed writes the same rows.
+
+    skew: how rows spread over groups, see group_weights()
+    costs: how costs spread from min_value to max_value, see cost_weights()
+    """
+    rng = random.Random(seed)
+    groups = range(min_group, max_group + 1)
+    group_cumulative = _cumulative(group_weights(min_group, max_group, skew, zipf_s,
+                                                 hot_fraction))
+    # Lines are joined from ready made strings rather than formatting every row
+    value_strings = [str(value) + '\n' for value in range(min_value, max_value + 1)]
+    value_cumulative = _cumulative(cost_weights(min_value, max_value, costs, alpha, sigma))
+    prefixes = {group: str(group) + ',' for group in groups}
+    group_counts = Counter({group: 0 for group in groups})
+    remaining = count
+    while remaining > 0:
+        rows = min(batch, remaining)
+        chosen = rng.choices(groups, cum_weights=group_cumulative, k=rows)
+        values = rng.choices(value_strings, cum_weights=value_cumulative, k=rows)
+        file_handle.write(''.join(map(str.__add__, map(prefixes.__getitem__, chosen), values)))
+        group_counts.update(chosen)
+        remaining -= rows
+    return dict(group_counts)
+
+
+def _cumulative(weights):
+    # Cumulative weights for random.choices(), None when they are all equal as choosing without
+    # weights is faster
+    if len(set(weights)) <= 1:
+        return None
+    return list(accumulate(weights))
 
-def gen_input(file_handle, count, min_group, max_group, min_value, max_value):
-    group_counts = {k:0 for k in range(min_group, max_group+1)}
-    print(group_counts)
-    for x in range(count):
-        group = random.randint(min_group, max_group)
-        group_counts[group] += 1
-        value = random.randint(min_value, max_value)
-        file_handle.write(str(group) + ',' + str(value) + '\n')
-    return group_counts
 
 if __name__ == "__main__":
-    c = 1200
+    c = int(sys.argv[1]) if len(sys.argv) > 1 else 1200
     mng = 1
     mxg = 8
     mnv = 1
     mxv = 10
+    group_skew = sys.argv[2] if len(sys.argv) > 2 else 'uniform'
+    cost_distribution = sys.argv[3] if len(sys.argv) > 3 else 'uniform'
+    input_seed = int(sys.argv[4]) if len(sys.argv) > 4 else None
 
     with open("infile.csv", 'w') as file:
-        results = gen_input(file, c, mng, mxg, mnv, mxv)
+        results = gen_input(file, c, mng, mxg, mnv, mxv, seed=input_seed, skew=group_skew,
+                            costs=cost_distribution)
 
-    print(results)
\ No newline at end of file
+    print(results)
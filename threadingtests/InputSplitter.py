@@ -1,19 +1,124 @@
+import heapq
+import io
+import sys
+import tempfile
+
+STRATEGIES = ('greedy', 'lpt', 'group')
+
+# Weights below this get an LPT spill file each, heavier ones share one per power of two
+EXACT_WEIGHTS = 64
+
+
+def imbalance(weights):
+    """Returns the heaviest shard weight over the mean shard weight, 1.0 being a perfect split."""
+    total = sum(weights)
+    if not total:
+        return 1.0
+    return max(weights) / (total / len(weights))
+
+
+def split(lines, writers, strategy='greedy'):
+    """Writes every csv line like those of infile.csv to one of writers, reading lines once, and
+    returns a report of the split. Each line's weight is its second column.
+
+    greedy: every line goes to the shard with the least weight so far
+    lpt: lines go out heaviest first, each to the shard with the least weight so far. Lines are
+        spilled to temporary files by weight while they are read, so inputs larger than memory
+        can be split, then written out from the heaviest file down
+    group: the first line of a group picks the shard with the least weight so far and the rest
+        of the group follows it, so a group never spans shards
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError("strategy must be one of {}".format(STRATEGIES))
+    if not writers:
+        raise ValueError("writers must have at least one writer")
+    rows = [0] * len(writers)
+    weights = [0] * len(writers)
+
+    def write(line, weight, shard):
+        writers[shard].write(line)
+        rows[shard] += 1
+        weights[shard] += weight
+
+    if strategy == 'group':
+        homes = dict()
+        for line, group, weight in _parse(lines):
+            shard = homes.get(group)
+            if shard is None:
+                shard = homes[group] = min(range(len(weights)), key=weights.__getitem__)
+            write(line, weight, shard)
+    else:
+        lightest = [(0, number) for number in range(len(writers))]  # heap of (weight, shard)
+
+        def place(line, weight):
+            load, shard = lightest[0]
+            write(line, weight, shard)
+            heapq.heapreplace(lightest, (load + weight, shard))
+
+        if strategy == 'lpt':
+            spills = dict()
+            try:
+                for line, group, weight in _parse(lines):
+                    key = weight if weight < EXACT_WEIGHTS else EXACT_WEIGHTS + weight.bit_length()
+                    if key not in spills:
+                        spills[key] = tempfile.TemporaryFile('w+')
+                    spills[key].write(line)
+                for key in sorted(spills, reverse=True):
+                    spills[key].seek(0)
+                    for line, group, weight in _parse(spills[key]):
+                        place(line, weight)
+            finally:
+                for spill in spills.values():
+                    spill.close()
+        else:
+            for line, group, weight in _parse(lines):
+                place(line, weight)
+
+    return {'strategy': strategy, 'shards': len(writers), 'rows': rows, 'weights': weights,
+            'imbalance': imbalance(weights)}
+
+
+def split_lines(lines, shards, strategy='greedy'):
+    """Returns a list of shards lists of the lines split() puts in each shard and its report."""
+    writers = [io.StringIO() for _ in range(shards)]
+    report = split(lines, writers, strategy)
+    return [writer.getvalue().splitlines(keepends=True) for writer in writers], report
+
+
+def split_file(infile_name, shards, strategy='greedy', outfile_basename='infile',
+               outfile_extension='.csv'):
+    """Splits the file infile_name into the files infile1.csv to infileN.csv for N shards and
+    returns the report of split()."""
+    writers = list()
+    try:
+        for number in range(1, shards + 1):
+            writers.append(open(outfile_basename + str(number) + outfile_extension, 'w'))
+        with open(infile_name, 'r') as infile:
+            return split(infile, writers, strategy)
+    finally:
+        for writer in writers:
+            writer.close()
+
+
+def _parse(lines):
+    # Generator of (line, group, weight) for the lines that are not blank
+    for line in lines:
+        if not line.strip():
+            continue
+        if not line.endswith('\n'):
+            line += '\n'
+        group, weight = line.split(',')[:2]
+        weight = int(weight)
+        if weight < 0:
+            raise ValueError("weights must not be negative: {!r}".format(line))
+        yield line, group, weight
+
 
 if __name__ == "__main__":
-    infile_name = "infile.csv"
-    outfile_basename = "infile"
-    outfile_extension = ".csv"
-    outfile_count = 0
-    max_size = 600
-    with open("infile.csv", 'r') as infile:
-        infile_contents = infile.readlines()
-
-    for i, line in enumerate(infile_contents):
-        if i % max_size == 0:
-            if outfile_count > 0:
-                outfile.close()
-            outfile_count += 1
-            outfile = open(outfile_basename + str(outfile_count) + outfile_extension, "w")
-        outfile.write(line)
-
-    outfile.close()
+    infile_name = sys.argv[1] if len(sys.argv) > 1 else 'infile.csv'
+    shard_count = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    split_strategy = sys.argv[3] if len(sys.argv) > 3 else 'greedy'
+    report = split_file(infile_name, shard_count, split_strategy)
+    for number, (row_count, weight) in enumerate(zip(report['rows'], report['weights']), 1):
+        print('infile{}.csv {:>10} rows {:>12} weight'.format(number, row_count, weight))
+    print('{} imbalance {:.4f}'.format(split_strategy, report['imbalance']))
@@ -0,0 +1,188 @@
+import csv
+import threading
+from collections import deque
+from time import perf_counter
+
+
+class GroupScheduler:
+    """Runs work(item) for a stream of (group, item) pairs on a fixed number of worker threads.
+
+    Every group has a home worker that runs its items, so a group's items run in order on one
+    thread the way one queue per group does. A worker with nothing left of its own steals the
+    group with the most items waiting from another worker: an ordered group is taken over whole,
+    so its items still run one at a time in order, while from an unordered group single items
+    are taken from the back. Items can be submitted while the workers run.
+
+    ordered: True if every group's items must run in order, False if none need to, or a set of
+        the groups that do
+
+    Example:
+        scheduler = GroupScheduler(one_item, workers=4)
+        with open('infile.csv') as infile:
+            statistics = scheduler.run(read_items(infile))
+
+    Attributes:
+        work: function called with each item
+        workers: number of worker threads
+        errors: list of (group, item, exception) for every item whose work raised
+    """
+
+    def __init__(self, work, workers=4, ordered=True):
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        self.work = work
+        self.workers = workers
+        self.errors = list()
+        self._ordered = ordered
+        self._condition = threading.Condition()
+        self._pending = dict()  # group to deque of items waiting to run
+        self._ready = [deque() for _ in range(workers)]  # groups with items waiting per worker
+        self._queued = dict()  # group to the worker whose ready deque has it
+        self._active = set()  # ordered groups a worker is running
+        self._home = dict()
+        self._closed = False
+        self._threads = list()
+        self._worker_stats = list()
+        self._started = None
+        self._finished = None
+
+    def is_ordered(self, group):
+        if isinstance(self._ordered, bool):
+            return self._ordered
+        return group in self._ordered
+
+    def start(self):
+        """Starts the worker threads."""
+        if self._threads:
+            raise RuntimeError("ERROR: GroupScheduler has already been started")
+        self._started = perf_counter()
+        for number in range(self.workers):
+            stats = {'items': 0, 'busy': 0.0, 'stolen_groups': 0, 'stolen_items': 0}
+            self._worker_stats.append(stats)
+            thread = threading.Thread(target=self._run_worker, args=(number, stats),
+                                      name='worker{}'.format(number + 1), daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    def submit(self, group, item):
+        """Queues item to run after the items of group submitted before it."""
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("ERROR: GroupScheduler has been closed")
+            pending = self._pending.get(group)
+            if pending is None:
+                pending = self._pending[group] = deque()
+                # New groups are spread over the workers as they first appear
+                self._home[group] = len(self._home) % self.workers
+            pending.append(item)
+            if group not in self._active and group not in self._queued:
+                worker = self._home[group]
+                self._ready[worker].append(group)
+                self._queued[group] = worker
+            self._condition.notify()
+
+    def close(self):
+        """Marks the end of the input, workers exit once every item has run."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def join(self):
+        """Waits for every item to run and returns statistics()."""
+        for thread in self._threads:
+            thread.join()
+        if self._finished is None:
+            self._finished = perf_counter()
+        return self.statistics()
+
+    def run(self, items):
+        """Starts the workers, submits every (group, item) pair from the iterable items as it is
+        read, then waits for them all to run and returns statistics()."""
+        self.start()
+        try:
+            for group, item in items:
+                self.submit(group, item)
+        finally:
+            self.close()
+        return self.join()
+
+    def statistics(self):
+        """Returns a dictionary of the makespan in seconds, the items run and how busy each
+        worker was, along with the groups and items it stole."""
+        end = self._finished if self._finished is not None else perf_counter()
+        makespan = end - self._started if self._started is not None else 0.0
+        busy = sum(stats['busy'] for stats in self._worker_stats)
+        return {'workers': self.workers, 'makespan': makespan,
+                'items': sum(stats['items'] for stats in self._worker_stats),
+                'errors': len(self.errors),
+                'utilization': busy / (makespan * self.workers) if makespan else 0.0,
+                'per_worker': [dict(stats) for stats in self._worker_stats]}
+
+    def _run_worker(self, number, stats):
+        held = None
+        while True:
+            with self._condition:
+                task = self._take(number, held, stats)
+            if task is None:
+                return
+            group, item, held = task
+            start = perf_counter()
+            try:
+                self.work(item)
+            except Exception as error:
+                with self._condition:
+                    self.errors.append((group, item, error))
+            stats['busy'] += perf_counter() - start
+            stats['items'] += 1
+
+    def _take(self, number, held, stats):
+        # Called holding the condition, returns the next (group, item, held group) for worker
+        # number to run or None once there is nothing left. held is the ordered group the worker
+        # is running, which it keeps until the group has no items waiting
+        if held is not None:
+            if self._pending[held]:
+                return held, self._pending[held].popleft(), held
+            self._active.discard(held)
+        while True:
+            if self._ready[number]:
+                return self._claim(number, self._ready[number][0], False)
+            group = self._loaded_group(number)
+            if group is not None:
+                if self.is_ordered(group):
+                    stats['stolen_groups'] += 1
+                    self._home[group] = number
+                else:
+                    stats['stolen_items'] += 1
+                return self._claim(number, group, True)
+            if self._closed:
+                return None
+            self._condition.wait()
+
+    def _loaded_group(self, number):
+        # The group queued on another worker with the most items waiting
+        best = None
+        for group, worker in self._queued.items():
+            if worker != number and (best is None
+                                     or len(self._pending[group]) > len(self._pending[best])):
+                best = group
+        return best
+
+    def _claim(self, number, group, stolen):
+        pending = self._pending[group]
+        if self.is_ordered(group):
+            self._unqueue(group)
+            self._active.add(group)
+            return group, pending.popleft(), group
+        item = pending.pop() if stolen else pending.popleft()
+        if not pending:
+            self._unqueue(group)
+        return group, item, None
+
+    def _unqueue(self, group):
+        self._ready[self._queued.pop(group)].remove(group)
+
+
+def read_items(file_handle):
+    """Generator of (group, cost) pairs from the rows of a csv file like infile.csv."""
+    for group, cost in csv.reader(file_handle):
+        yield int(group), int(cost)
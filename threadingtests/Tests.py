@@ -1,24 +1,26 @@
-import cProfile
 import csv
-from time import sleep
+import io
+import os
+import sys
+from time import perf_counter, sleep
 import threading
 import queue
 
-mxg = 8
-queues = dict()
+from InputSplitter import split_lines
+from Scheduler import GroupScheduler, read_items
 
 
-def one_thread(file_handle):
+def one_thread(file_handle, scale=1.0):
     items = csv.reader(file_handle)
     for item in items:
         (_, time) = item
         seconds = int(time)
-        one_item(seconds)
+        one_item(seconds, scale)
 
 
-def two_threads(file_handle1, file_handle2):
-    t1 = threading.Thread(target=one_thread, args=(file_handle1,))
-    t2 = threading.Thread(target=one_thread, args=(file_handle2,))
+def two_threads(file_handle1, file_handle2, scale=1.0):
+    t1 = threading.Thread(target=one_thread, args=(file_handle1, scale))
+    t2 = threading.Thread(target=one_thread, args=(file_handle2, scale))
 
     t1.start()
     t2.start()
@@ -27,44 +29,85 @@ def two_threads(file_handle1, file_handle2):
     t2.join()
 
 
-def one_item(seconds):
-    sleep(seconds)
+def one_item(seconds, scale=1.0):
+    sleep(seconds * scale)
 
 
 def generate_queues(file_handle):
-    for i in range(mxg):
-        queues[i+1] = queue.Queue()
+    # One queue per group in the input, however many groups there are
+    queues = dict()
     items = csv.reader(file_handle)
     for item in items:
         (g, time) = item
+        if int(g) not in queues:
+            queues[int(g)] = queue.Queue()
         queues[int(g)].put(int(time))
+    return queues
 
 
-def one_worker(myqueue):
+def one_worker(myqueue, scale=1.0):
     while not myqueue.empty():
         item = myqueue.get()
-        one_item(item)
+        one_item(item, scale)
         myqueue.task_done()
 
 
-def process_queues():
+def process_queues(queues, scale=1.0):
     threads = list()
-    for q in range(len(queues.keys())):
-        threads.append(threading.Thread(name=str(q+1), target=one_worker, args=(queues[q+1],)))
+    for g in sorted(queues):
+        threads.append(threading.Thread(name=str(g), target=one_worker, args=(queues[g], scale)))
     for t in threads:
         t.start()
     for t in threads:
         t.join()
 
 
-if __name__ == "__main__":
-    with open('infile.csv', 'r') as infile:
-        cProfile.run('one_thread(infile)')
-
-    with open('infile1.csv', 'r') as infile1, open('infile2.csv', 'r') as infile2:
-        cProfile.run('two_threads(infile1, infile2)')
+def scheduled(file_handle, workers=4, ordered=True, scale=1.0):
+    scheduler = GroupScheduler(lambda seconds: one_item(seconds, scale), workers=workers,
+                               ordered=ordered)
+    return scheduler.run(read_items(file_handle))
+
+
+def timed(fn, *args, **kwargs):
+    start = perf_counter()
+    fn(*args, **kwargs)
+    return perf_counter() - start
+
+
+def compare(lines, workers=(2, 4, 8), scale=0.001):
+    """Returns a list of (strategy, makespan in seconds) running the csv lines of an input like
+    infile.csv with every strategy, each item sleeping its cost times scale seconds. two_threads
+    gets the input cut in half by lines and then split in two by weight with InputSplitter.py,
+    process_queues one thread per group. lower bound is the least any strategy with the most
+    workers could take."""
+    half = len(lines) // 2
+    costs = [cost * scale for group, cost in read_items(lines)]
+    results = [('one_thread', timed(one_thread, lines, scale)),
+               ('two_threads', timed(two_threads, lines[:half], lines[half:], scale)),
+               ('two_threads balanced', timed(two_threads, *split_lines(lines, 2, 'lpt')[0],
+                                              scale=scale)),
+               ('process_queues', timed(process_queues, generate_queues(lines), scale))]
+    for count in workers:
+        for ordered in (True, False):
+            statistics = scheduled(lines, count, ordered, scale)
+            results.append(('scheduler {} workers{}'.format(count, '' if ordered else
+                                                            ' unordered'),
+                            statistics['makespan']))
+    results.append(('lower bound', max(sum(costs) / max(workers), max(costs, default=0))))
+    return results
 
-    with open('infile.csv', 'r') as infile:
-        cProfile.run('generate_queues(infile)')
 
-    cProfile.run('process_queues()')
\ No newline at end of file
+if __name__ == "__main__":
+    infile_name = sys.argv[1] if len(sys.argv) > 1 else 'infile.csv'
+    scale = float(sys.argv[2]) if len(sys.argv) > 2 else 0.001
+    if os.path.exists(infile_name):
+        with open(infile_name, 'r') as infile:
+            infile_lines = infile.readlines()
+    else:
+        from InputBuilder import gen_input
+        generated = io.StringIO()
+        gen_input(generated, 1200, 1, 8, 1, 10)
+        infile_lines = generated.getvalue().splitlines()
+
+    for strategy, makespan in compare(infile_lines, scale=scale):
+        print('{:<30} {:>8.3f}s'.format(strategy, makespan))
@@ -0,0 +1,64 @@
+import contextlib
+import io
+import json
+import os
+import tempfile
+import unittest
+
+from Backends import BACKENDS, benchmark, make_tasks, measure, run_task
+
+ITEMS = [(1, 2), (2, 1), (1, 1), (3, 2)]
+MEASURED = {'backend', 'workers', 'items', 'makespan', 'items_per_second', 'utilization',
+            'peak_rss_kib', 'children_peak_rss_kib'}
+
+
+class TestBackends(unittest.TestCase):
+    def test_make_tasks(self):
+        self.assertEqual(make_tasks(ITEMS[:2], 'sleep', 0.5, 100),
+                         [(1, ('sleep', 1.0, 0)), (2, ('sleep', 0.5, 0))])
+        self.assertEqual(make_tasks(ITEMS[:2], 'cpu', 0.5, 100),
+                         [(1, ('cpu', 0.0, 100)), (2, ('cpu', 0.0, 50))])
+        self.assertEqual(make_tasks(ITEMS[:2], 'mixed', 0.5, 100),
+                         [(1, ('mixed', 0.5, 50)), (2, ('mixed', 0.25, 25))])
+        self.assertRaises(ValueError, make_tasks, ITEMS, 'io', 0.5, 100)
+
+    def test_run_task(self):
+        self.assertGreaterEqual(run_task(('sleep', 0.01, 0)), 0.01)
+        self.assertGreater(run_task(('cpu', 0.0, 1000)), 0.0)
+        self.assertGreaterEqual(run_task(('mixed', 0.01, 1000)), 0.01)
+
+    def test_measure_every_backend(self):
+        tasks = make_tasks(ITEMS, 'mixed', 0.002, 100000)
+        for backend in BACKENDS:
+            result = measure(backend, tasks, 2)
+            self.assertEqual(set(result), MEASURED)
+            self.assertEqual((result['backend'], result['workers'], result['items']),
+                             (backend, 2, len(ITEMS)))
+            self.assertGreater(result['makespan'], 0.0)
+            self.assertGreater(result['items_per_second'], 0.0)
+            self.assertGreater(result['utilization'], 0.0)
+            self.assertGreater(result['peak_rss_kib'], 0)
+
+    def test_benchmark_writes_a_json_summary(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output = os.path.join(tmpdir, 'backends.json')
+            with contextlib.redirect_stdout(io.StringIO()) as printed:
+                returned = benchmark(ITEMS, backends=('threads', 'processes'), worker_counts=(1,),
+                                     modes=('sleep',), scale=0.001, output=output)
+            with open(output) as file:
+                summary = json.load(file)
+        self.assertEqual(summary, returned)
+        self.assertEqual(set(summary), {'python', 'platform', 'cpus', 'start_method', 'date',
+                                        'items', 'total_cost', 'scale',
+                                        'spin_iterations_per_second', 'results'})
+        self.assertEqual((summary['items'], summary['total_cost']), (4, 6))
+        self.assertEqual([(result['mode'], result['backend']) for result in summary['results']],
+                         [('sleep', 'threads'), ('sleep', 'processes')])
+        for result in summary['results']:
+            self.assertEqual(set(result), MEASURED | {'mode'})
+            self.assertGreater(result['peak_rss_kib'], 0)
+        self.assertEqual(len(printed.getvalue().splitlines()), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import io
+import unittest
+from collections import Counter
+
+from InputBuilder import cost_weights, gen_input, group_weights
+
+
+def generate(count, seed, **kwargs):
+    output = io.StringIO()
+    counts = gen_input(output, count, 1, 8, 1, 10, seed=seed, **kwargs)
+    return output.getvalue(), counts
+
+
+class TestGenInput(unittest.TestCase):
+    def test_same_seed_same_rows(self):
+        for skew in ('uniform', 'zipf', 'hot'):
+            for costs in ('uniform', 'pareto', 'lognormal'):
+                self.assertEqual(generate(2000, 7, skew=skew, costs=costs, batch=300),
+                                 generate(2000, 7, skew=skew, costs=costs, batch=300))
+        self.assertNotEqual(generate(2000, 8)[0], generate(2000, 7)[0])
+
+    def test_counts_match_rows_written(self):
+        text, counts = generate(10000, 3, skew='zipf', costs='pareto', batch=4096)
+        rows = [line.split(',') for line in text.splitlines()]
+        self.assertEqual(len(rows), 10000)
+        written = Counter(int(group) for group, cost in rows)
+        self.assertEqual(counts, {group: written[group] for group in range(1, 9)})
+        self.assertTrue(all(1 <= int(cost) <= 10 for group, cost in rows))
+
+    def test_skew(self):
+        text, counts = generate(20000, 1, skew='hot')
+        self.assertAlmostEqual(counts[1] / 20000, 0.4, delta=0.02)
+        text, counts = generate(20000, 1, skew='zipf')
+        self.assertEqual(max(counts, key=counts.get), 1)
+
+    def test_invalid_distributions(self):
+        self.assertRaises(ValueError, group_weights, 1, 8, 'normal')
+        self.assertRaises(ValueError, cost_weights, 1, 10, 'normal')
+        self.assertRaises(ValueError, cost_weights, 0, 10, 'pareto')
+
+
+if __name__ == '__main__':
+    unittest.main()
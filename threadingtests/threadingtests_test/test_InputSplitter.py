@@ -0,0 +1,86 @@
+import os
+import tempfile
+import unittest
+
+from InputSplitter import imbalance, split_file, split_lines
+
+
+def lines_of(weights, groups=None):
+    # csv lines like infile.csv, every line in its own group unless groups are given
+    groups = range(len(weights)) if groups is None else groups
+    return ['{},{}\n'.format(group, weight) for group, weight in zip(groups, weights)]
+
+
+def shard_weights(shards):
+    return [sum(int(line.split(',')[1]) for line in shard) for shard in shards]
+
+
+class TestSplit(unittest.TestCase):
+    # Graham's example: the best split of these into 3 shards is 9 each while LPT gets 11, its
+    #     worst case of 4/3 - 1/(3 * 3) times the best
+    WEIGHTS = [3, 3, 3, 4, 4, 5, 5]
+
+    def test_lpt_is_within_its_bound(self):
+        shards, report = split_lines(lines_of(self.WEIGHTS), 3, 'lpt')
+        self.assertEqual(sorted(shard_weights(shards)), [8, 8, 11])
+        # At most 4/3 - 1/(3 * shards) times the best split, in integers
+        self.assertLessEqual(max(report['weights']), (4 * 3 - 1) * 9 // (3 * 3))
+        self.assertEqual(report['weights'], shard_weights(shards))
+        self.assertAlmostEqual(report['imbalance'], 11 / 9)
+
+    def test_greedy_follows_input_order(self):
+        shards, report = split_lines(lines_of(self.WEIGHTS), 3, 'greedy')
+        self.assertEqual(sorted(report['weights']), [7, 8, 12])
+        self.assertEqual(report['rows'], [len(shard) for shard in shards])
+        self.assertEqual(sum(report['rows']), len(self.WEIGHTS))
+
+    def test_lpt_keeps_every_heavy_line(self):
+        weights = [1000, 70, 65, 64, 300, 5, 129]
+        shards, report = split_lines(lines_of(weights), 2, 'lpt')
+        self.assertEqual(sorted(line for shard in shards for line in shard),
+                         sorted(lines_of(weights)))
+        self.assertEqual(sorted(report['weights']), [633, 1000])
+
+    def test_group_never_spans_shards(self):
+        groups = [1, 2, 3, 1, 2, 1, 4, 3, 1]
+        weights = [5, 4, 3, 5, 4, 5, 1, 3, 5]
+        shards, report = split_lines(lines_of(weights, groups), 3, 'group')
+        homes = dict()
+        for number, shard in enumerate(shards):
+            for line in shard:
+                self.assertEqual(homes.setdefault(line.split(',')[0], number), number)
+        self.assertEqual(len(homes), 4)
+        self.assertEqual(report['weights'], [20, 8, 7])
+        self.assertEqual(report['strategy'], 'group')
+
+    def test_blank_lines_and_missing_newlines(self):
+        shards, report = split_lines(['1,2\n', '\n', '2,3'], 2)
+        self.assertEqual(sorted(line for shard in shards for line in shard), ['1,2\n', '2,3\n'])
+        self.assertEqual(sum(report['rows']), 2)
+
+    def test_invalid_arguments(self):
+        self.assertRaises(ValueError, split_lines, lines_of([1]), 2, 'random')
+        self.assertRaises(ValueError, split_lines, lines_of([1]), 0)
+        self.assertRaises(ValueError, split_lines, ['1,-1\n'], 2)
+
+    def test_imbalance(self):
+        self.assertEqual(imbalance([3, 1]), 1.5)
+        self.assertEqual(imbalance([2, 2]), 1.0)
+        self.assertEqual(imbalance([0, 0]), 1.0)
+
+    def test_split_file(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            infile = os.path.join(tmpdir, 'infile.csv')
+            with open(infile, 'w') as file:
+                file.writelines(lines_of(self.WEIGHTS))
+            report = split_file(infile, 3, 'lpt', outfile_basename=os.path.join(tmpdir, 'infile'))
+            written = list()
+            for number in range(1, 4):
+                with open(os.path.join(tmpdir, 'infile{}.csv'.format(number))) as file:
+                    written.append(file.readlines())
+        self.assertEqual(shard_weights(written), report['weights'])
+        self.assertEqual(sum(report['rows']), len(self.WEIGHTS))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import io
+import threading
+import time
+import unittest
+
+from Scheduler import GroupScheduler, read_items
+
+
+class Recorder:
+    # work for a GroupScheduler whose items are (group, number, seconds) tuples, recording the
+    # order each group's items ran in, the threads they ran on and any overlap within a group
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.order = dict()
+        self.threads = dict()
+        self.running = set()
+        self.overlaps = list()
+
+    def __call__(self, item):
+        group, number, seconds = item
+        with self.lock:
+            if group in self.running:
+                self.overlaps.append(item)
+            self.running.add(group)
+            self.order.setdefault(group, list()).append(number)
+            self.threads.setdefault(group, set()).add(threading.current_thread().name)
+        time.sleep(seconds)
+        with self.lock:
+            self.running.discard(group)
+
+
+class TestGroupScheduler(unittest.TestCase):
+    def test_ordered_groups_keep_their_order_when_stolen(self):
+        # Worker 3's groups finish at once so it steals the groups waiting on the others
+        recorder = Recorder()
+        scheduler = GroupScheduler(recorder, workers=3)
+        items = [(group, (group, number, 0.0 if group % 3 == 2 else 0.005))
+                 for number in range(10) for group in range(6)]
+        statistics = scheduler.run(items)
+        self.assertEqual(statistics['items'], 60)
+        self.assertGreater(sum(stats['stolen_groups'] for stats in statistics['per_worker']), 0)
+        self.assertEqual(recorder.order, {group: list(range(10)) for group in range(6)})
+        self.assertEqual(recorder.overlaps, [])
+
+    def test_unordered_group_spreads_over_workers(self):
+        recorder = Recorder()
+        scheduler = GroupScheduler(recorder, workers=4, ordered=False)
+        statistics = scheduler.run((1, (1, number, 0.005)) for number in range(20))
+        self.assertEqual(statistics['items'], 20)
+        self.assertGreater(sum(stats['stolen_items'] for stats in statistics['per_worker']), 0)
+        self.assertGreater(len(recorder.threads[1]), 1)
+        self.assertEqual(sorted(recorder.order[1]), list(range(20)))
+
+    def test_ordered_set_only_orders_its_groups(self):
+        recorder = Recorder()
+        scheduler = GroupScheduler(recorder, workers=4, ordered={1})
+        scheduler.run((group, (group, number, 0.005)) for number in range(12) for group in (1, 2))
+        self.assertEqual(recorder.order[1], list(range(12)))
+        self.assertEqual([item for item in recorder.overlaps if item[0] == 1], [])
+        self.assertGreater(len(recorder.threads[2]), 1)
+
+    def test_errors_are_collected(self):
+        def work(item):
+            if item % 3 == 0:
+                raise ValueError(item)
+
+        scheduler = GroupScheduler(work, workers=2)
+        statistics = scheduler.run((item % 2, item) for item in range(10))
+        self.assertEqual(statistics['items'], 10)
+        self.assertEqual(statistics['errors'], 4)
+        self.assertEqual(sorted((group, item) for group, item, error in scheduler.errors),
+                         [(0, 0), (0, 6), (1, 3), (1, 9)])
+        self.assertTrue(all(isinstance(error, ValueError) for _, _, error in scheduler.errors))
+
+    def test_run_consumes_a_generator(self):
+        ran = list()
+        items = read_items(io.StringIO('1,3\n2,1\n1,4\n3,1\n'))
+        statistics = GroupScheduler(ran.append, workers=2).run(items)
+        self.assertEqual(statistics['items'], 4)
+        self.assertEqual(sorted(ran), [1, 1, 3, 4])
+        self.assertIsNone(next(items, None))
+
+    def test_closed_scheduler_rejects_items(self):
+        scheduler = GroupScheduler(lambda item: None, workers=1)
+        scheduler.run([])
+        self.assertRaises(RuntimeError, scheduler.submit, 1, 1)
+        self.assertRaises(ValueError, GroupScheduler, lambda item: None, workers=0)
+
+
+if __name__ == '__main__':
+    unittest.main()